@@ -0,0 +1,100 @@
+# Minimal stand-in for the parts of the docker SDK pyd2b2 uses. Network
+# calls only count, so the benchmark measures the backup path itself.
+import threading
+
+from src import settings
+
+class Image:
+    def __init__(self, tag):
+        self.tags = [tag]
+
+class Container:
+    def __init__(self, number, name, image, labels):
+        self.id = "{:064x}".format(number)
+        self.short_id = self.id[:12]
+        self.name = name
+        self.image = Image(image)
+        self.labels = labels
+        self.status = "running"
+        self.attrs = {"NetworkSettings": {"Ports": {}}}
+
+class Network:
+    def __init__(self, client, name):
+        self.client = client
+        self.id = "network-" + name
+        self.name = name
+        self.containers = []
+
+    def connect(self, container, aliases=None):
+        self.client.count("network_connect")
+
+    def disconnect(self, container, force=False):
+        self.client.count("network_disconnect")
+
+    def remove(self):
+        self.client.count("network_remove")
+        self.client.networks.items.pop(self.id, None)
+
+class Networks:
+    def __init__(self, client):
+        self.client = client
+        self.items = {}
+
+    def list(self, names=None, greedy=False):
+        return [network for network in self.items.values() if names is None or network.name == names]
+
+    def create(self, name):
+        self.client.count("network_create")
+        network = Network(self.client, name)
+        self.items[network.id] = network
+        return network
+
+    def get(self, network_id):
+        return self.items[network_id]
+
+class Containers:
+    def __init__(self, client, containers):
+        self.client = client
+        self.items = containers
+
+    def list(self, filters=None, all=False):
+        self.client.count("containers_list")
+        return list(self.items)
+
+    def get(self, container_id):
+        self.client.count("containers_get")
+        return next(container for container in self.items if container.id == container_id or container.name == container_id)
+
+class Client:
+    def __init__(self, containers):
+        self.calls = {}
+        self._lock = threading.Lock()
+        self.containers = Containers(self, containers)
+        self.networks = Networks(self)
+        self._stopped = threading.Event()
+
+    def count(self, call):
+        with self._lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+
+    def events(self, decode=False, since=None, filters=None):
+        self._stopped.wait()
+        return iter(())
+
+IMAGES = {
+    "mysql": "mysql:8",
+    "mariadb": "mariadb:10",
+    "postgres": "postgres:15",
+    "influxdb": "influxdb:2",
+}
+
+def make_client(count, types, labels=None):
+    # count containers, their type cycles through types
+    containers = []
+    for i in range(count):
+        type = types[i % len(types)]
+        container_labels = {settings.LABEL_PREFIX + "enable": "true"}
+        for key, value in (labels or {}).items():
+            container_labels[settings.LABEL_PREFIX + key] = value
+        containers.append(Container(i + 1, "{}{}".format(type, i), IMAGES[type], container_labels))
+    return Client(containers)
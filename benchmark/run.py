@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# Offline benchmark of the backup path. Runs complete backup cycles of
+# main.py against a fake Docker client and stub dump tools, measures the
+# pipeline stages on their own and times the clean up of a large dump
+# directory. The results are written as JSON, so runs of different releases
+# can be compared.
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pyAesCrypt
+
+from src import settings
+from src import docker
+from src import pipeline
+from src import compression
+from src import encryption
+import main as pyd2b2
+
+import fakes
+import stub
+
+MB = 1000 * 1000
+STAGES = ["cycle", "compression", "encryption", "cleanup"]
+
+def mb_per_second(size, seconds):
+    return round(size / MB / seconds, 2) if seconds > 0 else None
+
+def version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def install_tools(bin_dir):
+    # Wrappers tell the stub which tool it stands in for
+    os.makedirs(bin_dir, exist_ok=True)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub.py")
+    for tool in ("mysqldump", "pg_dumpall", "influx"):
+        with open(os.path.join(bin_dir, tool), "w") as f:
+            f.write("#!/bin/sh\nBENCHMARK_TOOL={} exec \"{}\" \"{}\" \"$@\"\n".format(tool, sys.executable, script))
+        os.chmod(os.path.join(bin_dir, tool), 0o755)
+
+class NullSink:
+    def write(self, data):
+        return len(data)
+
+def drain(reader):
+    size = 0
+    while True:
+        data = reader.read(pipeline.BUFFER_SIZE)
+        if not data:
+            return size
+        size += len(data)
+
+def bench_cycle(args, work_dir, codec):
+    # One complete run of main.py in one-time mode
+    dump_dir = tempfile.mkdtemp(prefix="cycle-", dir=work_dir)
+    labels = {"compress": codec, "encryption_passphrase": args.passphrase}
+    client = fakes.make_client(args.containers, args.types, labels)
+    os.environ.update({
+        "DUMP_DIR": dump_dir,
+        "SCHEDULE": "",
+        "MAX_PARALLEL": str(args.parallel),
+        "METRICS_PORT": "0",
+        "METRICS_FILE": ".metrics.jsonl",
+    })
+
+    get_client, get_own_container_id = docker.get_client, docker.get_own_container_id
+    docker.get_client = lambda *_args, **_kwargs: client
+    docker.get_own_container_id = lambda: "benchmark"
+    started = time.monotonic()
+    try:
+        pyd2b2.main()
+    except SystemExit:
+        pass
+    finally:
+        docker.get_client, docker.get_own_container_id = get_client, get_own_container_id
+    seconds = time.monotonic() - started
+
+    with open(os.path.join(dump_dir, ".metrics.jsonl")) as f:
+        record = json.loads(f.readlines()[-1])
+    shutil.rmtree(dump_dir)
+
+    # Phases run on several workers at once, so their MB/s is the data of
+    # all backups divided by the time all backups spent in the phase
+    phases = {}
+    for backup in record["backups"]:
+        for phase, phase_seconds in backup["phases"].items():
+            phases[phase] = phases.get(phase, 0.0) + phase_seconds
+    return {
+        "codec": codec,
+        "encrypted": args.passphrase != "",
+        "containers": record["containers"],
+        "successful": record["successful"],
+        "seconds": round(seconds, 3),
+        "bytes_in": record["bytes_in"],
+        "bytes_out": record["bytes_out"],
+        "mb_per_second": mb_per_second(record["bytes_in"], seconds),
+        "phases": {phase: {"seconds": round(phase_seconds, 3), "mb_per_second": mb_per_second(record["bytes_in"], phase_seconds)}
+                   for phase, phase_seconds in phases.items()},
+        "docker_calls": client.calls,
+        "backups": record["backups"],
+    }
+
+def bench_compression(args, blocks, size):
+    results = []
+    threads = os.cpu_count() or 1
+    for name in args.codecs:
+        for codec_threads in sorted({1, threads}):
+            if name == "none" and codec_threads > 1:
+                continue
+            codec = compression.get(name, threads=codec_threads)
+            started = time.monotonic()
+            compressed = drain(codec.reader(pipeline.Reader(pipeline.IterSource(blocks))))
+            seconds = time.monotonic() - started
+            results.append({
+                "codec": name,
+                "level": codec.level,
+                "threads": codec.threads,
+                "seconds": round(seconds, 3),
+                "mb_per_second": mb_per_second(size, seconds),
+                "ratio": round(size / compressed, 3) if compressed else None,
+            })
+    return results
+
+def bench_encryption(args, blocks, size):
+    # The chunked AES-GCM stream the backups are written with, by thread
+    # count. The key is derived once beforehand, like in the service.
+    results = []
+    encryption.new_cipher("benchmark")
+    for threads in args.encryption_threads:
+        started = time.monotonic()
+        encrypted = drain(pipeline.EncryptReader(pipeline.Reader(pipeline.IterSource(blocks)), "benchmark", threads))
+        seconds = time.monotonic() - started
+        results.append({"format": "aes-gcm", "threads": threads, "seconds": round(seconds, 3),
+                        "mb_per_second": mb_per_second(size, seconds), "overhead": encrypted - size})
+
+    # pyAesCrypt wrote the .aes files of older versions, it is the baseline
+    if args.legacy_buffer:
+        started = time.monotonic()
+        pyAesCrypt.encryptStream(pipeline.Reader(pipeline.IterSource(blocks)), NullSink(), "benchmark", args.legacy_buffer)
+        seconds = time.monotonic() - started
+        results.append({"format": "pyaescrypt", "buffer_size": args.legacy_buffer, "seconds": round(seconds, 3),
+                        "mb_per_second": mb_per_second(size, seconds)})
+    return results
+
+def bench_cleanup(args, work_dir):
+    # Hourly backups of several containers, going back far enough that
+    # about half of them are expired
+    dump_dir = tempfile.mkdtemp(prefix="cleanup-", dir=work_dir)
+    now = datetime.datetime.now().replace(microsecond=0)
+    per_container = max(1, args.cleanup_files // args.cleanup_containers)
+    for container in range(args.cleanup_containers):
+        for i in range(per_container):
+            created = now - datetime.timedelta(hours=i)
+            with open(os.path.join(dump_dir, "db{}_{}.sql.gz".format(container, created.strftime("%Y%m%dT%H%M%S"))), "wb") as f:
+                f.write(b"\0")
+    files = per_container * args.cleanup_containers
+
+    os.environ.update({
+        "DUMP_DIR": dump_dir,
+        "DELETE_DAYS": str(max(1, per_container // 48)),
+        "KEEP_MIN": "20",
+    })
+    config, _ = settings.read()
+
+    started = time.monotonic()
+    pyd2b2.cleanup(config)
+    first = time.monotonic() - started
+
+    started = time.monotonic()
+    pyd2b2.cleanup(config)
+    second = time.monotonic() - started
+
+    remaining = len([name for name in os.listdir(dump_dir) if not name.startswith(".")])
+    shutil.rmtree(dump_dir)
+    return {
+        "files": files,
+        "containers": args.cleanup_containers,
+        "deleted": files - remaining,
+        "first_seconds": round(first, 3),
+        "second_seconds": round(second, 3),
+        "files_per_second": round(files / first, 1) if first > 0 else None,
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the pyd2b2 backup path")
+    parser.add_argument("--size", type=int, default=64, help="size of every synthetic dump in MiB (default: 64)")
+    parser.add_argument("--entropy", type=float, default=0.3, help="share of random bytes in the dumps, 0-1 (default: 0.3)")
+    parser.add_argument("--containers", type=int, default=4, help="number of fake containers per cycle (default: 4)")
+    parser.add_argument("--types", default="mysql,postgres,influxdb", help="database types of the fake containers")
+    parser.add_argument("--codecs", default="gzip,zstd,none", help="codecs to benchmark")
+    parser.add_argument("--parallel", type=int, default=2, help="MAX_PARALLEL of the cycles (default: 2)")
+    parser.add_argument("--passphrase", default="", help="encrypt the cycle backups with this passphrase")
+    parser.add_argument("--encryption-threads", default="1,2,4,{}".format(os.cpu_count() or 1), help="thread counts of the encryption to benchmark")
+    parser.add_argument("--legacy-buffer", type=int, default=65536, help="pyAesCrypt buffer size of the legacy baseline, 0 to skip it (default: 65536)")
+    parser.add_argument("--cleanup-files", type=int, default=20000, help="number of dumps in the clean up benchmark (default: 20000)")
+    parser.add_argument("--cleanup-containers", type=int, default=20, help="number of containers in the clean up benchmark (default: 20)")
+    parser.add_argument("--skip", default="", help="comma separated stages to skip: " + ", ".join(STAGES))
+    parser.add_argument("--output", default="benchmark-results.json", help="result file (default: benchmark-results.json)")
+    parser.add_argument("--verbose", action="store_true", help="show the log of the backup cycles")
+    args = parser.parse_args()
+
+    args.types = [x.strip() for x in args.types.split(",") if x.strip()]
+    args.codecs = [x.strip() for x in args.codecs.split(",") if x.strip()]
+    args.encryption_threads = sorted({int(x) for x in args.encryption_threads.split(",") if x.strip()})
+    args.skip = [x.strip() for x in args.skip.split(",") if x.strip()]
+    for type in args.types:
+        if type not in fakes.IMAGES:
+            parser.error("unknown type {}".format(type))
+    for codec in args.codecs:
+        if codec not in compression.CODECS:
+            parser.error("unknown codec {}".format(codec))
+    if any(threads < 1 for threads in args.encryption_threads):
+        parser.error("encryption thread counts must be at least 1")
+    if args.legacy_buffer < 0 or args.legacy_buffer % 16:
+        parser.error("the legacy buffer size must be a multiple of 16")
+    if not 0 <= args.entropy <= 1:
+        parser.error("entropy must be between 0 and 1")
+    return args
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    size = args.size * 1024 * 1024
+    work_dir = tempfile.mkdtemp(prefix="pyd2b2-benchmark-")
+    bin_dir = os.path.join(work_dir, "bin")
+    install_tools(bin_dir)
+    os.environ.update({
+        "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+        "BENCHMARK_SIZE": str(size),
+        "BENCHMARK_ENTROPY": str(args.entropy),
+        "DUMP_UID": str(os.getuid()),
+        "DUMP_GID": str(os.getgid()),
+        "DEBUG": "false",
+        "HC_UUID": "",
+        "SUCCESS_URL": "",
+    })
+
+    results = {
+        "created": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "version": version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("passphrase", "output", "verbose")},
+    }
+    results["parameters"]["encrypted"] = args.passphrase != ""
+
+    try:
+        if "cycle" not in args.skip:
+            results["cycles"] = []
+            for codec in args.codecs:
+                result = bench_cycle(args, work_dir, codec)
+                results["cycles"].append(result)
+                print("cycle {:>5}: {:8.2f} s {:8.2f} MB/s ({}/{} successful)".format(
+                    codec, result["seconds"], result["mb_per_second"] or 0, result["successful"], result["containers"]))
+
+        if "compression" not in args.skip or "encryption" not in args.skip:
+            blocks = list(stub.synthetic_blocks(size, args.entropy))
+
+        if "compression" not in args.skip:
+            results["compression"] = bench_compression(args, blocks, size)
+            for result in results["compression"]:
+                print("compression {:>5} level {:>2}, {:>2} thread(s): {:8.2f} MB/s, ratio {}".format(
+                    result["codec"], result["level"], result["threads"], result["mb_per_second"] or 0, result["ratio"]))
+
+        if "encryption" not in args.skip:
+            results["encryption"] = bench_encryption(args, blocks, size)
+            for result in results["encryption"]:
+                if result["format"] == "aes-gcm":
+                    print("encryption aes-gcm, {:>2} thread(s): {:8.2f} MB/s".format(result["threads"], result["mb_per_second"] or 0))
+                else:
+                    print("encryption pyAesCrypt (legacy), buffer {}: {:8.2f} MB/s".format(result["buffer_size"], result["mb_per_second"] or 0))
+
+        if "cleanup" not in args.skip:
+            results["cleanup"] = bench_cleanup(args, work_dir)
+            print("cleanup {} files: {:.3f} s first run, {:.3f} s second run".format(
+                results["cleanup"]["files"], results["cleanup"]["first_seconds"], results["cleanup"]["second_seconds"]))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to {}".format(args.output))
+
+if __name__ == "__main__":
+    main()
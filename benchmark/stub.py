@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Stands in for mysqldump, pg_dumpall and influx. The tool is picked by
+# BENCHMARK_TOOL or the name the script is called with. Every dump is
+# BENCHMARK_SIZE bytes of synthetic data with BENCHMARK_ENTROPY (0-1)
+# random content.
+import os
+import sys
+import json
+
+BLOCK_SIZE = 1024 * 1024
+SHARDS = 4
+FILLER = b"INSERT INTO `benchmark` VALUES (1,'lorem ipsum dolor sit amet','2022-01-01 00:00:00',NULL);\n"
+
+def synthetic_blocks(size, entropy):
+    # Every block is a random part followed by repeated SQL, so the entropy
+    # decides how well the dump compresses
+    filler = (FILLER * (BLOCK_SIZE // len(FILLER) + 1))[:BLOCK_SIZE]
+    while size > 0:
+        length = min(size, BLOCK_SIZE)
+        random_length = int(length * entropy)
+        yield os.urandom(random_length) + filler[:length - random_length]
+        size -= length
+
+def _settings():
+    return int(os.getenv("BENCHMARK_SIZE", str(64 * 1024 * 1024))), float(os.getenv("BENCHMARK_ENTROPY", "0.3"))
+
+def main(argv):
+    tool = os.getenv("BENCHMARK_TOOL", os.path.basename(argv[0]))
+    size, entropy = _settings()
+
+    if tool == "influx" and argv[1:3] == ["bucket", "list"]:
+        # influx bucket list ... --json
+        buckets = int(os.getenv("BENCHMARK_BUCKETS", "4"))
+        print(json.dumps([{"name": "bucket{}".format(i)} for i in range(buckets)]))
+        return 0
+
+    if tool == "influx":
+        # influx backup --host ... --token ... [--bucket <name>] <directory>/
+        # writes the data of a bucket as several shard files
+        buckets = int(os.getenv("BENCHMARK_BUCKETS", "4"))
+        shards = SHARDS if "--bucket" in argv else SHARDS * buckets
+        directory = argv[-1]
+        os.makedirs(directory, exist_ok=True)
+        shard_size = size // buckets // SHARDS
+        for shard in range(shards):
+            with open(os.path.join(directory, "{}.tar.gz".format(shard + 1)), "wb") as f:
+                for block in synthetic_blocks(shard_size, entropy):
+                    f.write(block)
+        return 0
+
+    output = sys.stdout.buffer
+    for block in synthetic_blocks(size, entropy):
+        output.write(block)
+    output.flush()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,372 +1,761 @@
-import re 
-import subprocess
+import argparse
 import os
 import datetime
-import time
 import sys
-import humanize
-import ftplib
-import pyAesCrypt
-import requests
 import logging
-import math
-import natsort
+import humanize
 import shutil
-from pprint import pprint
+import tempfile
+import threading
+import signal
+import subprocess
+import time
 from croniter import croniter
-from os import path
+from concurrent.futures import ThreadPoolExecutor
+from pprint import pprint
 
 from src import settings
 from src import docker
-from src.database import Database, DatabaseType
-
-
+from src import pipeline
+from src import store
+from src import catalog
+from src import scheduler
+from src import inventory
+from src import metrics
+from src import encryption
+from src import upload
+from src import throttle
+from src import verify
+from src import restore
+from src import history
+from src import dispatcher
+from src import recompact
+from src import logstream
+from src import notify
+from src.database import Database
+from src.backup import backup_container, target_alias
+
+
+
+cleanup_lock = threading.Lock()
+
+class Cycle:
+    # All backups of one schedule tick. They are reported to Healthchecks.io
+    # and SUCCESS_URL together as one backup cycle.
+
+    def __init__(self, config, members, uploader=None, on_done=None):
+        self.config = config
+        self.uploader = uploader
+        self.on_done = on_done
+        self.members = set(members)
+        self.started = False
+        self.processed = 0
+        self.finished = 0
+        self.successful = 0
+        self.backups = []
+        self.started_at = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, key):
+        # Returns the position of the backup in the cycle
+        with self._lock:
+            self.members.add(key)
+            if not self.started:
+                self.started = True
+                self.started_at = time.time()
+                logging.info(f"Starting backup cycle with {len(self.members)} container(s)...")
+                report_start(self.config)
+            self.processed += 1
+            return self.processed
+
+    def finish(self, key, success, record=None):
+        with self._lock:
+            if key not in self.members:
+                return
+            self.finished += 1
+            if success:
+                self.successful += 1
+            if record is not None:
+                self.backups.append(record)
+            complete = self.finished == len(self.members)
+
+        if complete:
+            started = time.monotonic()
+            with cleanup_lock:
+                # Clean up old backups
+                cleanup(self.config, self.uploader)
+            self.report_metrics(time.monotonic() - started)
+            report_finish(self.config, self.successful, len(self.members))
+            self.done.set()
+            if self.on_done is not None:
+                self.on_done()
+
+    def report_metrics(self, cleanup_seconds=0.0):
+        record = metrics.cycle_record(self.started_at or time.time(), self.backups, cleanup_seconds)
+        metrics.registry.observe_cycle(record)
+        if self.config.metrics_file:
+            metrics.write_record(self.config.metrics_file, record)
+
+    def skip(self, key):
+        # The container is gone before its backup started
+        with self._lock:
+            self.members.discard(key)
+            complete = self.started and self.finished == len(self.members)
+        if complete:
+            self.report_metrics()
+            report_finish(self.config, self.successful, len(self.members))
+            self.done.set()
+            if self.on_done is not None:
+                self.on_done()
+
+def report_start(config):
+    if config.hc_uuid != "":
+        check = config.hc_ping_url + config.hc_uuid
+        notify.get().send("GET", check + "/start", description="start of the time measuring to Healthchecks.io", check=check)
+
+def report_finish(config, successful_containers, total_containers):
+    all_backups_successfull = (successful_containers == total_containers)
+    msg = f"Finished backup cycle. {successful_containers}/{total_containers} successful."
+
+    # Send request on success
+    if config.success_url != "" and all_backups_successfull:
+        notify.get().send("GET", config.success_url, description="request to success url")
+
+    if config.hc_uuid != "":
+        check = config.hc_ping_url + config.hc_uuid
+        hcurl = check + ("/fail" if not all_backups_successfull else "")
+        notify.get().send("PUT", hcurl, msg, description="ping to Healthchecks.io", check=check)
+
+    logging.info(msg)
+
+def report_container_start(config, database):
+    # Containers with a check of their own get it pinged for every backup
+    if database.hc_uuid != "":
+        check = config.hc_ping_url + database.hc_uuid
+        notify.get().send("GET", check + "/start", description="start of the container time measuring to Healthchecks.io", check=check)
+
+def report_container_finish(config, database, record, success):
+    if database.hc_uuid != "":
+        if success:
+            msg = "Backup of {} finished in {}".format(record.container, humanize.naturaldelta(datetime.timedelta(seconds=record.duration)))
+            if record.path is not None:
+                msg += ": {} ({})".format(os.path.basename(record.path), humanize.naturalsize(record.bytes_out))
+        else:
+            msg = f"Backup of {record.container} failed"
+        check = config.hc_ping_url + database.hc_uuid
+        notify.get().send("PUT", check + ("" if success else "/fail"), msg, description="container ping to Healthchecks.io", check=check)
+
+def report_verify(config, failed, total, msg):
+    # Failures fail the check, a clean run is only logged, so it doesn't
+    # stand in for a backup cycle
+    if config.hc_uuid != "":
+        check = config.hc_ping_url + config.hc_uuid
+        hcurl = check + ("/fail" if failed > 0 else "/log")
+        notify.get().send("PUT", hcurl, msg, description="verification result to Healthchecks.io", check=check)
+
+def predict_cycle(config, backup_history, names, schedule=None, tick=None):
+    # Logs when the cycle is expected to end and warns if that is after the
+    # next run of its schedule
+    seconds, unknown = backup_history.predict(names, config.max_parallel)
+    metrics.registry.observe_prediction(seconds)
+    end = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+    logging.info("Backup cycle of {} container(s) is expected to take {} (until {}){}".format(
+        len(names), humanize.naturaldelta(seconds), end.strftime("%H:%M:%S"),
+        f", {unknown} without history" if unknown else ""))
+    if schedule and tick is not None:
+        next_tick = croniter(schedule, tick).get_next(datetime.datetime)
+        if end > next_tick:
+            logging.warning(f"Backup cycle is expected to end at {end.replace(microsecond=0)}, after the next run at {next_tick} (schedule '{schedule}')")
 
 def main():
 
     # Load config
     config, global_labels = settings.read()
-    docker_client = docker.get_client()
 
     # Setup Logger
     logging.basicConfig(level=config.logginglevel,
                         format='%(asctime)s %(levelname)s: %(message)s')
 
-    
-
-    def nextRun(silent=False):
-        iter = croniter(config.schedule, datetime.datetime.now())
-        nextrun = iter.get_next(datetime.datetime)
-        if not silent:
-            logging.info(f"Next backup cycle will be at {nextrun}")
-        return nextrun
+    hosts = docker.get_hosts(config)
+    notify.configure(config)
 
     logging.info(f"+++ Welcome to pyd2b2! +++")
 
     if config.singlerun:
         logging.info("SCHEDULE value is empty, fallback to one-time backup")
     else:
-        if config.startup:
-            nextrun = datetime.datetime.now()
+        logging.info(f"Schedule is activated ({config.schedule}, jitter up to {config.schedule_jitter} seconds)")
+
+    if len(hosts) > 1:
+        logging.info("Backup containers on {} Docker hosts: {}".format(len(hosts), ", ".join(str(host) for host in hosts)))
+
+    # clean up old networks, remote hosts don't use the helper network
+    for docker_client in [host.client for host in hosts if host.local]:
+        logging.debug("Clean up old networks...")
+        oldnetworks = docker_client.networks.list(names=config.helper_network_name,greedy=True)
+        if len(oldnetworks):
+            for i, oldnetwork in enumerate(oldnetworks):
+                logging.debug(f"Remove network {i+1}/{len(oldnetworks)}: {oldnetwork.id}...")
+                for i, connected_container in enumerate(oldnetwork.containers):
+                    logging.debug(f"Remove network from container {i+1}/{len(oldnetwork.containers)}: {connected_container.name}...")
+                    docker_client.networks.get(oldnetwork.id).disconnect(connected_container.id,force=True)
+                docker_client.networks.get(oldnetwork.id).remove()
+            logging.debug("Clean up old networks done!")
         else:
-            nextrun = nextRun(True)
-        
-        logging.info(f"Schedule is activated. Next backup cycle will be at {nextrun}")
-
-    # clean up old networks
-    logging.debug("Clean up old networks...")
-    oldnetworks = docker_client.networks.list(names=config.helper_network_name,greedy=True)
-    if len(oldnetworks):
-        for i, oldnetwork in enumerate(oldnetworks):
-            logging.debug(f"Remove network {i+1}/{len(oldnetworks)}: {oldnetwork.id}...")
-            for i, connected_container in enumerate(oldnetwork.containers):
-                logging.debug(f"Remove network from container {i+1}/{len(oldnetwork.containers)}: {connected_container.name}...")
-                docker_client.networks.get(oldnetwork.id).disconnect(connected_container.id,force=True)
-            docker_client.networks.get(oldnetwork.id).remove()
-        logging.debug("Clean up old networks done!")
-    else:
-        logging.debug(f"Nothing to clean up")
-
-    while True:
-
-        if config.schedule:
-            diff = nextrun-datetime.datetime.now()
-            #logging.debug(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | {nextrun} | {diff.total_seconds()}")
-            if diff.total_seconds() >= 0:
-                time.sleep(5)
-                continue
-
-        containers = docker_client.containers.list(
-            filters = {
-                "label": settings.LABEL_PREFIX + "enable=true"
-            }
-        )
-
-        if len(containers):
-            logging.info(f"Starting backup cycle with {len(containers)} container(s)...")
-
-            if config.hc_uuid != "":
-                hcurl = config.hc_ping_url + config.hc_uuid + "/start"
-                logging.debug(f"Start time measuring to Healthchecks.io ({hcurl})...")
-                try:
-                    requests.get(hcurl, timeout=10)
-
-                except requests.RequestException as e:
-                    logging.error(f"Failed to start time measuring to Healthchecks.io. Error Output: {e}")
+            logging.debug(f"Nothing to clean up")
+
+    executor = ThreadPoolExecutor(max_workers=config.max_parallel)
+    # Backups wait for a slot on their host without taking a worker
+    host_slots = dispatcher.Dispatcher(executor, config.max_parallel_per_host or config.max_parallel)
+    running = set()
+    running_lock = threading.Lock()
+
+    container_filter = [x.strip() for x in config.container_filter.split(',') if x]
+    if len(container_filter) > 0:
+        logging.info(f"Container filter is active! Process only this names: {container_filter}")
+
+    throttle.configure(config)
+    if config.max_read_rate or config.max_write_rate:
+        logging.info("Limit all backups together to {} read and {} written per second".format(
+            humanize.naturalsize(config.max_read_rate, binary=True) if config.max_read_rate else "unlimited",
+            humanize.naturalsize(config.max_write_rate, binary=True) if config.max_write_rate else "unlimited"))
+
+    uploader = None
+    if config.upload_targets:
+        uploader = upload.Uploader(config)
+        logging.info("Upload backups to {}".format(", ".join(target.name for target in uploader.targets)))
+
+    backup_history = history.get(config.dump_dir)
+    for name in backup_history.containers():
+        metrics.registry.observe_summary(backup_history.summary(name))
+
+    backup_scheduler = scheduler.Scheduler(config.schedule_jitter, config.startup)
+    containers = inventory.Inventories(hosts, global_labels, container_filter, backup_scheduler.notify)
+
+    # Passphrases by backup name as of the last look at the inventory. Only
+    # the main loop replaces them, the recompaction thread just reads them.
+    passphrases = {}
+    default_passphrase = os.getenv("ENCRYPTION_PASSPHRASE") or global_labels["encryption_passphrase"]
+
+    def passphrase(backup_name):
+        # The label of the container if it still runs, else the global one
+        known = passphrases
+        return known[backup_name] if backup_name in known else default_passphrase
+
+    recompactor = None
+    if config.recompact_after:
+        recompactor = recompact.Recompactor(config, passphrase)
+        logging.info(f"Recompact backups older than {config.recompact_after} hour(s) with {config.recompact_codec} level {config.recompact_level} between backup cycles")
+    streamers = logstream.Streamers(config, target_alias)
+
+    def name(key, container):
+        # Containers of named hosts are backed up under the host name too
+        return containers.host(key).backup_name(container)
+
+    def process(cycle, host, container, database, record):
+        # Never raises, the cycle waits for the result of every container
+        success = False
+        try:
+            position = cycle.start(container.id)
+
+            logging.info("[{}/{}] Processing container {} {} ({}){}".format(
+                position,
+                len(cycle.members),
+                container.short_id,
+                container.name,
+                database.type.name,
+                f" on {host}" if len(hosts) > 1 else ""
+            ))
+
+            # Time spent waiting for a worker and a slot on the host
+            record.add("queue", time.time() - record.started)
+            report_container_start(config, database)
+            with record.phase("connect"):
+                network = host.network.open()
+            success = backup_container(config, network, container, database, record, record.container)
+        except Exception:
+            logging.exception(f"[{record.container}] Backup failed")
+        finally:
+            with running_lock:
+                running.discard(container.id)
+            record.finish(success)
+        return success
+
+    def submit(cycle, key, container, database):
+        # The same container never runs twice at the same time
+        with running_lock:
+            if container.id in running:
+                logging.warning(f"[{name(key, container)}] Previous backup is still running, skipping this run")
+                cycle.start(container.id)
+                cycle.finish(container.id, False)
+                return
+            running.add(container.id)
+        host = containers.host(key)
+        record = metrics.Backup(host.backup_name(container), database.type.name)
+        future = host_slots.submit(host, process, cycle, host, container, database, record)
+        # A backup that raised anyway counts as failed
+        future.add_done_callback(lambda f: finish(cycle, container, database, record, f.exception() is None and f.result()))
+
+    def finish(cycle, container, database, record, success):
+        # The backup only counts once it reached all upload targets
+        if success and uploader is not None and record.path is not None:
+            started = time.monotonic()
+            try:
+                uploaded = uploader.upload(record.path, f"[{record.container}]")
+            except Exception:
+                logging.exception(f"[{record.container}] Upload failed")
+                done(cycle, container, database, record, False)
+                return
+            # The targets upload at the same time, the phase is the wall time
+            # until the last one is done
+            uploaded.add_done_callback(lambda f: done(cycle, container, database, record, f.exception() is None and f.result(),
+                                                      time.monotonic() - started))
+        else:
+            done(cycle, container, database, record, success)
+
+    def done(cycle, container, database, record, success, upload_seconds=None):
+        # The record is complete only now, with the upload
+        try:
+            if upload_seconds is not None:
+                record.add("upload", upload_seconds)
+            record.success = success
+            metrics.registry.observe(record)
+            # Skipped and linked runs would pull the estimates to zero
+            if not record.skipped:
+                backup_history.add(record)
+                metrics.registry.observe_summary(backup_history.summary(record.container))
+        except Exception:
+            logging.exception(f"[{record.container}] Failed to record the backup run")
+        try:
+            report_container_finish(config, database, record, success)
+        finally:
+            cycle.finish(container.id, success, record)
+
+    if config.metrics_port:
+        metrics.serve(config.metrics_port)
+
+    # docker stop sends SIGTERM, exit cleanly so the helper network is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        containers.seed()
 
-            if path.isfile("/proc/1/cpuset"):
-                own_container_id = subprocess.check_output("basename $(cat /proc/1/cpuset)", shell=True, text=True).strip()
-            elif path.isfile("/proc/self/cgroup"):
-                own_container_id = subprocess.check_output("basename $(cat /proc/self/cgroup | head -n 1)", shell=True, text=True).strip()
+        if config.singlerun:
+            current = containers.containers()
+            passphrases = {name(key, container): database.encryption_passphrase for key, (container, database) in current.items()}
+            if any(database.continuous for _, database in current.values()):
+                logging.warning("Continuous backups need a SCHEDULE, only the full backups are taken")
+            if len(current):
+                cycle = Cycle(config, current.keys(), uploader)
+                keys = backup_history.longest_first(list(current), lambda key: name(key, current[key][0]))
+                predict_cycle(config, backup_history, [name(key, current[key][0]) for key in keys])
+                for key in keys:
+                    submit(cycle, key, *current[key])
+                cycle.done.wait()
             else:
-                own_container_id = subprocess.check_output("docker_api \"/containers/$(hostname)/json\" | jq -r '.Id')", shell=True, text=True).strip()
-                
-            successful_containers = 0
-
-            network = docker_client.networks.create(config.helper_network_name)
-            network.connect(own_container_id)
-
-            container_filter = [x.strip() for x in config.container_filter.split(',') if x]
-
-            if len(container_filter) > 0:
-                logging.info(f"Container filter is active! Process only this names: {container_filter}")
-                # Removes all containers from the list, which are not included in the filter
-                containers = [x for x in containers if x.name in container_filter]
-
-            for i, container in enumerate(containers):
-                database = Database(container, global_labels)
-
-                logging.info("[{}/{}] Processing container {} {} ({})".format(
-                    i + 1, 
-                    len(containers), 
-                    container.short_id,
-                    container.name,
-                    database.type.name
-                ))
-
-                if database.type == DatabaseType.influxdb:
-                    logging.debug("Login http://database-backup-target:{} using Token".format(database.port))
-                else:
-                    logging.debug("Login {}@database-backup-target:{} using Password: {}".format(database.username, database.port, "YES" if len(database.password) > 0 else "NO"))
-
-                if database.type == DatabaseType.unknown:
-                    logging.error("Cannot read database type. Please specify via label.")
-
-                network.connect(container, aliases = ["database-backup-target"])
-                outFile = "{}/{}_{}".format(config.dump_dir, container.name, time.strftime("%Y%m%dT%H%M%S"))
-                error_code = 0
-                error_text = ""
-                error_stdout = ""
-
-                logging.debug("Dumping all databases...")
-                
-                try:
-                    env = os.environ.copy()
-
-                    if database.type == DatabaseType.mysql or database.type == DatabaseType.mariadb:
-                        outFile = outFile + ".sql"
-                        subprocess.run(
-                            ("mysqldump --host=database-backup-target --port={} --user={} --password='{}'"
-                            " --all-databases"
-                            " --ignore-database=mysql"
-                            " --ignore-database=information_schema"
-                            " --ignore-database=performance_schema"
-                            " > {}").format(
-                                database.port,
-                                database.username, 
-                                database.password,
-                                outFile),
-                            shell=True,
-                            text=True,
-                            capture_output=True,
-                            env=env,
-                        ).check_returncode()
-                    elif database.type == DatabaseType.postgres:
-                        outFile = outFile + ".sql"
-                        env["PGPASSWORD"] = database.password
-                        subprocess.run(
-                            ("pg_dumpall --host=database-backup-target --port={} --username={}"
-                            " > {}").format(
-                                database.port,
-                                database.username, 
-                                outFile),
-                            shell=True,
-                            text=True,
-                            capture_output=True,
-                            env=env
-                        ).check_returncode()
-                    elif database.type == DatabaseType.influxdb:
-                        subprocess.run(
-                            ("influx backup --host http://database-backup-target:{} --token {} {}/").format(
-                                database.port,
-                                database.token,
-                                outFile
-                                ),
-                            shell=True,
-                            text=True,
-                            capture_output=True,
-                            env=env
-                        ).check_returncode()
-                except subprocess.CalledProcessError as e:
-                    error_code = e.returncode
-                    error_text = f"\n{e.stderr.strip()}".replace('\n', '\n> ').strip()
-                    error_stdout = f"\n{e.stdout.strip()}".replace('\n', '\n> ').strip()
-
-                network.disconnect(container)
-
-                if error_code > 0:
-                    logging.error(f"Return Code: {error_code}; Error Output:")
-                    logging.error(f"{error_text}")
-                    logging.debug(f"Standard Output:")
-                    logging.debug(f"{error_stdout}")
-                    
-                    if os.path.exists(outFile):
-                        if os.path.isdir(outFile):
-                            shutil.rmtree(outFile)
-                        else:
-                            os.remove(outFile)
-                else:
-                    if (os.path.exists(outFile)):
-                        noError = True
-                        if os.path.isdir(outFile):
-                            targetFile = outFile + ".tar.gz"
-                            uncompressed_size = 0
-                            for ele in os.scandir(outFile):
-                                uncompressed_size+=os.stat(ele).st_size
-                        else:
-                            targetFile = outFile + ".gz"
-                            uncompressed_size = os.path.getsize(outFile)
-                        if (database.compress or os.path.isdir(outFile)) and uncompressed_size > 0:
-                            logging.debug(f"Compressing {humanize.naturalsize(uncompressed_size)}...")
-                            if os.path.exists(targetFile):
-                                os.remove(targetFile)
-
-                            try:
-                                if os.path.isdir(outFile):
-                                    subprocess.check_output("cd {} && tar cvzf {} *".format(outFile, targetFile), shell=True)
-                                else:
-                                    subprocess.check_output("gzip {}".format(outFile), shell=True)
-                            except Exception as e:
-                                logging.error(f"Error Output: {e}")
-                                noError = False
-
-                            if noError and os.path.isdir(outFile):
-                                shutil.rmtree(outFile)
-
-                            outFile = targetFile
-                            
-                            compressed_size = os.path.getsize(outFile)
-                        else:
-                            database.compress = False
-
-                        
-                        if noError and database.encryption_passphrase != "":
-                            filesize = os.path.getsize(outFile)
-                            logging.debug(f"Encrypting {humanize.naturalsize(filesize)}...")
-
-                            bufferSize = 64 * 1024
-                            outFileEncrypted = outFile + ".aes"
-                        
-                            try:
-                                pyAesCrypt.encryptFile(outFile, outFileEncrypted, database.encryption_passphrase, bufferSize)
-                                
-                                os.remove(outFile)
-                                outFile = outFileEncrypted
-
-                                compressed_size = os.path.getsize(outFileEncrypted)
-
-                            except Exception as e:
-                                logging.error(f"Error Output: {e}")
-                                noError = False
-
-                        if noError:
-                            os.chown(outFile, config.dump_uid, config.dump_gid) # pylint: disable=maybe-no-member
-
-                            successful_containers += 1
-                            logging.info("SUCCESS. File: {} ({}{})".format(outFile, 
-                                                                        humanize.naturalsize(uncompressed_size), 
-                                                                        ", " + humanize.naturalsize(compressed_size) + " compressed" if database.compress else "")
-                                                                    )
-
-            network.disconnect(own_container_id)
-            network.remove()
-
-            # Clean up old backups
-            cleanup(config)
-
-            all_backups_successfull = (successful_containers == len(containers))
-            msg = f"Finished backup cycle. {successful_containers}/{len(containers)} successful."
-
-            # Send request on success
-            if config.success_url != "" and all_backups_successfull:
-                
-                logging.debug(f"Send request to success url ({config.success_url})...")
-                try:
-                    requests.get(config.success_url, timeout=10)
-                except requests.RequestException as e:
-                    logging.error(f"Send request to success url ({config.success_url}) failed. Error Output: {e}")
-            
-            if config.hc_uuid != "":
-                hcurl = config.hc_ping_url + config.hc_uuid + ("/fail" if not all_backups_successfull else "")
-                data = msg
-                logging.debug(f"Send ping to Healthchecks.io ({hcurl})...")
-                try:
-                    requests.put(hcurl, data=data, timeout=10)
+                logging.info("No databases to backup")
 
-                except requests.RequestException as e:
-                    logging.error(f"Sending a ping to Healthchecks.io failed. Error Output: {e}")
+            if recompactor is not None:
+                recompactor.start()
+                recompactor.join()
 
-            logging.info(msg)
-        else:
-            logging.info("No databases to backup")
-
-        if config.singlerun:
+            executor.shutdown()
+            if uploader is not None:
+                uploader.shutdown()
             logging.info("Program terminated")
             sys.exit()
-        elif config.schedule:
-            nextrun = nextRun()
 
-def cleanup(config):
+        containers.start()
+        cycles = {}
+
+        while True:
+            current = containers.containers()
+            passphrases = {name(key, container): database.encryption_passphrase for key, (container, database) in current.items()}
+            entries = {key: (name(key, container), database.schedule or config.schedule) for key, (container, database) in current.items()}
+            streamers.update({name(key, container): (containers.host(key), container, database)
+                              for key, (container, database) in current.items() if database.continuous})
+
+            for job in backup_scheduler.update(entries):
+                cycle = cycles.get((job.schedule, job.tick))
+                if cycle is not None:
+                    cycle.skip(job.key)
+
+            # Longest first, so the long backups don't start last
+            due = backup_history.longest_first(backup_scheduler.pop_due(), lambda item: item[0].name)
+            if due and recompactor is not None:
+                # Backups get the disks and CPUs to themselves
+                recompactor.stop()
+            for job, tick, members in due:
+                key = (job.schedule, tick)
+                if key not in cycles:
+                    overrun = any(schedule == job.schedule and cycle is not None and not cycle.done.is_set()
+                                  for (schedule, _), cycle in cycles.items())
+                    if overrun and config.overrun == "skip":
+                        logging.warning(f"Previous backup cycle (schedule '{job.schedule}') is still running, skipping the run of {tick}")
+                        cycles[key] = None
+                    else:
+                        if overrun:
+                            logging.warning(f"Previous backup cycle (schedule '{job.schedule}') is still running, the run of {tick} starts late")
+                        cycles[key] = Cycle(config, members, uploader, backup_scheduler.notify)
+                        predict_cycle(config, backup_history, [name(member, current[member][0]) for member in members if member in current], job.schedule, tick)
+                if cycles[key] is None:
+                    continue
+                submit(cycles[key], job.key, *current[job.key])
+
+            # Skipped runs are kept until all their containers were due
+            window = datetime.timedelta(seconds=config.schedule_jitter, minutes=1)
+            for key in [key for key, cycle in cycles.items()
+                        if (cycle is None and key[1] + window < datetime.datetime.now()) or (cycle is not None and cycle.done.is_set())]:
+                del cycles[key]
+
+            if recompactor is not None and not any(cycle is not None for cycle in cycles.values()):
+                recompactor.start()
+
+            # The inventory wakes the scheduler up when containers change, so
+            # it only has to wait for the next run
+            nextrun = backup_scheduler.next_run()
+            if nextrun is None:
+                timeout = None
+            else:
+                if due:
+                    logging.info(f"Next backup cycle will be at {nextrun}")
+                timeout = (nextrun - datetime.datetime.now()).total_seconds()
+            backup_scheduler.wait(timeout)
+    finally:
+        if recompactor is not None:
+            recompactor.stop()
+        streamers.stop()
+        containers.stop()
+        for host in hosts:
+            host.network.close()
+        # Pings still waiting are sent before the exit
+        notify.get().stop()
+
+def cleanup(config, uploader=None):
     logging.info("Clean up old backups (delete older than {} day{}, but keep at least {} file{})".format(
         config.delete_days,
         ("s" if config.delete_days > 1 else ""),
         config.keep_min,
         ("s" if config.keep_min > 1 else "")
     ))
-    files = [f for f in natsort.natsorted(os.listdir(config.dump_dir), reverse=True) if os.path.isfile(os.path.join(config.dump_dir, f))]
-    logging.debug(f"Found {len(files)} files")
-    filelist = {}
-    for f in files:
-        #logging.info(f"Parse filename {f}")
-        match = re.search('(.*)_(\d{4}\d{2}\d{2}T\d{2}\d{2}\d{2})', f)
-        filedate = datetime.datetime.strptime(match.group(2), '%Y%m%dT%H%M%S')
-        filedate_diff = datetime.datetime.now() - filedate
-        days = int(math.floor(filedate_diff.days))
-        #logging.info("DB: {} Date: {} Days: {}".format(match.group(1), filedate.strftime("%Y-%m-%d %H:%M:%S"), days))
-        if not match.group(1) in filelist:
-            filelist[match.group(1)] = []
-        filelist[match.group(1)].append({'filename': f, 'date': filedate.strftime("%Y-%m-%d %H:%M:%S"), 'days': days})
-    
-    #pprint(filelist)
-    count_container = 0
-    count_deleted = 0
-    count_dumps_total = 0
-    for name in filelist:
-        count_container += 1
-        
-        logging.debug(f"[{count_container:02d}/{len(filelist):02d}] Clean dumps from container {name}")
-
-        count_dumps = 0
-        for details in filelist[name]:
-            count_dumps_total += 1
-            count_dumps += 1
-
-            fullpath = os.path.join(config.dump_dir, details['filename'])
-
-            delete = False
-            if details['days'] >= config.delete_days and count_dumps > config.keep_min:
-                delete = True
-                count_deleted += 1
-                try:
-                    os.remove(fullpath)
-                except Exception:
-                    logging.exception(f"Failed to delete dump {fullpath}")
+    backup_catalog = catalog.get(config.dump_dir)
+    if backup_catalog.created:
+        # First run with a catalog, pick up the backups that already exist
+        added, removed = backup_catalog.reconcile()
+        logging.info(f"Created backup catalog with {added} existing dumps")
+        backup_catalog.created = False
 
+    count_dumps_total = backup_catalog.count()
+    expired = backup_catalog.expired(config.delete_days, config.keep_min)
+    logging.debug(f"Found {len(expired)} expired dumps")
 
+    count_deleted = 0
+    for name in expired:
+        fullpath = os.path.join(config.dump_dir, name)
+        try:
+            if os.path.isdir(fullpath):
+                shutil.rmtree(fullpath)
+            elif os.path.exists(fullpath):
+                os.remove(fullpath)
+            if os.path.exists(fullpath + pipeline.CHECKSUM_EXTENSION):
+                os.remove(fullpath + pipeline.CHECKSUM_EXTENSION)
+            backup_catalog.remove(name)
+            count_deleted += 1
+        except Exception:
+            logging.exception(f"Failed to delete dump {fullpath}")
 
-            # logging.debug("[{:03d}/{:03d}] {} = {:03d} days ({}) -> Delete: {}".format(
-            #     count_dumps,
-            #     len(filelist[name]),
-            #     details['date'],
-            #     details['days'],
-            #     fullpath,
-            #     delete)
-            # )
     logging.info(f"Deleted {count_deleted} of {count_dumps_total} dumps")
 
+    # Log segments go with the oldest backup they continue
+    expired_segments = backup_catalog.expired_segments(config.delete_days)
+    for name in expired_segments:
+        fullpath = os.path.join(config.dump_dir, name)
+        try:
+            for path in (fullpath, fullpath + pipeline.CHECKSUM_EXTENSION):
+                if os.path.exists(path):
+                    os.remove(path)
+            backup_catalog.remove_segment(name)
+        except Exception:
+            logging.exception(f"Failed to delete log segment {fullpath}")
+    if expired_segments:
+        logging.info(f"Deleted {len(expired_segments)} log segments older than the oldest backup")
+
+    if os.path.isdir(os.path.join(config.dump_dir, store.STORE_DIR)):
+        referenced, deleted, freed = store.get(config.dump_dir).collect_garbage(config.dump_dir)
+        logging.info(f"Deleted {deleted} unreferenced chunks ({humanize.naturalsize(freed)}), {referenced} chunks still in use")
+
+    if uploader is not None:
+        uploader.cleanup()
+
+
+
+
+
+def rebuild_catalog():
+    config, _ = settings.read()
+    logging.basicConfig(level=config.logginglevel,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    backup_catalog = catalog.get(config.dump_dir)
+    logging.info(f"Reconcile backup catalog {backup_catalog.path} with {config.dump_dir}...")
+    added, removed = backup_catalog.reconcile()
+    logging.info(f"Added {added} and removed {removed} entries. The catalog now holds {backup_catalog.count()} dumps")
+
+def decrypt(args):
+    # Decrypts a backup of either format to a file or stdout
+    _, global_labels = settings.read()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+    passphrase = args.passphrase or os.getenv("ENCRYPTION_PASSPHRASE") or global_labels["encryption_passphrase"]
+    if passphrase == "":
+        logging.error("No passphrase given. Use --passphrase or set ENCRYPTION_PASSPHRASE")
+        sys.exit(1)
+
+    output = open(args.output + pipeline.TEMP_SUFFIX, "wb") if args.output else sys.stdout.buffer
+    try:
+        with open(args.file, "rb") as f:
+            reader = pipeline.decrypt(f, passphrase, os.cpu_count() or 1)
+            while True:
+                data = reader.read(pipeline.BUFFER_SIZE)
+                if not data:
+                    break
+                output.write(data)
+    except encryption.DecryptionError as e:
+        logging.error(f"Failed to decrypt {args.file}: {e}")
+        if args.output:
+            output.close()
+            os.remove(args.output + pipeline.TEMP_SUFFIX)
+        sys.exit(1)
+
+    if args.output:
+        output.close()
+        os.replace(args.output + pipeline.TEMP_SUFFIX, args.output)
+        logging.info(f"Decrypted {args.file} to {args.output}")
+
+def parse_time(value):
+    return datetime.datetime.strptime(value, catalog.DATE_FORMAT)
+
+def show_logs(args):
+    # The archived binary log or WAL of a container and the backups it
+    # continues, or exports the segments that continue one of them
+    config, global_labels = settings.read()
+    logging.basicConfig(level=config.logginglevel,
+                        format='%(asctime)s %(levelname)s: %(message)s')
 
+    backup_catalog = catalog.get(config.dump_dir)
+    backups = backup_catalog.backups(args.container)
+    if args.export:
+        backup = next((backup for backup in backups if backup["name"] == args.backup), None) if args.backup else next(iter(backups), None)
+        if backup is None:
+            logging.error(f"No backup {args.backup} of {args.container}" if args.backup else f"No backups of {args.container}")
+            sys.exit(1)
+        passphrase = args.passphrase or os.getenv("ENCRYPTION_PASSPHRASE") or global_labels["encryption_passphrase"]
+        try:
+            segments = logstream.chain(backup_catalog, backup, args.until)
+            os.makedirs(args.export, exist_ok=True)
+            paths = logstream.export(config.dump_dir, segments, args.export, passphrase)
+        except (logstream.ChainError, encryption.DecryptionError, OSError) as e:
+            logging.error(f"Cannot export the log after {backup['name']}: {e}")
+            sys.exit(1)
+        logging.info(f"Exported {len(paths)} log segment(s) after {backup['name']} (position {backup['position']}) to {args.export}")
+        return
+
+    segments = backup_catalog.segments(args.container)
+    if not segments:
+        logging.info(f"{args.container}: no archived log segments")
+        return
+    logging.info("{}: {} log segment(s) ({}), {} to {}".format(
+        args.container, len(segments), humanize.naturalsize(sum(segment["size"] or 0 for segment in segments)),
+        segments[0]["segment"], segments[-1]["segment"]))
+    for backup in backups:
+        try:
+            chain = logstream.chain(backup_catalog, backup)
+            logging.info(f"{backup['name']}: continued by {len(chain)} segment(s) up to {chain[-1]['created']}")
+        except logstream.ChainError as e:
+            logging.info(f"{backup['name']}: no point-in-time restore, {e}")
+
+def show_history(args):
+    # Durations and sizes of the past backups and their trends
+    config, _ = settings.read()
+    logging.basicConfig(level=config.logginglevel,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    backup_history = history.get(config.dump_dir)
+    for name in args.containers or backup_history.containers():
+        summary = backup_history.summary(name)
+        if summary.last is None:
+            logging.info(f"{name}: no successful backups")
+            continue
+        details = ["last {:.1f}s and {}".format(summary.last["duration"], humanize.naturalsize(summary.last["bytes_in"] or 0)),
+                   "expected {:.1f}s".format(summary.expected)]
+        if summary.duration_trend is not None:
+            details.append("{:+.1f}s and {}{} per day".format(summary.duration_trend, "-" if summary.size_trend < 0 else "+",
+                                                             humanize.naturalsize(abs(summary.size_trend))))
+        logging.info("{}: {} run(s), {}".format(name, summary.runs, ", ".join(details)))
+
+def verify_backups(args):
+    # Checks the backups of the catalog, all of them or the given names or
+    # containers
+    config, global_labels = settings.read()
+    logging.basicConfig(level=config.logginglevel,
+                        format='%(asctime)s %(levelname)s: %(message)s')
 
+    passphrase = args.passphrase or os.getenv("ENCRYPTION_PASSPHRASE") or global_labels["encryption_passphrase"]
+    backup_catalog = catalog.get(config.dump_dir)
+    if backup_catalog.created:
+        backup_catalog.reconcile()
+
+    backups = backup_catalog.backups()
+    if args.backups:
+        backups = [backup for backup in backups if backup["name"] in args.backups or backup["container"] in args.backups]
+    if args.latest:
+        # Ordered by container and newest first
+        backups = [backup for i, backup in enumerate(backups) if i == 0 or backups[i - 1]["container"] != backup["container"]]
+
+    mode = "deep" if args.deep else "quick"
+    logging.info(f"Verify {len(backups)} backup(s) in {config.dump_dir} ({mode} check, {args.parallel} at once)...")
+    results = verify.verify(config.dump_dir, backups, args.deep, passphrase, args.parallel)
+
+    failed = [result for result in results if not result.ok]
+    unchecked = sum(1 for result in results if result.ok and result.unchecked > 0)
+    msg = f"Finished {mode} verification. {len(results) - len(failed)}/{len(results)} backups are intact"
+    if unchecked:
+        msg += f", {unchecked} of them have files without checksum"
+    msg += "."
+    if failed:
+        msg += "\n" + "\n".join("{}: {}".format(result.name, "; ".join(result.errors)) for result in failed)
+
+    notify.configure(config)
+    report_verify(config, len(failed), len(results), msg)
+    logging.info(msg)
+    notify.get().stop()
+    if failed:
+        sys.exit(1)
+
+def restore_backup(args):
+    # Streams a backup into the database of a container, by default the one
+    # it was taken from
+    config, global_labels = settings.read()
+    logging.basicConfig(level=config.logginglevel,
+                        format='%(asctime)s %(levelname)s: %(message)s')
 
+    path = args.backup if os.path.exists(args.backup) else os.path.join(config.dump_dir, args.backup)
+    path = path.rstrip("/")
+    match = catalog.BACKUP_NAME_REGEX.match(os.path.basename(path))
+    if not os.path.exists(path) or not match:
+        logging.error(f"{args.backup} is not a backup")
+        sys.exit(1)
+
+    # A network of its own, so a running backup service doesn't remove it
+    hosts = docker.get_hosts(config, config.helper_network_name + "-restore")
+    container_name = args.container or match.group(1)
+    try:
+        host, container = docker.find_container(hosts, container_name)
+        database = Database(container, global_labels)
+    except Exception as e:
+        logging.error(f"Cannot find database container {container_name}. Error Output: {e}")
+        sys.exit(1)
+
+    log_prefix = f"[{host.backup_name(container)}]"
+    passphrase = args.passphrase or database.encryption_passphrase or os.getenv("ENCRYPTION_PASSPHRASE", "")
+
+    # Point-in-time restore: the binary log archived after the backup is
+    # replayed up to --until
+    backup_catalog = catalog.get(config.dump_dir)
+    backup = next((backup for backup in backup_catalog.backups(match.group(1)) if backup["name"] == os.path.basename(path)), None)
+    segments = []
+    if args.until is not None:
+        if args.databases:
+            logging.error(f"{log_prefix} --until always restores all databases")
+            sys.exit(1)
+        try:
+            if backup is None:
+                raise logstream.ChainError(f"{os.path.basename(path)} is not in the catalog")
+            segments = logstream.chain(backup_catalog, backup, args.until)
+        except logstream.ChainError as e:
+            logging.error(f"{log_prefix} Cannot restore to {args.until}: {e}")
+            sys.exit(1)
+
+    helper_network = host.network
+    started = time.monotonic()
+    try:
+        network = helper_network.open()
+        address = target_alias(container)
+        if isinstance(network, docker.PublishedPorts):
+            address, database.port = network.target(container, database.port)
+        job = restore.Restore(address, database, passphrase, args.jobs, args.databases, log_prefix)
+        network.connect(container, aliases=[target_alias(container)])
+        try:
+            logging.info("{} Restore {}{}...".format(log_prefix, os.path.basename(path),
+                                                     " (databases: {})".format(", ".join(args.databases)) if args.databases else ""))
+            size = job.run(path)
+            if segments:
+                logging.info(f"{log_prefix} Replay {len(segments)} log segment(s) up to {args.until}...")
+                stage_dir = tempfile.mkdtemp(prefix=".restore-", dir=config.dump_dir)
+                try:
+                    size += job.replay(logstream.export(config.dump_dir, segments, stage_dir, passphrase), backup["position"], args.until)
+                finally:
+                    shutil.rmtree(stage_dir, ignore_errors=True)
+        finally:
+            network.disconnect(container)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"{log_prefix} Restore failed. Return Code: {e.returncode}; Error Output:")
+        logging.error(f"\n{e.stderr.strip()}".replace('\n', '\n> ').strip())
+        sys.exit(1)
+    except Exception as e:
+        logging.error(f"{log_prefix} Restore failed. Error Output: {e}")
+        sys.exit(1)
+    finally:
+        helper_network.close()
+
+    seconds = time.monotonic() - started
+    logging.info("{} Restored {} in {:.1f}s".format(log_prefix, humanize.naturalsize(size), seconds))
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Python Docker Database Backup")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("run", help="run the backup service (default)")
+    catalog_parser = commands.add_parser("catalog", help="maintain the backup catalog")
+    catalog_parser.add_argument("action", choices=["rebuild"], help="reconcile the catalog with the dump directory")
+    decrypt_parser = commands.add_parser("decrypt", help="decrypt an encrypted backup (.enc or .aes)")
+    decrypt_parser.add_argument("file", help="encrypted backup")
+    decrypt_parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    decrypt_parser.add_argument("-p", "--passphrase", help="passphrase (default: ENCRYPTION_PASSPHRASE or GLOBAL_ENCRYPTION_PASSPHRASE)")
+    verify_parser = commands.add_parser("verify", help="verify the checksums of backups, or decrypt and decompress them with --deep")
+    verify_parser.add_argument("backups", nargs="*", help="backup names or container names (default: all backups)")
+    verify_parser.add_argument("--deep", action="store_true", help="also decrypt and decompress the backups")
+    verify_parser.add_argument("--latest", action="store_true", help="only verify the newest backup of each container")
+    verify_parser.add_argument("-j", "--parallel", type=int, default=os.cpu_count() or 1, help="backups verified at the same time (default: number of CPU cores)")
+    verify_parser.add_argument("-p", "--passphrase", help="passphrase for --deep (default: ENCRYPTION_PASSPHRASE or GLOBAL_ENCRYPTION_PASSPHRASE)")
+    history_parser = commands.add_parser("history", help="show the durations and sizes of past backups and their trends")
+    history_parser.add_argument("containers", nargs="*", help="container names (default: all)")
+    restore_parser = commands.add_parser("restore", help="restore a backup into a database container")
+    restore_parser.add_argument("backup", help="backup name in DUMP_DIR or path")
+    restore_parser.add_argument("-c", "--container", help="target container (default: the container of the backup)")
+    restore_parser.add_argument("-d", "--database", dest="databases", action="append", default=[], help="only restore this database (InfluxDB: bucket), can be repeated")
+    restore_parser.add_argument("-j", "--jobs", type=int, help="connections used at the same time where the format allows it (default: jobs label)")
+    restore_parser.add_argument("-p", "--passphrase", help="passphrase of encrypted backups (default: encryption_passphrase label)")
+    restore_parser.add_argument("--until", type=parse_time, help="replay the archived binary log up to this time ('YYYY-MM-DD HH:MM:SS'), MySQL/MariaDB only")
+    logs_parser = commands.add_parser("logs", help="show or export the binary log or WAL archived by continuous backups")
+    logs_parser.add_argument("container", help="container name")
+    logs_parser.add_argument("--export", metavar="DIR", help="write the plain segments that continue a backup into DIR")
+    logs_parser.add_argument("--backup", help="backup the exported segments continue (default: the newest)")
+    logs_parser.add_argument("--until", type=parse_time, help="only export the segments up to this time ('YYYY-MM-DD HH:MM:SS')")
+    logs_parser.add_argument("-p", "--passphrase", help="passphrase of encrypted segments (default: ENCRYPTION_PASSPHRASE or GLOBAL_ENCRYPTION_PASSPHRASE)")
+    args = parser.parse_args()
+
+    if args.command == "catalog":
+        rebuild_catalog()
+    elif args.command == "decrypt":
+        decrypt(args)
+    elif args.command == "verify":
+        verify_backups(args)
+    elif args.command == "restore":
+        restore_backup(args)
+    elif args.command == "history":
+        show_history(args)
+    elif args.command == "logs":
+        show_logs(args)
+    else:
+        main()
@@ -0,0 +1,234 @@
+import subprocess
+import os
+import copy
+import time
+import datetime
+import logging
+import humanize
+
+from .database import DatabaseType
+from . import pipeline
+from . import compression
+from . import mysql_parallel
+from . import postgres_parallel
+from . import store
+from . import catalog
+from . import metrics
+from . import encryption
+from . import throttle
+from . import influx
+from . import changes
+from . import logstream
+from .docker import PublishedPorts, UnreachableError
+
+TARGET_ALIAS_PREFIX = "database-backup-target"
+
+def target_alias(container):
+    # Every container gets its own alias, so several of them can be attached
+    # to the helper network at the same time
+    return "{}-{}".format(TARGET_ALIAS_PREFIX, container.short_id)
+
+def backup_container(config, network, container, database, record=None, name=None):
+    # record collects the timings and sizes of the backup for the metrics.
+    # name is the name of the backups, by default the container name.
+    name = name or container.name
+    if record is None:
+        record = metrics.Backup(name, database.type.name)
+    host = target_alias(container)
+    log_prefix = f"[{name}]"
+
+    if isinstance(network, PublishedPorts):
+        try:
+            host, port = network.target(container, database.port)
+        except UnreachableError as e:
+            logging.error(f"{log_prefix} Error Output: {e}")
+            return False
+        database = copy.copy(database)
+        database.port = port
+
+    if database.type == DatabaseType.influxdb:
+        logging.debug("{} Login http://{}:{} using Token".format(log_prefix, host, database.port))
+    else:
+        logging.debug("{} Login {}@{}:{} using Password: {}".format(log_prefix, database.username, host, database.port, "YES" if len(database.password) > 0 else "NO"))
+
+    if database.type == DatabaseType.unknown:
+        logging.error(f"{log_prefix} Cannot read database type. Please specify via label.")
+
+    codec = throttle.limit_threads(database.codec, config.max_compress_threads)
+    if codec is not database.codec:
+        # The parallel engines take the codec from the database
+        database = copy.copy(database)
+        database.codec = codec
+    limits = throttle.get(database, log_prefix)
+
+    with record.phase("connect"):
+        network.connect(container, aliases = [host])
+    created = datetime.datetime.now().replace(microsecond=0)
+    outFile = "{}/{}_{}".format(config.dump_dir, name, created.strftime("%Y%m%dT%H%M%S"))
+    error_code = 0
+    error_text = ""
+    error_stdout = ""
+
+    logging.debug(f"{log_prefix} Dumping all databases (compression: {codec.name}, level {codec.level}, {codec.threads} thread(s))...")
+
+    timings = {}
+    backup_catalog = catalog.get(config.dump_dir)
+    state = None
+    previous = None
+    position = None
+    try:
+        env = os.environ.copy()
+        limits.start(host, database.port, database.type.name)
+
+        # The state is taken before the dump, so changes while it runs show
+        # up next time
+        if database.change_detection != "off":
+            with record.phase("detect"):
+                state = changes.state(host, database, codec, env, log_prefix)
+                previous = changes.unchanged(backup_catalog, name, state, database.max_skip_age, config.dump_dir)
+            if previous is not None and database.change_detection == "skip":
+                logging.info(f"{log_prefix} SUCCESS. Unchanged since {previous['dumped']}, kept {previous['name']}")
+                record.skipped = "skip"
+                return True
+
+        if previous is not None:
+            logging.debug(f"{log_prefix} Unchanged since {previous['dumped']}, linking {previous['name']}...")
+            record.skipped = "link"
+            with record.phase("link"):
+                outFile = changes.link(config.dump_dir, previous["name"], outFile)
+            uncompressed_size, compressed_size = previous["uncompressed_size"], 0
+            codec = compression.get(previous["codec"] or "none")
+            position = previous["position"]
+            command = None
+        elif database.engine == "parallel" and (database.type == DatabaseType.mysql or database.type == DatabaseType.mariadb):
+            with record.phase("dump"):
+                uncompressed_size, compressed_size = mysql_parallel.dump(host, database, outFile, log_prefix, limits)
+            if database.continuous:
+                position = logstream.manifest_position(outFile)
+            command = None
+        elif database.engine == "parallel" and database.type == DatabaseType.postgres and not database.continuous:
+            env["PGPASSWORD"] = database.password
+            with record.phase("dump"):
+                uncompressed_size, compressed_size = postgres_parallel.dump(host, database, outFile, env, log_prefix, limits)
+            command = None
+        elif database.type == DatabaseType.mysql or database.type == DatabaseType.mariadb:
+            command = ("mysqldump --host={} --port={} --user={} --password='{}'"
+                " --all-databases"
+                " --ignore-database=mysql"
+                " --ignore-database=information_schema"
+                " --ignore-database=performance_schema").format(
+                    host,
+                    database.port,
+                    database.username,
+                    database.password)
+            if database.continuous:
+                # The binary log continues the dump at the position it notes
+                command = logstream.DumpPosition(command + " --single-transaction --master-data=2", env, limits)
+            outFile = outFile + ".sql"
+        elif database.type == DatabaseType.postgres and database.continuous:
+            # The WAL can only be replayed on a copy of the data directory
+            env["PGPASSWORD"] = database.password
+            position = logstream.postgres_position(host, database, env)
+            command = "pg_basebackup --host={} --port={} --username={} --pgdata=- --format=tar --wal-method=fetch --checkpoint=fast".format(
+                host,
+                database.port,
+                database.username)
+            outFile = outFile + ".tar"
+        elif database.type == DatabaseType.postgres:
+            env["PGPASSWORD"] = database.password
+            command = "pg_dumpall --host={} --port={} --username={}".format(
+                host,
+                database.port,
+                database.username)
+            outFile = outFile + ".sql"
+        elif database.type == DatabaseType.influxdb:
+            # influx only writes backups to directories. The buckets are
+            # backed up at the same time and archived while they are written.
+            command = influx.backup(host, database, outFile + pipeline.TEMP_SUFFIX, env, log_prefix, limits)
+            outFile = outFile + ".tar"
+            # Directory backups have always been compressed
+            if codec.name == "none":
+                codec = compression.get("gzip", threads=codec.threads)
+        else:
+            return False
+
+        if command is not None and database.storage == "dedup":
+            # Compression and encryption happen per chunk inside the store
+            outFile = outFile + store.SNAPSHOT_EXTENSION
+            dedup_store = store.get(config.dump_dir)
+
+            def consume(source):
+                started = time.monotonic()
+                result = dedup_store.save(source, outFile, codec, database.encryption_passphrase, limits)
+                timings["dump"] = source.seconds
+                timings["store"] = time.monotonic() - started - source.seconds
+                return result
+
+            uncompressed_size, compressed_size = pipeline.stream(command, consume, env, limits)
+        elif command is not None:
+            outFile = outFile + codec.extension
+            if database.encryption_passphrase != "":
+                outFile = outFile + encryption.EXTENSION
+
+            uncompressed_size, compressed_size = pipeline.run(command, outFile, codec, database.encryption_passphrase, env, timings, limits)
+
+        if isinstance(command, logstream.DumpPosition):
+            position = command.position
+            if position is None:
+                logging.warning(f"{log_prefix} The dump has no binary log position, the binary log cannot continue it")
+    except subprocess.CalledProcessError as e:
+        error_code = e.returncode
+        error_text = f"\n{e.stderr.strip()}".replace('\n', '\n> ').strip()
+        error_stdout = f"\n{e.stdout.strip()}".replace('\n', '\n> ').strip()
+    except Exception as e:
+        logging.error(f"{log_prefix} Error Output: {e}")
+        return False
+    finally:
+        limits.stop()
+        record.add_all(timings)
+        with record.phase("disconnect"):
+            network.disconnect(container)
+
+    if error_code > 0:
+        logging.error(f"{log_prefix} Return Code: {error_code}; Error Output:")
+        logging.error(f"{error_text}")
+        logging.debug(f"{log_prefix} Standard Output:")
+        logging.debug(f"{error_stdout}")
+        return False
+
+    record.path = outFile
+    record.bytes_in = uncompressed_size
+    record.bytes_out = compressed_size
+    started = time.monotonic()
+
+    if os.path.isdir(outFile):
+        for root, dirs, files in os.walk(outFile):
+            for entry in dirs + files:
+                os.chown(os.path.join(root, entry), config.dump_uid, config.dump_gid) # pylint: disable=maybe-no-member
+    os.chown(outFile, config.dump_uid, config.dump_gid) # pylint: disable=maybe-no-member
+
+    backup_catalog.add(
+        os.path.basename(outFile),
+        name,
+        database.type.name,
+        created,
+        pipeline.disk_usage(outFile),
+        uncompressed_size,
+        codec.name,
+        database.encryption_passphrase != "",
+        pipeline.read_checksum(outFile),
+        state,
+        datetime.datetime.strptime(previous["dumped"], catalog.DATE_FORMAT) if previous is not None else None,
+        position)
+    record.add("finalize", time.monotonic() - started)
+
+    if previous is not None:
+        details = ", unchanged since " + previous["dumped"]
+    elif database.storage == "dedup":
+        details = ", " + humanize.naturalsize(compressed_size) + " new in store"
+    elif codec.name != "none":
+        details = ", " + humanize.naturalsize(compressed_size) + " compressed"
+    else:
+        details = ""
+    logging.info("{} SUCCESS. File: {} ({}{})".format(log_prefix, outFile, humanize.naturalsize(uncompressed_size), details))
+    return True
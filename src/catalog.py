@@ -0,0 +1,233 @@
+import os
+import re
+import json
+import sqlite3
+import datetime
+import logging
+import threading
+
+from . import pipeline
+from . import compression
+from . import store
+from . import encryption
+
+CATALOG_FILE = ".catalog.sqlite"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+BACKUP_NAME_REGEX = re.compile(r'^(.*)_(\d{{8}}T\d{{6}})(?:\.sql|\.tar)?({})?(\.aes|\.enc|\.snap)?$'.format(
+    "|".join(re.escape(extension) for extension in compression.EXTENSIONS)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    name TEXT PRIMARY KEY,
+    container TEXT NOT NULL,
+    type TEXT,
+    created TEXT NOT NULL,
+    size INTEGER,
+    uncompressed_size INTEGER,
+    codec TEXT,
+    encrypted INTEGER,
+    checksum TEXT,
+    state TEXT,
+    dumped TEXT,
+    recompacted INTEGER,
+    position TEXT
+);
+CREATE INDEX IF NOT EXISTS backups_container_created ON backups (container, created);
+CREATE TABLE IF NOT EXISTS segments (
+    name TEXT PRIMARY KEY,
+    container TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    created TEXT NOT NULL,
+    size INTEGER,
+    checksum TEXT
+);
+CREATE INDEX IF NOT EXISTS segments_container_segment ON segments (container, segment);
+"""
+
+# Added to catalogs of older versions
+COLUMNS = {
+    "state": "TEXT",
+    "dumped": "TEXT",
+    "recompacted": "INTEGER",
+    "position": "TEXT",
+}
+
+class Catalog:
+    # Index of all backups in the dump directory. Every backup is recorded
+    # when it is written, so the retention never has to scan the directory.
+
+    def __init__(self, dump_dir):
+        self.dump_dir = dump_dir
+        self.path = os.path.join(dump_dir, CATALOG_FILE)
+        self.created = not os.path.exists(self.path)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.executescript(SCHEMA)
+        existing = {row[1] for row in self._connection.execute("PRAGMA table_info(backups)")}
+        for column, type in COLUMNS.items():
+            if column not in existing:
+                self._connection.execute("ALTER TABLE backups ADD COLUMN {} {}".format(column, type))
+
+    def add(self, name, container, type, created, size, uncompressed_size=None, codec=None, encrypted=False, checksum=None, state=None, dumped=None, position=None):
+        # state is the change detection state of the database before the
+        # dump. dumped is when the content was dumped, if the backup reuses
+        # an older one. position is where the binary log or WAL continues
+        # the dump (see logstream).
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO backups (name, container, type, created, size, uncompressed_size, codec, encrypted, checksum, state, dumped, position)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, container, type, created.strftime(DATE_FORMAT), size, uncompressed_size, codec, 1 if encrypted else 0, checksum,
+                 state, (dumped or created).strftime(DATE_FORMAT), position))
+
+    def remove(self, name):
+        with self._lock:
+            self._connection.execute("DELETE FROM backups WHERE name = ?", (name,))
+
+    def count(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM backups").fetchone()[0]
+
+    def backups(self, container=None):
+        query = "SELECT name, container, type, created, size, uncompressed_size, codec, encrypted, checksum, state, dumped, position FROM backups"
+        args = ()
+        if container is not None:
+            query += " WHERE container = ?"
+            args = (container,)
+        with self._lock:
+            cursor = self._connection.execute(query + " ORDER BY container, created DESC", args)
+            columns = [d[0] for d in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def latest(self, container):
+        backups = self.backups(container)
+        return backups[0] if backups else None
+
+    def recompaction_candidates(self, before):
+        # Backups created before the datetime before that were not
+        # recompacted yet, the youngest first as they are kept the longest
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT name, container, codec, encrypted, dumped FROM backups WHERE NOT COALESCE(recompacted, 0) AND created <= ?"
+                " ORDER BY created DESC, name", (before.strftime(DATE_FORMAT),))
+            columns = [d[0] for d in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def recompacted(self, name, new_name=None, size=None, codec=None, checksum=None):
+        # Marks the backup as recompacted, with its new file if there is one
+        with self._lock:
+            if new_name is None:
+                self._connection.execute("UPDATE backups SET recompacted = 1 WHERE name = ?", (name,))
+            else:
+                self._connection.execute(
+                    "UPDATE backups SET name = ?, size = ?, codec = ?, encrypted = ?, checksum = ?, recompacted = 1 WHERE name = ?",
+                    (new_name, size, codec, 1 if new_name.endswith(encryption.EXTENSION) else 0, checksum, name))
+
+    def expired(self, delete_days, keep_min):
+        # Backups older than delete_days, but never the newest keep_min of a
+        # container
+        deadline = (datetime.datetime.now() - datetime.timedelta(days=delete_days)).strftime(DATE_FORMAT)
+        with self._lock:
+            return [row[0] for row in self._connection.execute(
+                "SELECT name FROM ("
+                " SELECT name, created, ROW_NUMBER() OVER (PARTITION BY container ORDER BY created DESC, name DESC) AS position FROM backups"
+                ") WHERE position > ? AND created <= ? ORDER BY name",
+                (keep_min, deadline)).fetchall()]
+
+    def add_segment(self, name, container, segment, created, size, checksum=None):
+        # name is the path of the archived file below the dump directory,
+        # segment the name of the binary log or WAL file. created is when it
+        # was archived, it holds nothing that happened later.
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO segments (name, container, segment, created, size, checksum) VALUES (?, ?, ?, ?, ?, ?)",
+                (name, container, segment, created.strftime(DATE_FORMAT), size, checksum))
+
+    def remove_segment(self, name):
+        with self._lock:
+            self._connection.execute("DELETE FROM segments WHERE name = ?", (name,))
+
+    def segments(self, container, since=None):
+        # In log order, only those archived at or after since
+        query = "SELECT name, container, segment, created, size, checksum FROM segments WHERE container = ?"
+        args = (container,)
+        if since is not None:
+            query += " AND created >= ?"
+            args += (since.strftime(DATE_FORMAT),)
+        with self._lock:
+            cursor = self._connection.execute(query + " ORDER BY segment", args)
+            columns = [d[0] for d in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def last_segment(self, container):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT segment FROM segments WHERE container = ? ORDER BY segment DESC LIMIT 1", (container,)).fetchone()
+        return row[0] if row else None
+
+    def expired_segments(self, delete_days):
+        # A segment is only of use with a dump before it. Segments archived
+        # before the content of the oldest backup of their container was
+        # dumped are expired, those of containers without backups after
+        # delete_days.
+        deadline = (datetime.datetime.now() - datetime.timedelta(days=delete_days)).strftime(DATE_FORMAT)
+        with self._lock:
+            return [row[0] for row in self._connection.execute(
+                "SELECT name FROM segments WHERE created < COALESCE("
+                " (SELECT MIN(COALESCE(dumped, created)) FROM backups WHERE backups.container = segments.container), ?)"
+                " ORDER BY name",
+                (deadline,)).fetchall()]
+
+    def reconcile(self):
+        # Brings the catalog in line with the dump directory: adds backups
+        # that are missing (e.g. written by an older version) and removes
+        # entries whose backup is gone
+        known = {backup["name"] for backup in self.backups()}
+        found = set()
+        added = 0
+
+        for name in os.listdir(self.dump_dir):
+            if name.endswith(pipeline.TEMP_SUFFIX):
+                continue
+            match = BACKUP_NAME_REGEX.match(name)
+            if not match:
+                continue
+            found.add(name)
+            if name in known:
+                continue
+
+            path = os.path.join(self.dump_dir, name)
+            codec = compression.from_extension(match.group(3)).name
+            encrypted = match.group(4) in (encryption.EXTENSION, encryption.LEGACY_EXTENSION)
+            uncompressed_size = None
+            manifest_file = path if match.group(4) == store.SNAPSHOT_EXTENSION else os.path.join(path, "manifest.json")
+            if os.path.isfile(manifest_file):
+                try:
+                    with open(manifest_file) as f:
+                        manifest = json.load(f)
+                    codec = manifest.get("compression", codec)
+                    encrypted = manifest.get("encrypted", encrypted)
+                    uncompressed_size = manifest.get("size")
+                except (OSError, ValueError):
+                    logging.warning(f"Cannot read manifest of {name}")
+
+            self.add(name, match.group(1), None, datetime.datetime.strptime(match.group(2), '%Y%m%dT%H%M%S'),
+                     pipeline.disk_usage(path), uncompressed_size, codec, encrypted, pipeline.read_checksum(path))
+            added += 1
+
+        removed = 0
+        for name in known - found:
+            self.remove(name)
+            removed += 1
+
+        return added, removed
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def get(dump_dir):
+    with _catalogs_lock:
+        if dump_dir not in _catalogs:
+            _catalogs[dump_dir] = Catalog(dump_dir)
+        return _catalogs[dump_dir]
@@ -0,0 +1,141 @@
+import os
+import re
+import shutil
+import hashlib
+import logging
+import datetime
+import subprocess
+import requests
+import pymysql
+
+from .database import DatabaseType
+from . import pipeline
+from . import catalog
+from . import mysql_parallel
+
+# Server counters that only move when data or schema change. They are used
+# when MySQL/MariaDB runs without a binary log.
+MYSQL_COUNTERS = ("Innodb_rows_inserted", "Innodb_rows_updated", "Innodb_rows_deleted",
+                  "Com_create_table", "Com_alter_table", "Com_drop_table", "Com_rename_table",
+                  "Com_create_db", "Com_drop_db", "Com_create_view", "Com_drop_view",
+                  "Com_create_user", "Com_drop_user", "Com_grant", "Com_revoke", "Com_truncate")
+
+# Sizes of the shards and their write ahead logs, they change with every
+# write (and with compactions, which only costs a dump too many)
+INFLUX_METRICS_REGEX = re.compile(r"^(?:storage_shard_disk_size|storage_wal_size)\{.*$", re.MULTILINE)
+INFLUX_TIMEOUT = 10
+
+def _mysql_state(host, database):
+    connection = mysql_parallel.connect(host, database)
+    try:
+        with connection.cursor() as cursor:
+            position = mysql_parallel.binlog_position(cursor)
+            if position is not None:
+                return "binlog " + " ".join("{}={}".format(key, value) for key, value in sorted(position.items()))
+            # Counters start at 0 with the server, its start is part of the state
+            cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN ({})".format(", ".join(["%s"] * (len(MYSQL_COUNTERS) + 1))),
+                           MYSQL_COUNTERS + ("Uptime",))
+            status = dict(cursor.fetchall())
+            cursor.execute("SELECT UNIX_TIMESTAMP()")
+            started = int(cursor.fetchone()[0]) - int(status.pop("Uptime"))
+            # The clock and the uptime tick apart, round the start a little
+            return "counters started={} ".format(started // 10) + " ".join("{}={}".format(key, status[key]) for key in sorted(status))
+    finally:
+        connection.close()
+
+def _postgres_state(host, database, env):
+    # The position in the WAL, any write moves it. Replicas report the
+    # position they have replayed.
+    env = dict(env, PGPASSWORD=database.password)
+    output = subprocess.run(
+        ("psql --host={} --port={} --username={} --dbname=template1 --no-align --tuples-only --command="
+         "\"SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END\"").format(
+            host, database.port, database.username),
+        shell=True,
+        text=True,
+        capture_output=True,
+        env=env,
+    )
+    output.check_returncode()
+    return "lsn " + output.stdout.strip()
+
+def _influx_state(host, database):
+    response = requests.get("http://{}:{}/metrics".format(host, database.port),
+                            headers={"Authorization": "Token {}".format(database.token)}, timeout=INFLUX_TIMEOUT)
+    response.raise_for_status()
+    shards = sorted(INFLUX_METRICS_REGEX.findall(response.text))
+    if not shards:
+        return None
+    return "shards " + "\n".join(shards)
+
+def state(host, database, codec, env, log_prefix=""):
+    # A fingerprint of the content of the database and of the settings that
+    # change the backup. None if it cannot be determined, then the database
+    # is dumped.
+    try:
+        if database.type in (DatabaseType.mysql, DatabaseType.mariadb):
+            value = _mysql_state(host, database)
+        elif database.type == DatabaseType.postgres:
+            value = _postgres_state(host, database, env)
+        elif database.type == DatabaseType.influxdb:
+            value = _influx_state(host, database)
+        else:
+            value = None
+    except (pymysql.MySQLError, subprocess.CalledProcessError, requests.RequestException, OSError, ValueError) as e:
+        logging.warning(f"{log_prefix} Cannot detect changes, dumping the database. Error Output: {e}")
+        return None
+    if value is None:
+        logging.warning(f"{log_prefix} Cannot detect changes of this database, dumping it")
+        return None
+    logging.debug(f"{log_prefix} Database state: {value.splitlines()[0]}")
+
+    # Only whether the backup is encrypted, the catalog must not give hints
+    # on the passphrase
+    digest = hashlib.sha256()
+    # Continuous backups of PostgreSQL are base backups instead of dumps
+    engine = database.engine + (" continuous" if database.continuous else "")
+    for part in (database.type.name, engine, database.storage, codec.name, str(database.encryption_passphrase != ""), value):
+        digest.update(part.encode() + b"\0")
+    return digest.hexdigest()
+
+def unchanged(backup_catalog, container, state, max_skip_age, dump_dir):
+    # The last backup of the container, if the database is still in the same
+    # state and its content is younger than max_skip_age hours
+    if state is None:
+        return None
+    latest = backup_catalog.latest(container)
+    if latest is None or latest["state"] != state:
+        return None
+    dumped = datetime.datetime.strptime(latest["dumped"] or latest["created"], catalog.DATE_FORMAT)
+    if max_skip_age and datetime.datetime.now() - dumped >= datetime.timedelta(hours=max_skip_age):
+        return None
+    if not os.path.exists(os.path.join(dump_dir, latest["name"])):
+        return None
+    return latest
+
+def _link_file(source, target):
+    # Hard links cost no space, copies are the fall back on file systems
+    # without them
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+    return target
+
+def link(dump_dir, name, out_file):
+    # Makes the backup name available under the name of a new backup
+    # (out_file without extensions) and returns its path
+    match = catalog.BACKUP_NAME_REGEX.match(name)
+    source = os.path.join(dump_dir, name)
+    target = out_file + name[match.end(2):]
+    if os.path.isdir(source):
+        shutil.copytree(source, target + pipeline.TEMP_SUFFIX, copy_function=_link_file)
+        os.replace(target + pipeline.TEMP_SUFFIX, target)
+        return target
+
+    checksum = pipeline.read_checksum(source)
+    if checksum is not None:
+        # The sidecar names the file, so it gets a new one
+        pipeline.write_checksum(target, checksum)
+    _link_file(source, target)
+    return target
@@ -0,0 +1,163 @@
+import os
+import zlib
+import zstandard
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .pipeline import Reader
+
+BLOCK_SIZE = 1024 * 1024
+
+class GzipReader(Reader):
+    def __init__(self, source, level):
+        super().__init__(source)
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def _process(self, data):
+        return self._compressor.compress(data)
+
+    def _finish(self):
+        return self._compressor.flush()
+
+class ParallelGzipReader(Reader):
+    # Compresses independent blocks on a thread pool (zlib releases the GIL)
+    # and writes every block as a gzip member of its own. Concatenated members
+    # are a valid gzip file, so gunzip, zcat etc. read it like pigz output.
+
+    def __init__(self, source, level, threads):
+        super().__init__(source)
+        self._level = level
+        self._threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+        self._source_eof = False
+
+    def _compress_block(self, data):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def _fill(self):
+        # Keep twice as many blocks in flight as there are threads, so no
+        # thread runs dry while the oldest block is being handed out
+        while not self._source_eof and len(self._pending) < self._threads * 2:
+            data = self.source.read(BLOCK_SIZE)
+            if not data:
+                self._source_eof = True
+                break
+            self.bytes_in += len(data)
+            self._pending.append(self._executor.submit(self._compress_block, data))
+
+        if self._pending:
+            self._buffer += self._pending.popleft().result()
+        else:
+            self._executor.shutdown()
+            self._eof = True
+
+class ZstdReader(Reader):
+    def __init__(self, source, level, threads):
+        super().__init__(source)
+        # zstd splits the stream into jobs for its worker threads by itself
+        # and still produces one regular frame. The frame checksum lets a
+        # deep verification detect corrupted data.
+        self._compressor = zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0, write_checksum=True).compressobj()
+
+    def _process(self, data):
+        return self._compressor.compress(data)
+
+    def _finish(self):
+        return self._compressor.flush()
+
+class GunzipReader(Reader):
+    # Reads files with several gzip members (see ParallelGzipReader) as well.
+    # A stream that ends within a member raises ValueError.
+
+    def __init__(self, source):
+        super().__init__(source)
+        self._decompressor = zlib.decompressobj(31)
+        self._pending = False
+
+    def _process(self, data):
+        output = b""
+        while data:
+            output += self._decompressor.decompress(data)
+            self._pending = not self._decompressor.eof
+            data = self._decompressor.unused_data
+            if self._decompressor.eof:
+                self._decompressor = zlib.decompressobj(31)
+        return output
+
+    def _finish(self):
+        if self._pending:
+            raise ValueError("Unexpected end of the gzip stream")
+        return b""
+
+class ZstdDecompressReader(Reader):
+    def __init__(self, source):
+        super().__init__(source)
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self._pending = False
+
+    def _process(self, data):
+        output = b""
+        while data:
+            output += self._decompressor.decompress(data)
+            self._pending = not self._decompressor.eof
+            data = self._decompressor.unused_data if self._decompressor.eof else b""
+            if self._decompressor.eof:
+                self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        return output
+
+    def _finish(self):
+        if self._pending:
+            raise ValueError("Unexpected end of the zstd stream")
+        return b""
+
+class Codec:
+    def __init__(self, name, extension, default_level, min_level, max_level):
+        self.name = name
+        self.extension = extension
+        self.default_level = default_level
+        self.min_level = min_level
+        self.max_level = max_level
+        self.level = default_level
+        self.threads = 1
+
+    def configure(self, level=None, threads=None):
+        codec = Codec(self.name, self.extension, self.default_level, self.min_level, self.max_level)
+        if level is not None:
+            if level < self.min_level or level > self.max_level:
+                raise AttributeError("Invalid compression level {} for {} ({}-{})".format(level, self.name, self.min_level, self.max_level))
+            codec.level = level
+        if threads is not None:
+            codec.threads = threads if threads > 0 else os.cpu_count() or 1
+        return codec
+
+    def reader(self, source):
+        if self.name == "gzip":
+            if self.threads > 1:
+                return ParallelGzipReader(source, self.level, self.threads)
+            return GzipReader(source, self.level)
+        elif self.name == "zstd":
+            return ZstdReader(source, self.level, self.threads)
+        return source
+
+    def decompressor(self, source):
+        if self.name == "gzip":
+            return GunzipReader(source)
+        elif self.name == "zstd":
+            return ZstdDecompressReader(source)
+        return source
+
+CODECS = {
+    "none": Codec("none", "", 0, 0, 0),
+    "gzip": Codec("gzip", ".gz", 6, 1, 9),
+    "zstd": Codec("zstd", ".zst", 3, 1, 22),
+}
+
+EXTENSIONS = [codec.extension for codec in CODECS.values() if codec.extension]
+
+def get(name, level=None, threads=None):
+    return CODECS[name].configure(level, threads)
+
+def from_extension(extension):
+    return next((codec for codec in CODECS.values() if codec.extension and codec.extension == extension), CODECS["none"])
@@ -3,8 +3,12 @@ import re
 import distutils.util
 
 import docker
+import logging
+from croniter import croniter
 
 from . import settings
+from . import compression
+from . import throttle
 
 class DatabaseType(Enum):
   unknown = -1
@@ -49,6 +53,10 @@ TYPE_DEFAULTS = {
   }
 }
 
+ENGINES = ["default", "parallel"]
+STORAGES = ["files", "dedup"]
+CHANGE_DETECTIONS = ["off", "skip", "link"]
+
 class Database:
   IMAGE_REGEX = re.compile("^(.+?)(?::.+)?$")
 
@@ -66,7 +74,25 @@ class Database:
     if "password" in values: self.password = values["password"]
     if "token" in values: self.token = values["token"]
     if "compress" in values: self.compress = values["compress"]
+    if "compress_level" in values: self.compress_level = values["compress_level"]
+    if "compress_threads" in values: self.compress_threads = values["compress_threads"]
+    if "engine" in values: self.engine = values["engine"]
+    if "jobs" in values: self.jobs = values["jobs"]
+    if "chunk_rows" in values: self.chunk_rows = values["chunk_rows"]
+    if "parallel_databases" in values: self.parallel_databases = values["parallel_databases"]
+    if "storage" in values: self.storage = values["storage"]
+    if "schedule" in values: self.schedule = values["schedule"]
     if "encryption_passphrase" in values: self.encryption_passphrase = values["encryption_passphrase"]
+    if "read_limit" in values: self.read_limit = values["read_limit"]
+    if "write_limit" in values: self.write_limit = values["write_limit"]
+    if "nice" in values: self.nice = values["nice"]
+    if "ionice" in values: self.ionice = values["ionice"]
+    if "adaptive_throttle" in values: self.adaptive_throttle = values["adaptive_throttle"]
+    if "change_detection" in values: self.change_detection = values["change_detection"]
+    if "max_skip_age" in values: self.max_skip_age = values["max_skip_age"]
+    if "continuous" in values: self.continuous = values["continuous"]
+    if "continuous_interval" in values: self.continuous_interval = values["continuous_interval"]
+    if "hc_uuid" in values: self.hc_uuid = values["hc_uuid"]
 
   def _get_labels_from_container(self, container):
     labels = {}
@@ -102,4 +128,81 @@ class Database:
     else:
       self.port = int(self.port)
     
-    self.compress = distutils.util.strtobool(self.compress)
+    # true/false are still accepted and mean gzip/none
+    self.compress = str(self.compress).strip().lower()
+    try:
+      self.compress = "gzip" if distutils.util.strtobool(self.compress) else "none"
+    except ValueError:
+      pass
+    if self.compress not in compression.CODECS:
+      logging.error("Unknown compression '{}' on container {}, falling back to gzip".format(self.compress, container.name))
+      self.compress = "gzip"
+
+    level = None if self.compress_level == "auto" else int(self.compress_level)
+    threads = 0 if self.compress_threads == "auto" else int(self.compress_threads)
+    self.codec = compression.get(self.compress, level, threads)
+
+    self.engine = str(self.engine).strip().lower()
+    if self.engine not in ENGINES:
+      logging.error("Unknown engine '{}' on container {}, falling back to default".format(self.engine, container.name))
+      self.engine = "default"
+
+    self.jobs = int(self.jobs)
+    if self.jobs < 1:
+      raise AttributeError("Invalid jobs value")
+
+    self.chunk_rows = int(self.chunk_rows)
+    if self.chunk_rows < 1:
+      raise AttributeError("Invalid chunk_rows value")
+
+    self.parallel_databases = int(self.parallel_databases)
+    if self.parallel_databases < 1:
+      raise AttributeError("Invalid parallel_databases value")
+
+    self.storage = str(self.storage).strip().lower()
+    if self.storage not in STORAGES:
+      logging.error("Unknown storage '{}' on container {}, falling back to files".format(self.storage, container.name))
+      self.storage = "files"
+
+    self.schedule = str(self.schedule).strip()
+    if self.schedule and not croniter.is_valid(self.schedule):
+      logging.error("Invalid schedule '{}' on container {}, falling back to global schedule".format(self.schedule, container.name))
+      self.schedule = ""
+
+    self.read_limit = settings.parse_rate(self.read_limit, "read_limit")
+    self.write_limit = settings.parse_rate(self.write_limit, "write_limit")
+
+    self.nice = int(self.nice)
+    if self.nice < 0 or self.nice > 19:
+      raise AttributeError("Invalid nice value")
+
+    # none, idle or best-effort with an optional level, e.g. best-effort:7
+    self.ionice = str(self.ionice).strip().lower()
+    ionice_class, _, ionice_level = self.ionice.partition(":")
+    if ionice_class not in throttle.IONICE_CLASSES or (ionice_level and (ionice_class != "best-effort" or not ionice_level.isdigit() or int(ionice_level) > 7)):
+      raise AttributeError("Invalid ionice value")
+
+    self.adaptive_throttle = distutils.util.strtobool(str(self.adaptive_throttle))
+
+    self.change_detection = str(self.change_detection).strip().lower()
+    if self.change_detection not in CHANGE_DETECTIONS:
+      logging.error("Unknown change_detection '{}' on container {}, falling back to off".format(self.change_detection, container.name))
+      self.change_detection = "off"
+
+    # Hours, 0 never forces a full dump
+    self.max_skip_age = int(self.max_skip_age)
+    if self.max_skip_age < 0:
+      raise AttributeError("Invalid max_skip_age value")
+
+    self.continuous = distutils.util.strtobool(str(self.continuous))
+    if self.continuous and self.type not in (DatabaseType.mysql, DatabaseType.mariadb, DatabaseType.postgres):
+      logging.error("Continuous backups are not supported for {} on container {}".format(self.type.name, container.name))
+      self.continuous = False
+
+    # Seconds, 0 waits for the database to start the next segment itself
+    self.continuous_interval = int(self.continuous_interval)
+    if self.continuous_interval < 0:
+      raise AttributeError("Invalid continuous_interval value")
+
+    # Healthchecks.io check of this container alone
+    self.hc_uuid = str(self.hc_uuid).strip()
@@ -0,0 +1,40 @@
+import threading
+import collections
+from concurrent.futures import Future
+
+class Dispatcher:
+    # Hands work to the executor, but never more than limit items of one
+    # Docker host at once. Work that waits for its host doesn't occupy a
+    # worker, so the backups of other hosts go ahead.
+
+    def __init__(self, executor, limit):
+        self.executor = executor
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._running = collections.Counter()
+        self._waiting = collections.defaultdict(collections.deque)
+
+    def submit(self, host, function, *args):
+        future = Future()
+        with self._lock:
+            if self._running[host] >= self.limit:
+                self._waiting[host].append((future, function, args))
+                return future
+            self._running[host] += 1
+        self._start(host, future, function, args)
+        return future
+
+    def _start(self, host, future, function, args):
+        self.executor.submit(function, *args).add_done_callback(lambda inner: self._done(host, future, inner))
+
+    def _done(self, host, future, inner):
+        with self._lock:
+            waiting = self._waiting[host].popleft() if self._waiting[host] else None
+            if waiting is None:
+                self._running[host] -= 1
+        if waiting is not None:
+            self._start(host, *waiting)
+        if inner.exception() is not None:
+            future.set_exception(inner.exception())
+        else:
+            future.set_result(inner.result())
@@ -1,14 +1,183 @@
 import os
 import sys
+import subprocess
+import threading
+import urllib.parse
 
 import docker
+import docker.tls
 import logging
 
 DOCKER_SOCK = "/var/run/docker.sock"
 
-def get_client():
-    if not os.path.exists(DOCKER_SOCK):
-        logging.error("Docker Socket not found. Socket file must be created at {}".format(DOCKER_SOCK))
+class UnreachableError(Exception):
+    pass
+
+def _tls(url, name):
+    # TCP endpoints use the certificates in DOCKER_CERT_PATH, or in a
+    # directory named like the host below it
+    cert_path = os.getenv("DOCKER_CERT_PATH", "")
+    if not url.startswith("tcp://") or not cert_path:
+        return False
+    if os.path.isdir(os.path.join(cert_path, name)):
+        cert_path = os.path.join(cert_path, name)
+    return docker.tls.TLSConfig(
+        client_cert=(os.path.join(cert_path, "cert.pem"), os.path.join(cert_path, "key.pem")),
+        ca_cert=os.path.join(cert_path, "ca.pem"),
+        verify=True)
+
+def get_client(max_parallel=1, url=None, name=""):
+    # Every worker talks to the daemon at the same time, so the connection
+    # pool must not be smaller than the worker pool
+    if url is None:
+        if not os.path.exists(DOCKER_SOCK):
+            logging.error("Docker Socket not found. Socket file must be created at {}".format(DOCKER_SOCK))
+            sys.exit(1)
+        return docker.from_env(max_pool_size=max(10, max_parallel * 2))
+    return docker.DockerClient(base_url=url, tls=_tls(url, name), max_pool_size=max(10, max_parallel * 2))
+
+class Host:
+    # One Docker endpoint. Containers on the local one are reached through
+    # the helper network, on remote ones through their published ports.
+    # Backups of containers on a named host are prefixed with the name.
+
+    def __init__(self, name, url, client, network_name):
+        self.name = name
+        self.url = url
+        self.client = client
+        self.local = url is None or url.startswith("unix://")
+        if self.local:
+            self.network = HelperNetwork(client, network_name)
+        else:
+            self.network = PublishedPorts(urllib.parse.urlparse(url).hostname)
+
+    def backup_name(self, container):
+        return "{}_{}".format(self.name, container.name) if self.name else container.name
+
+    def __str__(self):
+        return self.name or "local"
+
+def get_hosts(config, network_name=None):
+    # No DOCKER_HOSTS means the local socket only
+    network_name = network_name or config.helper_network_name
+    if not config.docker_hosts:
+        return [Host("", None, get_client(config.max_parallel), network_name)]
+    # A host that is down is left out, so the others are still backed up
+    hosts = []
+    for name, url in config.docker_hosts:
+        try:
+            hosts.append(Host(name, url, get_client(config.max_parallel, url, name), network_name))
+        except docker.errors.DockerException as e:
+            logging.error(f"Cannot connect to Docker host {name or url}, its containers are not backed up. Error Output: {e}")
+    if not hosts:
+        logging.error("None of the Docker hosts can be reached")
         sys.exit(1)
+    return hosts
+
+def find_container(hosts, name):
+    # The host and container a backup belongs to, name is the container
+    # part of the backup name
+    for host in hosts:
+        if host.name and name.startswith(host.name + "_"):
+            try:
+                return host, host.client.containers.get(name[len(host.name) + 1:])
+            except docker.errors.NotFound:
+                pass
+    for host in hosts:
+        if not host.name:
+            try:
+                return host, host.client.containers.get(name)
+            except docker.errors.NotFound:
+                pass
+    raise docker.errors.NotFound("No such container: {}".format(name))
+
+_own_container_id = None
+
+def get_own_container_id():
+    # The id never changes while the process runs, so it is only looked up once
+    global _own_container_id
+    if _own_container_id is None:
+        if os.path.isfile("/proc/1/cpuset"):
+            _own_container_id = subprocess.check_output("basename $(cat /proc/1/cpuset)", shell=True, text=True).strip()
+        elif os.path.isfile("/proc/self/cgroup"):
+            _own_container_id = subprocess.check_output("basename $(cat /proc/self/cgroup | head -n 1)", shell=True, text=True).strip()
+        else:
+            _own_container_id = subprocess.check_output("docker_api \"/containers/$(hostname)/json\" | jq -r '.Id')", shell=True, text=True).strip()
+    return _own_container_id
+
+class HelperNetwork:
+    # The helper network is created once and this container stays connected
+    # to it for the lifetime of the process. Only the database containers
+    # are connected and disconnected per backup. A backup and the log stream
+    # of a container share its connection, it is removed when both are done.
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.network = None
+        self._lock = threading.Lock()
+        self._connected = {}
+
+    def open(self):
+        with self._lock:
+            if self.network is None:
+                logging.debug(f"Create helper network {self.name}...")
+                self.network = self.client.networks.create(self.name)
+                self.network.connect(get_own_container_id())
+            return self
+
+    def connect(self, container, aliases=None):
+        with self._lock:
+            if self._connected.get(container.id, 0) == 0:
+                self.network.connect(container, aliases=aliases)
+            self._connected[container.id] = self._connected.get(container.id, 0) + 1
+
+    def disconnect(self, container):
+        with self._lock:
+            count = self._connected.pop(container.id, 0) - 1
+            if count > 0:
+                self._connected[container.id] = count
+            elif count == 0:
+                self.network.disconnect(container)
+
+    def close(self):
+        with self._lock:
+            if self.network is None:
+                return
+            logging.debug(f"Remove helper network {self.name}...")
+            try:
+                self.network.disconnect(get_own_container_id())
+                self.network.remove()
+            except docker.errors.APIError as e:
+                logging.error(f"Failed to remove helper network {self.name}. Error Output: {e}")
+            self.network = None
+            self._connected = {}
+
+class PublishedPorts:
+    # Stands in for the helper network on remote hosts: the database is
+    # reached through the port the container publishes on the host
+
+    def __init__(self, address):
+        self.address = address
+
+    def open(self):
+        return self
+
+    def close(self):
+        pass
+
+    def connect(self, container, aliases=None):
+        pass
+
+    def disconnect(self, container):
+        pass
 
-    return docker.from_env()
\ No newline at end of file
+    def target(self, container, port):
+        bindings = (container.attrs.get("NetworkSettings", {}).get("Ports") or {}).get("{}/tcp".format(port)) or []
+        for binding in bindings:
+            ip = binding.get("HostIp", "")
+            if ip in ("", "0.0.0.0", "::"):
+                return self.address, int(binding["HostPort"])
+            if not ip.startswith("127.") and ip != "::1":
+                return ip, int(binding["HostPort"])
+        raise UnreachableError("Port {} is not published on {}, the database cannot be reached".format(port, self.address))
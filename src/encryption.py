@@ -0,0 +1,89 @@
+import os
+import hashlib
+import threading
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Encrypted backups are a header followed by chunks of CHUNK_SIZE bytes, each
+# sealed with AES-GCM on its own. The nonce of a chunk is its position plus a
+# flag for the last chunk, so chunks can't be reordered, dropped or cut off
+# without decryption failing, and every chunk can be processed on its own.
+#
+# header: MAGIC (7) | VERSION (1) | salt (16) | file salt (16) | chunk size (4)
+EXTENSION = ".enc"
+LEGACY_EXTENSION = ".aes"
+MAGIC = b"pyd2b2E"
+LEGACY_MAGIC = b"AES"
+VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+TAG_SIZE = 16
+SALT_SIZE = 16
+HEADER_SIZE = len(MAGIC) + 1 + SALT_SIZE * 2 + 4
+
+class DecryptionError(Exception):
+    pass
+
+_master_keys = {}
+_salts = {}
+_lock = threading.Lock()
+
+def _master_key(passphrase, salt):
+    # scrypt is slow on purpose, so it only runs once per passphrase and salt
+    with _lock:
+        key = _master_keys.get((passphrase, salt))
+    if key is None:
+        key = hashlib.scrypt(passphrase.encode(), salt=salt, n=2**15, r=8, p=1, maxmem=64 * 1024 * 1024, dklen=32)
+        with _lock:
+            _master_keys[(passphrase, salt)] = key
+    return key
+
+def _salt(passphrase):
+    # All files written with the same passphrase share the salt of the
+    # master key and only differ in their file salt
+    with _lock:
+        if passphrase not in _salts:
+            _salts[passphrase] = os.urandom(SALT_SIZE)
+        return _salts[passphrase]
+
+def _file_key(master_key, file_salt):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=file_salt, info=b"pyd2b2 file key").derive(master_key)
+
+def _nonce(index, last):
+    return index.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+
+class Cipher:
+    def __init__(self, header, key, chunk_size):
+        self.header = header
+        self.chunk_size = chunk_size
+        self._aead = AESGCM(key)
+
+    def encrypt(self, index, data, last):
+        return self._aead.encrypt(_nonce(index, last), data, self.header)
+
+    def decrypt(self, index, data, last):
+        try:
+            return self._aead.decrypt(_nonce(index, last), data, self.header)
+        except InvalidTag:
+            raise DecryptionError("Chunk {} cannot be decrypted, the passphrase is wrong or the file is corrupted".format(index))
+
+def new_cipher(passphrase, chunk_size=CHUNK_SIZE):
+    salt = _salt(passphrase)
+    file_salt = os.urandom(SALT_SIZE)
+    header = MAGIC + bytes([VERSION]) + salt + file_salt + chunk_size.to_bytes(4, "big")
+    return Cipher(header, _file_key(_master_key(passphrase, salt), file_salt), chunk_size)
+
+def read_cipher(header, passphrase):
+    if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+        raise DecryptionError("Not an encrypted backup")
+    if header[len(MAGIC)] != VERSION:
+        raise DecryptionError("Unsupported encryption version {}".format(header[len(MAGIC)]))
+    offset = len(MAGIC) + 1
+    salt = header[offset:offset + SALT_SIZE]
+    file_salt = header[offset + SALT_SIZE:offset + SALT_SIZE * 2]
+    chunk_size = int.from_bytes(header[offset + SALT_SIZE * 2:], "big")
+    return Cipher(header, _file_key(_master_key(passphrase, salt), file_salt), chunk_size)
+
+def is_encrypted(name):
+    return name.endswith(EXTENSION) or name.endswith(LEGACY_EXTENSION)
@@ -0,0 +1,118 @@
+import os
+import time
+import heapq
+import sqlite3
+import threading
+
+HISTORY_FILE = ".history.sqlite"
+# Runs the expected duration is the median of
+ESTIMATE_RUNS = 5
+# Runs the trends are fitted to, at least TREND_MIN_RUNS over a day
+TREND_RUNS = 30
+TREND_MIN_RUNS = 3
+KEEP_DAYS = 400
+DAY = 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    container TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    bytes_in INTEGER,
+    bytes_out INTEGER,
+    success INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_container_started ON runs (container, started);
+"""
+
+def _slope(points):
+    # Least squares slope of (x, y) points, None if x doesn't vary
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+class Summary:
+    # What the past runs of one container say about the next one
+
+    def __init__(self, container, runs):
+        self.container = container
+        self.runs = len(runs)
+        self.last = runs[0] if runs else None
+        durations = sorted(run["duration"] for run in runs[:ESTIMATE_RUNS])
+        self.expected = durations[len(durations) // 2] if durations else None
+        # Change per day of the duration and of the uncompressed size
+        self.duration_trend = None
+        self.size_trend = None
+        if len(runs) >= TREND_MIN_RUNS and runs[0]["started"] - runs[-1]["started"] >= DAY:
+            self.duration_trend = _slope([(run["started"] / DAY, run["duration"]) for run in runs])
+            self.size_trend = _slope([(run["started"] / DAY, run["bytes_in"] or 0) for run in runs])
+
+class History:
+    # Durations and sizes of past backups, used to order a cycle longest
+    # first and to predict when it ends
+
+    def __init__(self, dump_dir):
+        self.path = os.path.join(dump_dir, HISTORY_FILE)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.executescript(SCHEMA)
+
+    def add(self, backup):
+        # backup is a finished metrics.Backup. The time it waited for a
+        # worker doesn't count.
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO runs (container, started, duration, bytes_in, bytes_out, success) VALUES (?, ?, ?, ?, ?, ?)",
+                (backup.container, backup.started, backup.duration - backup.phases.get("queue", 0.0), backup.bytes_in, backup.bytes_out, 1 if backup.success else 0))
+            self._connection.execute("DELETE FROM runs WHERE container = ? AND started < ?", (backup.container, time.time() - KEEP_DAYS * DAY))
+
+    def runs(self, container, limit=TREND_RUNS):
+        # Successful runs, newest first
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT started, duration, bytes_in, bytes_out FROM runs WHERE container = ? AND success = 1 ORDER BY started DESC LIMIT ?",
+                (container, limit))
+            columns = [d[0] for d in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def containers(self):
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT DISTINCT container FROM runs ORDER BY container")]
+
+    def summary(self, container):
+        return Summary(container, self.runs(container))
+
+    def expected(self, container):
+        return self.summary(container).expected
+
+    def longest_first(self, items, name=lambda item: item):
+        # Containers without history first, they may be the longest
+        expected = {name(item): self.expected(name(item)) for item in items}
+        return sorted(items, key=lambda item: -expected[name(item)] if expected[name(item)] is not None else float("-inf"))
+
+    def predict(self, containers, workers):
+        # Expected duration of a cycle on workers parallel slots, the way
+        # the executor hands them out: longest first, each to the slot that
+        # is free first. Containers without history count as the median
+        # of the others. Returns (seconds, containers without history).
+        expected = [self.expected(container) for container in containers]
+        known = sorted(seconds for seconds in expected if seconds is not None)
+        unknown = len(expected) - len(known)
+        fallback = known[len(known) // 2] if known else 0.0
+        slots = [0.0] * max(1, min(workers, len(expected)))
+        for seconds in sorted((fallback if seconds is None else seconds for seconds in expected), reverse=True):
+            heapq.heapreplace(slots, slots[0] + seconds)
+        return max(slots), unknown
+
+_histories = {}
+_histories_lock = threading.Lock()
+
+def get(dump_dir):
+    with _histories_lock:
+        if dump_dir not in _histories:
+            _histories[dump_dir] = History(dump_dir)
+        return _histories[dump_dir]
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import shlex
+import shutil
+import logging
+import tarfile
+import subprocess
+import tempfile
+
+from . import pipeline
+
+POLL_SECONDS = 0.2
+RECORD_SIZE = tarfile.RECORDSIZE
+
+def _connection_args(host, database):
+    return "--host http://{}:{} --token {}".format(host, database.port, database.token)
+
+def list_buckets(host, database, env):
+    output = subprocess.run(
+        "influx bucket list {} --json".format(_connection_args(host, database)),
+        shell=True,
+        text=True,
+        capture_output=True,
+        env=env,
+    )
+    output.check_returncode()
+    return sorted(bucket["name"] for bucket in json.loads(output.stdout))
+
+class _Job:
+    # One influx backup of a single bucket into a directory of its own
+
+    def __init__(self, bucket, directory, command, env):
+        self.bucket = bucket
+        self.directory = directory
+        self.command = command
+        self.stderr = tempfile.TemporaryFile()
+        os.makedirs(directory)
+        self.process = subprocess.Popen(command, shell=True, stdout=subprocess.DEVNULL, stderr=self.stderr, env=env)
+        self.archived = set()
+
+    def finished(self):
+        return self.process.poll() is not None
+
+    def check(self):
+        if self.process.returncode != 0:
+            self.stderr.seek(0)
+            raise subprocess.CalledProcessError(self.process.returncode, self.command, output="",
+                                                stderr=self.stderr.read().decode(errors="replace"))
+
+    def complete_files(self, finished):
+        # influx writes one file after the other, so every file but the
+        # newest is complete. Once the process is done, all of them are.
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name not in self.archived:
+                files.append((entry.stat().st_mtime_ns, entry.name))
+        files.sort()
+        if not finished and files:
+            newest = files[-1][0]
+            files = [file for file in files if file[0] < newest]
+        return [name for _, name in files]
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.stderr.close()
+
+def _tar_file(path, name):
+    # A tar member, read in blocks, so shards of any size are streamed
+    info = tarfile.TarInfo(name)
+    stat = os.stat(path)
+    info.size = stat.st_size
+    info.mtime = int(stat.st_mtime)
+    info.mode = 0o644
+    yield info.tobuf(tarfile.PAX_FORMAT)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(pipeline.BUFFER_SIZE)
+            if not data:
+                break
+            yield data
+    if info.size % tarfile.BLOCKSIZE:
+        yield b"\0" * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+
+def archive(host, database, buckets, stage_dir, env, log_prefix="", throttle=None):
+    # Runs up to parallel_databases influx backups at once, one per bucket,
+    # and yields a tar stream with a directory per bucket. Files are added
+    # (and deleted) as soon as influx has finished them, so the stage
+    # directory only holds the files in progress.
+    pending = list(buckets)
+    running = []
+    size = 0
+    try:
+        while pending or running:
+            while pending and len(running) < database.parallel_databases:
+                bucket = pending.pop(0)
+                command = "influx backup {} --bucket {} {}/".format(_connection_args(host, database), shlex.quote(bucket),
+                                                                    os.path.join(stage_dir, pipeline.file_name(bucket)))
+                logging.debug(f"{log_prefix} Backing up bucket {bucket}...")
+                running.append(_Job(bucket, os.path.join(stage_dir, pipeline.file_name(bucket)),
+                                    throttle.command(command) if throttle is not None else command, env))
+
+            added = False
+            for job in list(running):
+                finished = job.finished()
+                for name in job.complete_files(finished):
+                    path = os.path.join(job.directory, name)
+                    for block in _tar_file(path, pipeline.file_name(job.bucket) + "/" + name):
+                        size += len(block)
+                        yield block
+                    os.remove(path)
+                    job.archived.add(name)
+                    added = True
+                if finished:
+                    job.check()
+                    job.close()
+                    running.remove(job)
+            if not added:
+                time.sleep(POLL_SECONDS)
+    finally:
+        for job in running:
+            job.close()
+
+    # End of archive: two empty blocks, padded to a full record
+    end = tarfile.BLOCKSIZE * 2
+    yield b"\0" * (end + (-(size + end) % RECORD_SIZE))
+
+def backup(host, database, stage_dir, env, log_prefix="", throttle=None):
+    # Takes the place of the dump command in pipeline.stream(): hands the
+    # archive of all buckets to consume(source)
+    def stream(consume):
+        buckets = list_buckets(host, database, env)
+        logging.debug(f"{log_prefix} Found {len(buckets)} bucket(s)")
+        os.makedirs(stage_dir)
+        try:
+            source = pipeline.Reader(pipeline.IterSource(archive(host, database, buckets, stage_dir, env, log_prefix, throttle)))
+            return consume(throttle.reader(source) if throttle is not None else source)
+        finally:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+    return stream
@@ -0,0 +1,165 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+import requests
+
+from . import settings
+from .database import Database
+
+ENABLE_LABEL = settings.LABEL_PREFIX + "enable=true"
+# Events that (may) make a container available for backups and events after
+# which it is gone
+UPDATE_ACTIONS = ("start", "unpause", "rename", "update")
+REMOVE_ACTIONS = ("die", "stop", "kill", "pause", "destroy")
+RECONNECT_SECONDS = 5
+
+class Inventory:
+    # All enabled containers with their resolved labels. It is seeded with a
+    # single list call and then kept up to date by the Docker events stream,
+    # so a backup cycle doesn't need any API call to find its containers.
+
+    def __init__(self, client, global_labels, container_filter=None, on_change=None):
+        self.client = client
+        self.global_labels = global_labels
+        self.container_filter = container_filter or []
+        self.on_change = on_change
+        self._containers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def containers(self):
+        # Returns a snapshot of id -> (container, database)
+        with self._lock:
+            return dict(self._containers)
+
+    def _resolve(self, container):
+        if self.container_filter and container.name not in self.container_filter:
+            return None
+        try:
+            return Database(container, self.global_labels)
+        except Exception as e:
+            logging.error(f"[{container.name}] Cannot read labels: {e}")
+            return None
+
+    def seed(self):
+        containers = {}
+        for container in self.client.containers.list(filters = {"label": ENABLE_LABEL}):
+            database = self._resolve(container)
+            if database is not None:
+                containers[container.id] = (container, database)
+        with self._lock:
+            self._containers = containers
+        logging.debug(f"Found {len(containers)} container(s) to backup")
+        self._changed()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name="inventory", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def _update(self, container_id):
+        try:
+            container = self.client.containers.get(container_id)
+        except docker.errors.NotFound:
+            self._remove(container_id)
+            return
+
+        database = self._resolve(container) if container.status == "running" else None
+        with self._lock:
+            if database is None:
+                self._containers.pop(container_id, None)
+            else:
+                self._containers[container_id] = (container, database)
+        self._changed()
+
+    def _remove(self, container_id):
+        with self._lock:
+            removed = self._containers.pop(container_id, None)
+        if removed is not None:
+            logging.debug(f"[{removed[0].name}] Container is gone")
+            self._changed()
+
+    def handle(self, event):
+        container_id = event.get("id") or event.get("Actor", {}).get("ID")
+        action = event.get("Action", event.get("status", ""))
+        if not container_id:
+            return
+        if action in UPDATE_ACTIONS:
+            self._update(container_id)
+        elif action in REMOVE_ACTIONS:
+            self._remove(container_id)
+
+    def _watch(self):
+        since = time.time()
+        while not self._stopped.is_set():
+            try:
+                for event in self.client.events(decode=True, since=int(since), filters = {"type": "container", "label": ENABLE_LABEL}):
+                    since = event.get("time", since)
+                    self.handle(event)
+                    if self._stopped.is_set():
+                        return
+            except (docker.errors.APIError, requests.RequestException) as e:
+                logging.error(f"Docker events stream failed, reconnecting in {RECONNECT_SECONDS} seconds. Error Output: {e}")
+
+            # The stream ended, so events may have been missed
+            self._stopped.wait(RECONNECT_SECONDS)
+            if not self._stopped.is_set():
+                try:
+                    self.seed()
+                except (docker.errors.APIError, requests.RequestException) as e:
+                    logging.error(f"Listing the containers failed. Error Output: {e}")
+
+class Inventories:
+    # The inventories of several Docker hosts behind the interface of one.
+    # They are seeded at the same time, a host that can't be reached is left
+    # out until its events stream reconnects.
+
+    def __init__(self, hosts, global_labels, container_filter=None, on_change=None):
+        self.inventories = [(host, Inventory(host.client, global_labels, container_filter, on_change)) for host in hosts]
+        self._hosts = {}
+
+    def containers(self):
+        containers = {}
+        hosts = {}
+        for host, inventory in self.inventories:
+            current = inventory.containers()
+            hosts.update((key, host) for key in current)
+            containers.update(current)
+        self._hosts = hosts
+        return containers
+
+    def host(self, key):
+        return self._hosts[key]
+
+    def seed(self):
+        def seed(entry):
+            host, inventory = entry
+            try:
+                inventory.seed()
+            except (docker.errors.APIError, requests.RequestException) as e:
+                logging.error(f"Listing the containers on Docker host {host} failed. Error Output: {e}")
+                return e
+            return None
+
+        with ThreadPoolExecutor(max_workers=len(self.inventories)) as executor:
+            errors = list(executor.map(seed, self.inventories))
+        if all(errors):
+            raise errors[0]
+
+    def start(self):
+        for _, inventory in self.inventories:
+            inventory.start()
+
+    def stop(self):
+        for _, inventory in self.inventories:
+            inventory.stop()
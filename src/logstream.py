@@ -0,0 +1,373 @@
+import os
+import re
+import copy
+import json
+import time
+import shlex
+import logging
+import datetime
+import tempfile
+import threading
+import subprocess
+import pymysql
+
+from .database import DatabaseType
+from . import pipeline
+from . import compression
+from . import encryption
+from . import catalog
+from . import metrics
+from . import mysql_parallel
+from .docker import PublishedPorts
+
+POLL_SECONDS = 1
+RETRY_SECONDS = 30
+# mysqldump --master-data=2 writes the position within the first lines
+POSITION_SEARCH = 1024 * 1024
+POSITION_REGEX = re.compile(rb"^-- CHANGE (?:MASTER|REPLICATION SOURCE) TO (?:MASTER|SOURCE)_LOG_FILE='([^']+)', (?:MASTER|SOURCE)_LOG_POS=(\d+);", re.MULTILINE)
+# The segments of a container are archived in a directory named after it
+DIRECTORY_SUFFIXES = {
+    DatabaseType.mysql: ".binlog",
+    DatabaseType.mariadb: ".binlog",
+    DatabaseType.postgres: ".wal",
+}
+PARTIAL_SUFFIX = ".partial"
+
+class ChainError(Exception):
+    pass
+
+class PositionReader(pipeline.Reader):
+    # Passes a dump of mysqldump --master-data=2 on and picks the binary
+    # log position it continues at from its head
+
+    def __init__(self, source):
+        super().__init__(source)
+        self.position = None
+        self._head = b""
+
+    def _process(self, data):
+        if self.position is None and self._head is not None:
+            self._head += data
+            match = POSITION_REGEX.search(self._head)
+            if match:
+                self.position = "{}:{}".format(match.group(1).decode(), match.group(2).decode())
+            if match or len(self._head) >= POSITION_SEARCH:
+                self._head = None
+        return data
+
+class DumpPosition:
+    # Takes the place of the mysqldump command in pipeline.stream() and
+    # keeps the binary log position of the dump in position
+
+    def __init__(self, command, env=None, throttle=None):
+        self.command = command
+        self.env = env
+        self.throttle = throttle
+        self.position = None
+
+    def __call__(self, consume):
+        def inspect(source):
+            reader = PositionReader(source)
+            result = consume(reader)
+            self.position = reader.position
+            return result
+        return pipeline.stream(self.command, inspect, self.env, self.throttle)
+
+def manifest_position(path):
+    # The binary log position of a backup of the parallel engine
+    with open(os.path.join(path, mysql_parallel.MANIFEST_FILE)) as f:
+        position = json.load(f).get("binlog_position") or {}
+    if "File" not in position:
+        return None
+    return "{}:{}".format(position["File"], position["Position"])
+
+def _psql(host, database, env, query):
+    output = subprocess.run(
+        "psql --host={} --port={} --username={} --dbname=template1 --no-align --tuples-only --command=\"{}\"".format(
+            host, database.port, database.username, query),
+        shell=True,
+        text=True,
+        capture_output=True,
+        env=env,
+    )
+    output.check_returncode()
+    return output.stdout.strip()
+
+def postgres_position(host, database, env):
+    # The WAL position before a base backup. Replay starts at its
+    # checkpoint, which comes later.
+    return _psql(host, database, env, "SELECT pg_current_wal_lsn()")
+
+def _sequence(segment):
+    # Number of a binary log file, e.g. 12 for mysql-bin.000012
+    base, _, number = segment.rpartition(".")
+    return base, int(number) if number.isdigit() else -1
+
+class Streamer:
+    # Archives the binary log (MySQL/MariaDB) or the WAL (PostgreSQL) of one
+    # container while it runs. Every finished segment is compressed and
+    # encrypted like a backup and recorded in the catalog. The segment in
+    # progress is closed after continuous_interval seconds at the latest,
+    # which bounds the data lost with the database.
+
+    def __init__(self, config, name, host, container, database, alias):
+        self.config = config
+        self.name = name
+        self.host = host
+        self.container = container
+        self.database = database
+        self.alias = alias
+        self.log_prefix = f"[{name}]"
+        self.directory = os.path.join(config.dump_dir, name + DIRECTORY_SUFFIXES[database.type])
+        self.stage_dir = self.directory + pipeline.TEMP_SUFFIX
+        self.env = os.environ.copy()
+        if database.type == DatabaseType.postgres:
+            self.env["PGPASSWORD"] = database.password
+        self._catalog = catalog.get(config.dump_dir)
+        self._stopped = threading.Event()
+        self._process = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="logstream-" + self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        process = self._process
+        if process is not None and process.poll() is None:
+            process.terminate()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        for directory in (self.directory, self.stage_dir):
+            os.makedirs(directory, exist_ok=True)
+        os.chown(self.directory, self.config.dump_uid, self.config.dump_gid) # pylint: disable=maybe-no-member
+        while not self._stopped.is_set():
+            try:
+                network = self.host.network.open()
+                database = self.database
+                host = self.alias
+                if isinstance(network, PublishedPorts):
+                    host, port = network.target(self.container, database.port)
+                    database = copy.copy(database)
+                    database.port = port
+                network.connect(self.container, aliases=[self.alias])
+                try:
+                    if database.type == DatabaseType.postgres:
+                        self._postgres(host, database)
+                    else:
+                        self._mysql(host, database)
+                finally:
+                    network.disconnect(self.container)
+            except subprocess.CalledProcessError as e:
+                error_text = f"\n{e.stderr.strip()}".replace('\n', '\n> ').strip()
+                logging.error(f"{self.log_prefix} Log stream failed, retrying in {RETRY_SECONDS} seconds. Return Code: {e.returncode}; Error Output:\n{error_text}")
+            except Exception as e:
+                logging.error(f"{self.log_prefix} Log stream failed, retrying in {RETRY_SECONDS} seconds. Error Output: {e}")
+            self._stopped.wait(RETRY_SECONDS)
+
+    def _mysql(self, host, database):
+        connection = mysql_parallel.connect(host, database)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SHOW BINARY LOGS")
+                available = [row[0] for row in cursor.fetchall()]
+            start = self._mysql_start(available)
+            logging.info(f"{self.log_prefix} Streaming the binary log from {start}...")
+            command = ("mysqlbinlog --read-from-remote-server --raw --stop-never --host={} --port={} --user={} --password='{}'"
+                       " --result-file={}/ {}").format(
+                host, database.port, database.username, database.password, shlex.quote(self.stage_dir), shlex.quote(start))
+
+            def rotate():
+                # A new file only if the current one got events
+                connection.ping(reconnect=True)
+                with connection.cursor() as cursor:
+                    cursor.execute("FLUSH BINARY LOGS")
+
+            self._follow(command, self._mysql_finished, rotate)
+        finally:
+            connection.close()
+
+    def _mysql_start(self, available):
+        # Continues after the last archived file. The server may have purged
+        # it since, then the log has a gap.
+        last = self._catalog.last_segment(self.name)
+        if last is None:
+            return available[-1]
+        base, number = _sequence(last)
+        later = [log for log in available if _sequence(log)[0] == base and _sequence(log)[1] > number]
+        if not later:
+            logging.warning(f"{self.log_prefix} The binary log after {last} is gone, point-in-time restore is only possible from the next backup on")
+            return available[-1]
+        if _sequence(later[0])[1] != number + 1:
+            logging.warning(f"{self.log_prefix} The binary log between {last} and {later[0]} was purged, point-in-time restore is only possible from the next backup on")
+        return later[0]
+
+    def _mysql_finished(self):
+        # mysqlbinlog writes one file after the other, every file but the
+        # newest is complete
+        files = sorted(os.listdir(self.stage_dir))
+        return files[:-1], set()
+
+    def _postgres(self, host, database):
+        # The slot keeps the WAL on the server while the stream is down
+        slot = re.sub(r"[^a-z0-9_]", "_", "pyd2b2_" + self.name.lower())[:63]
+        command = "pg_receivewal --host={} --port={} --username={} --slot={}".format(host, database.port, database.username, slot)
+        subprocess.run(command + " --create-slot --if-not-exists", shell=True, text=True, capture_output=True, env=self.env).check_returncode()
+        logging.info(f"{self.log_prefix} Streaming the WAL (slot {slot})...")
+
+        def rotate():
+            # Does nothing if no WAL was written since the last switch
+            _psql(host, database, self.env, "SELECT pg_switch_wal()")
+
+        self._follow(command + " --directory={}".format(shlex.quote(self.stage_dir)), self._postgres_finished, rotate)
+
+    def _postgres_finished(self):
+        # pg_receivewal renames a segment once it is complete. It continues
+        # after the newest segment in the directory, so that one stays.
+        files = sorted(name for name in os.listdir(self.stage_dir) if not name.endswith(PARTIAL_SUFFIX))
+        return files, {name for name in files[-1:] if not name.endswith(".history")}
+
+    def _follow(self, command, finished, rotate):
+        # Runs the stream command and archives the segments finished() tells
+        # complete, until the command fails or the streamer is stopped.
+        # finished() returns the complete segments and those of them that
+        # stay in the stage directory.
+        rotated = time.monotonic()
+        current = None
+        with tempfile.TemporaryFile() as stderr:
+            # exec, so stopping it doesn't leave the command behind the shell
+            self._process = subprocess.Popen("exec " + command, shell=True, stdout=subprocess.DEVNULL, stderr=stderr, env=self.env)
+            try:
+                while not self._stopped.is_set():
+                    done = self._process.poll() is not None
+                    complete, keep = finished()
+                    last = self._catalog.last_segment(self.name)
+                    for segment in complete:
+                        if last is None or segment > last:
+                            self._archive(segment)
+                        if segment not in keep:
+                            os.remove(os.path.join(self.stage_dir, segment))
+                    if done:
+                        break
+
+                    newest = max(os.scandir(self.stage_dir), key=lambda entry: entry.name, default=None)
+                    state = (newest.name, newest.stat().st_size) if newest is not None else None
+                    if current is None or state is None or state[0] != current[0]:
+                        current = state
+                        rotated = time.monotonic()
+                    elif self.database.continuous_interval and time.monotonic() - rotated >= self.database.continuous_interval:
+                        if state[1] != current[1] or self.database.type == DatabaseType.postgres:
+                            try:
+                                rotate()
+                            except (pymysql.MySQLError, subprocess.CalledProcessError) as e:
+                                logging.warning(f"{self.log_prefix} Cannot start a new log segment, it is archived when the database starts one. Error Output: {e}")
+                        current = state
+                        rotated = time.monotonic()
+                    self._stopped.wait(POLL_SECONDS)
+            finally:
+                if self._process.poll() is None:
+                    self._process.terminate()
+                returncode = self._process.wait()
+
+            if returncode != 0 and not self._stopped.is_set():
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(returncode, command, output="",
+                                                    stderr=stderr.read().decode(errors="replace"))
+
+    def _archive(self, segment):
+        codec = self.database.codec
+        passphrase = self.database.encryption_passphrase
+        file = segment + codec.extension + (encryption.EXTENSION if passphrase != "" else "")
+        target = os.path.join(self.directory, file)
+        created = datetime.datetime.now().replace(microsecond=0)
+        with open(os.path.join(self.stage_dir, segment), "rb") as f:
+            _, size = pipeline.save(iter(lambda: f.read(pipeline.BUFFER_SIZE), b""), target, codec, passphrase)
+        os.chown(target, self.config.dump_uid, self.config.dump_gid) # pylint: disable=maybe-no-member
+        self._catalog.add_segment(os.path.join(os.path.basename(self.directory), file), self.name, segment, created, size,
+                                  pipeline.read_checksum(target))
+        metrics.registry.observe_segment(self.name, size)
+        logging.debug(f"{self.log_prefix} Archived log segment {segment}")
+
+class Streamers:
+    # The streamers of all containers with continuous backups. alias(container)
+    # is the name of a container on the helper network.
+
+    def __init__(self, config, alias):
+        self.config = config
+        self.alias = alias
+        self._streamers = {}
+
+    def update(self, entries):
+        # entries maps backup names to (host, container, database) of the
+        # containers with continuous backups
+        for name, streamer in list(self._streamers.items()):
+            entry = entries.get(name)
+            if entry is None or entry[1].id != streamer.container.id:
+                logging.info(f"[{name}] Stop log stream")
+                streamer.stop()
+                del self._streamers[name]
+        for name, (host, container, database) in entries.items():
+            if name not in self._streamers:
+                streamer = Streamer(self.config, name, host, container, database, self.alias(container))
+                streamer.start()
+                self._streamers[name] = streamer
+
+    def stop(self):
+        for streamer in self._streamers.values():
+            streamer.stop()
+        self._streamers = {}
+
+def chain(backup_catalog, backup, until=None):
+    # The segments that continue a backup, up to the one that holds until.
+    # Raises ChainError if the backup cannot be continued.
+    since = datetime.datetime.strptime(backup["dumped"] or backup["created"], catalog.DATE_FORMAT)
+    if until is not None and until < since:
+        raise ChainError("{} was taken after {}".format(backup["name"], until))
+    segments = []
+    for segment in backup_catalog.segments(backup["container"], since):
+        segments.append(segment)
+        if until is not None and datetime.datetime.strptime(segment["created"], catalog.DATE_FORMAT) >= until:
+            break
+    else:
+        if until is not None:
+            raise ChainError("the log is only archived until {}".format(segments[-1]["created"] if segments else backup["created"]))
+    if not segments:
+        raise ChainError("no log segments were archived after {}".format(backup["name"]))
+
+    if segments[0]["name"].split("/")[0].endswith(".binlog"):
+        if not backup["position"]:
+            raise ChainError("{} has no binary log position".format(backup["name"]))
+        first = backup["position"].rpartition(":")[0]
+        if segments[0]["segment"] != first:
+            raise ChainError("the binary log {} of {} was not archived".format(first, backup["name"]))
+        for previous, segment in zip(segments, segments[1:]):
+            if _sequence(segment["segment"])[1] != _sequence(previous["segment"])[1] + 1:
+                raise ChainError("the binary log between {} and {} is missing".format(previous["segment"], segment["segment"]))
+    return segments
+
+def export(dump_dir, segments, target_dir, passphrase=""):
+    # Writes the plain segments into target_dir and returns their paths
+    paths = []
+    for segment in segments:
+        path = os.path.join(dump_dir, segment["name"])
+        name = os.path.basename(path)
+        with open(path, "rb") as f:
+            reader = pipeline.Reader(f)
+            if encryption.is_encrypted(name):
+                if passphrase == "":
+                    raise ChainError(f"{name} is encrypted, but no passphrase was given")
+                reader = pipeline.decrypt(f, passphrase)
+                name = os.path.splitext(name)[0]
+            reader = compression.from_extension(os.path.splitext(name)[1]).decompressor(reader)
+            target = os.path.join(target_dir, segment["segment"])
+            with open(target, "wb") as output:
+                while True:
+                    data = reader.read(pipeline.BUFFER_SIZE)
+                    if not data:
+                        break
+                    output.write(data)
+        paths.append(target)
+    return paths
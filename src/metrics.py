@@ -0,0 +1,227 @@
+import json
+import time
+import logging
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "pyd2b2_"
+
+class Backup:
+    # Timings and sizes of one container backup. Every phase adds its
+    # duration, phases that run more than once add up.
+
+    def __init__(self, container, type):
+        self.container = container
+        self.type = type
+        self.started = time.time()
+        self.duration = 0.0
+        self.phases = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.success = False
+        # The backup file or directory once it is written
+        self.path = None
+        # "skip" or "link" if change detection saved the dump, such runs
+        # say nothing about how long a dump takes
+        self.skipped = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + max(0.0, seconds)
+
+    def add_all(self, timings):
+        for phase, seconds in timings.items():
+            self.add(phase, seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - started)
+
+    def finish(self, success):
+        self.success = success
+        self.duration = time.time() - self.started
+
+    @property
+    def throughput(self):
+        # Uncompressed bytes per second of the whole backup
+        return self.bytes_in / self.duration if self.duration > 0 else 0.0
+
+    @property
+    def ratio(self):
+        return self.bytes_in / self.bytes_out if self.bytes_out > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            "container": self.container,
+            "type": self.type,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "success": self.success,
+            "duration": round(self.duration, 3),
+            "phases": {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "mb_per_second": round(self.throughput / 1000000, 2),
+            "compression_ratio": round(self.ratio, 2),
+        }
+
+class Registry:
+    # Latest values of all metrics, rendered in the Prometheus text format
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._containers = {}
+        self._cycle = None
+        self._cycles = 0
+        self._summaries = {}
+        self._expected_cycle = None
+        self._segments = {}
+
+    def observe(self, backup):
+        with self._lock:
+            entry = self._containers.setdefault(backup.container, {"total": 0, "failures": 0, "last_success": None, "last": None})
+            entry["total"] += 1
+            if backup.success:
+                entry["last_success"] = backup.started + backup.duration
+            else:
+                entry["failures"] += 1
+            entry["last"] = backup
+
+    def observe_summary(self, summary):
+        # summary is a history.Summary
+        with self._lock:
+            self._summaries[summary.container] = summary
+
+    def observe_segment(self, container, size):
+        # A binary log or WAL segment was archived
+        with self._lock:
+            entry = self._segments.setdefault(container, {"total": 0, "bytes": 0, "last": None})
+            entry["total"] += 1
+            entry["bytes"] += size
+            entry["last"] = time.time()
+
+    def observe_prediction(self, seconds):
+        with self._lock:
+            self._expected_cycle = seconds
+
+    def observe_cycle(self, record):
+        with self._lock:
+            self._cycle = record
+            self._cycles += 1
+
+    def render(self):
+        lines = []
+
+        def metric(name, type, help, samples):
+            lines.append(f"# HELP {PREFIX}{name} {help}")
+            lines.append(f"# TYPE {PREFIX}{name} {type}")
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels.items())
+                lines.append("{}{}{} {}".format(PREFIX, name, "{" + label_text + "}" if label_text else "", value))
+
+        with self._lock:
+            containers = sorted(self._containers.items())
+            cycle = self._cycle
+            cycles = self._cycles
+            summaries = sorted(self._summaries.items())
+            expected_cycle = self._expected_cycle
+            segments = sorted((name, dict(entry)) for name, entry in self._segments.items())
+
+        metric("backups_total", "counter", "Backups started per container",
+               [({"container": name}, entry["total"]) for name, entry in containers])
+        metric("backup_failures_total", "counter", "Failed backups per container",
+               [({"container": name}, entry["failures"]) for name, entry in containers])
+        metric("backup_last_success_timestamp_seconds", "gauge", "Time of the last successful backup",
+               [({"container": name}, entry["last_success"]) for name, entry in containers if entry["last_success"] is not None])
+
+        last = [(name, entry["last"]) for name, entry in containers]
+        metric("backup_duration_seconds", "gauge", "Duration of the last backup",
+               [({"container": name}, round(backup.duration, 3)) for name, backup in last])
+        metric("backup_phase_seconds", "gauge", "Duration of each phase of the last backup",
+               [({"container": name, "phase": phase}, round(seconds, 3)) for name, backup in last for phase, seconds in sorted(backup.phases.items())])
+        metric("backup_bytes_in", "gauge", "Uncompressed size of the last backup",
+               [({"container": name}, backup.bytes_in) for name, backup in last])
+        metric("backup_bytes_out", "gauge", "Bytes written by the last backup",
+               [({"container": name}, backup.bytes_out) for name, backup in last])
+        metric("backup_throughput_bytes_per_second", "gauge", "Uncompressed bytes per second of the last backup",
+               [({"container": name}, round(backup.throughput)) for name, backup in last])
+        metric("backup_compression_ratio", "gauge", "Uncompressed size divided by written size of the last backup",
+               [({"container": name}, round(backup.ratio, 3)) for name, backup in last])
+
+        metric("backup_expected_duration_seconds", "gauge", "Expected duration of the next backup, from the past runs",
+               [({"container": name}, round(summary.expected, 3)) for name, summary in summaries if summary.expected is not None])
+        metric("backup_duration_trend_seconds_per_day", "gauge", "Change of the backup duration per day over the past runs",
+               [({"container": name}, round(summary.duration_trend, 3)) for name, summary in summaries if summary.duration_trend is not None])
+        metric("backup_size_trend_bytes_per_day", "gauge", "Change of the uncompressed backup size per day over the past runs",
+               [({"container": name}, round(summary.size_trend)) for name, summary in summaries if summary.size_trend is not None])
+
+        metric("log_segments_total", "counter", "Binary log or WAL segments archived per container",
+               [({"container": name}, entry["total"]) for name, entry in segments])
+        metric("log_segment_bytes_total", "counter", "Bytes written for archived binary log or WAL segments",
+               [({"container": name}, entry["bytes"]) for name, entry in segments])
+        metric("log_last_segment_timestamp_seconds", "gauge", "Time the last binary log or WAL segment was archived",
+               [({"container": name}, round(entry["last"], 3)) for name, entry in segments])
+
+        metric("cycles_total", "counter", "Finished backup cycles", [({}, cycles)])
+        if expected_cycle is not None:
+            metric("cycle_expected_duration_seconds", "gauge", "Expected duration of the current or last backup cycle", [({}, round(expected_cycle, 3))])
+        if cycle is not None:
+            metric("cycle_duration_seconds", "gauge", "Duration of the last backup cycle", [({}, cycle["duration"])])
+            metric("cycle_cleanup_seconds", "gauge", "Duration of the cleanup of the last backup cycle", [({}, cycle["cleanup"])])
+            metric("cycle_containers", "gauge", "Containers in the last backup cycle", [({}, cycle["containers"])])
+            metric("cycle_successful", "gauge", "Successful backups in the last backup cycle", [({}, cycle["successful"])])
+            metric("cycle_bytes_in", "gauge", "Uncompressed bytes of the last backup cycle", [({}, cycle["bytes_in"])])
+            metric("cycle_bytes_out", "gauge", "Bytes written by the last backup cycle", [({}, cycle["bytes_out"])])
+            metric("cycle_finished_timestamp_seconds", "gauge", "Time the last backup cycle finished", [({}, cycle["finished_timestamp"])])
+
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def cycle_record(started, backups, cleanup_seconds):
+    finished = time.time()
+    return {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+        "finished": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(finished)),
+        "finished_timestamp": round(finished, 3),
+        "duration": round(finished - started, 3),
+        "cleanup": round(cleanup_seconds, 3),
+        "containers": len(backups),
+        "successful": sum(1 for backup in backups if backup.success),
+        "bytes_in": sum(backup.bytes_in for backup in backups),
+        "bytes_out": sum(backup.bytes_out for backup in backups),
+        "backups": [backup.as_dict() for backup in backups],
+    }
+
+def write_record(path, record):
+    # One JSON object per line, so the file can be appended and tailed
+    try:
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        logging.error(f"Failed to write metrics to {path}. Error Output: {e}")
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format % args)
+
+def serve(port):
+    server = ThreadingHTTPServer(("", port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logging.info(f"Metrics are available at http://0.0.0.0:{port}/metrics")
+    return server
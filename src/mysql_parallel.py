@@ -0,0 +1,275 @@
+import os
+import json
+import math
+import time
+import queue
+import shutil
+import logging
+import threading
+import pymysql
+import pymysql.cursors
+
+from . import pipeline
+from . import encryption
+
+IGNORED_DATABASES = ("mysql", "information_schema", "performance_schema", "sys")
+INTEGER_TYPES = ("tinyint", "smallint", "mediumint", "int", "bigint")
+STATEMENT_SIZE = 1024 * 1024
+MANIFEST_FILE = "manifest.json"
+
+class Job:
+    def __init__(self, schema, table, columns, file, where="", rows=0):
+        self.schema = schema
+        self.table = table
+        self.columns = columns
+        self.file = file
+        self.where = where
+        self.rows = rows
+
+def _quote(name):
+    return "`{}`".format(name.replace("`", "``"))
+
+def connect(host, database):
+    # Also used by the change detection and the binary log streaming
+    return pymysql.connect(
+        host=host,
+        port=database.port,
+        user=database.username,
+        password=database.password,
+        charset="utf8mb4",
+        autocommit=True,
+    )
+
+def binlog_position(cursor):
+    # The row of SHOW BINARY LOG STATUS (SHOW MASTER STATUS before MySQL
+    # 8.2) by column, None without a binary log
+    for statement in ("SHOW BINARY LOG STATUS", "SHOW MASTER STATUS"):
+        try:
+            cursor.execute(statement)
+        except pymysql.MySQLError:
+            continue
+        row = cursor.fetchone()
+        if row:
+            columns = [d[0] for d in cursor.description]
+            return dict(zip(columns, [str(v) for v in row]))
+        return None
+    return None
+
+def _open_snapshot(host, database, jobs, log_prefix):
+    # The same approach as mydumper: block writes for a moment with a global
+    # read lock, start a consistent snapshot on every worker connection and
+    # release the lock again. All workers then see the same point in time.
+    lock_connection = connect(host, database)
+    locked = False
+    position = None
+    connections = []
+    try:
+        with lock_connection.cursor() as cursor:
+            try:
+                cursor.execute("FLUSH TABLES WITH READ LOCK")
+                locked = True
+                position = binlog_position(cursor)
+            except pymysql.MySQLError as e:
+                logging.warning(f"{log_prefix} Global read lock not possible, the snapshots of the connections may differ slightly: {e}")
+
+        for _ in range(jobs):
+            connection = connect(host, database)
+            with connection.cursor() as cursor:
+                cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            connections.append(connection)
+    except BaseException:
+        for connection in connections:
+            connection.close()
+        raise
+    finally:
+        if locked:
+            with lock_connection.cursor() as cursor:
+                cursor.execute("UNLOCK TABLES")
+        lock_connection.close()
+
+    return connections, position
+
+def _plan(connection, chunk_rows):
+    schemas = []
+    tables = []
+    views = []
+    jobs = []
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT SCHEMA_NAME FROM information_schema.SCHEMATA ORDER BY SCHEMA_NAME")
+        schemas = [row[0] for row in cursor.fetchall() if row[0] not in IGNORED_DATABASES]
+        if not schemas:
+            return schemas, tables, views, jobs
+
+        placeholders = ", ".join(["%s"] * len(schemas))
+        cursor.execute(
+            "SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, EXTRA FROM information_schema.COLUMNS"
+            f" WHERE TABLE_SCHEMA IN ({placeholders}) ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION",
+            schemas)
+        columns = {}
+        for schema, table, column, extra in cursor.fetchall():
+            # Generated columns cannot be inserted
+            if "GENERATED" not in (extra or "").upper():
+                columns.setdefault((schema, table), []).append(column)
+
+        cursor.execute(
+            "SELECT TABLE_SCHEMA, TABLE_NAME, TABLE_TYPE, IFNULL(TABLE_ROWS, 0) FROM information_schema.TABLES"
+            f" WHERE TABLE_SCHEMA IN ({placeholders}) ORDER BY TABLE_SCHEMA, TABLE_NAME",
+            schemas)
+        for schema, table, table_type, rows in cursor.fetchall():
+            if table_type == "VIEW":
+                views.append((schema, table))
+                continue
+            tables.append((schema, table))
+            table_columns = columns.get((schema, table), [])
+            rows = int(rows)
+
+            key = None
+            if rows > chunk_rows:
+                cursor.execute(
+                    "SELECT k.COLUMN_NAME, c.DATA_TYPE FROM information_schema.KEY_COLUMN_USAGE k"
+                    " JOIN information_schema.COLUMNS c ON c.TABLE_SCHEMA = k.TABLE_SCHEMA AND c.TABLE_NAME = k.TABLE_NAME AND c.COLUMN_NAME = k.COLUMN_NAME"
+                    " WHERE k.TABLE_SCHEMA = %s AND k.TABLE_NAME = %s AND k.CONSTRAINT_NAME = 'PRIMARY'",
+                    (schema, table))
+                primary_key = cursor.fetchall()
+                if len(primary_key) == 1 and primary_key[0][1].lower() in INTEGER_TYPES:
+                    key = primary_key[0][0]
+
+            if key is None:
+                jobs.append(Job(schema, table, table_columns, pipeline.file_name(schema, table, "00000"), rows=rows))
+                continue
+
+            cursor.execute("SELECT MIN({0}), MAX({0}) FROM {1}.{2}".format(_quote(key), _quote(schema), _quote(table)))
+            low, high = cursor.fetchone()
+            if low is None:
+                jobs.append(Job(schema, table, table_columns, pipeline.file_name(schema, table, "00000"), rows=rows))
+                continue
+
+            chunks = math.ceil(rows / chunk_rows)
+            step = max(1, math.ceil((high - low + 1) / chunks))
+            for i, start in enumerate(range(low, high + 1, step)):
+                where = " WHERE {0} >= {1} AND {0} < {2}".format(_quote(key), start, start + step)
+                jobs.append(Job(schema, table, table_columns, pipeline.file_name(schema, table, f"{i:05d}"), where, min(chunk_rows, rows)))
+
+    # Largest first, so a big table doesn't end up alone at the end
+    jobs.sort(key=lambda job: job.rows, reverse=True)
+    return schemas, tables, views, jobs
+
+def _schema(connection, statement):
+    with connection.cursor() as cursor:
+        cursor.execute(statement)
+        return cursor.fetchone()[1]
+
+def _rows(connection, job, counter):
+    columns = ", ".join(_quote(column) for column in job.columns)
+    prefix = "INSERT INTO {} ({}) VALUES\n".format(_quote(job.table), columns)
+
+    with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute("SELECT {} FROM {}.{}{}".format(columns, _quote(job.schema), _quote(job.table), job.where))
+
+        yield b"SET NAMES utf8mb4;\nSET FOREIGN_KEY_CHECKS=0;\n"
+        statement = []
+        size = 0
+        for row in cursor:
+            values = connection.escape(row)
+            statement.append(values)
+            size += len(values)
+            counter[0] += 1
+            if size >= STATEMENT_SIZE:
+                yield (prefix + ",\n".join(statement) + ";\n").encode()
+                statement = []
+                size = 0
+        if statement:
+            yield (prefix + ",\n".join(statement) + ";\n").encode()
+
+def dump(host, database, target, log_prefix="", throttle=None):
+    # Dumps all databases into the directory target: one schema file per
+    # database and table, one data file per table (or per primary key range
+    # of big tables) and a manifest describing the set.
+    codec = database.codec
+    extension = ".sql" + codec.extension + (encryption.EXTENSION if database.encryption_passphrase != "" else "")
+    stage_dir = target + pipeline.TEMP_SUFFIX
+    os.makedirs(stage_dir)
+
+    started = time.time()
+    connections = []
+    try:
+        connections, position = _open_snapshot(host, database, database.jobs, log_prefix)
+        schemas, tables, views, jobs = _plan(connections[0], database.chunk_rows)
+        logging.debug(f"{log_prefix} Dumping {len(tables)} table(s) in {len(jobs)} chunk(s) with {len(connections)} connection(s)...")
+
+        files = []
+        def save(name, chunks):
+            bytes_in, bytes_out = pipeline.save(chunks, os.path.join(stage_dir, name + extension), codec, database.encryption_passphrase, throttle=throttle)
+            files.append({"file": name + extension, "size": bytes_out, "uncompressed_size": bytes_in})
+            return files[-1]
+
+        for schema in schemas:
+            statement = _schema(connections[0], "SHOW CREATE DATABASE {}".format(_quote(schema)))
+            save(pipeline.file_name(schema) + "-schema-create", [statement.encode(), b";\n"])
+        for schema, table in tables:
+            statement = _schema(connections[0], "SHOW CREATE TABLE {}.{}".format(_quote(schema), _quote(table)))
+            save(pipeline.file_name(schema, table) + "-schema", [b"SET NAMES utf8mb4;\n", statement.encode(), b";\n"])
+        for schema, view in views:
+            statement = _schema(connections[0], "SHOW CREATE TABLE {}.{}".format(_quote(schema), _quote(view)))
+            save(pipeline.file_name(schema, view) + "-schema-view", [b"SET NAMES utf8mb4;\n", statement.encode(), b";\n"])
+
+        pending = queue.Queue()
+        for job in jobs:
+            pending.put(job)
+        lock = threading.Lock()
+        failed = []
+        data = []
+
+        def work(connection):
+            while not failed:
+                try:
+                    job = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    counter = [0]
+                    bytes_in, bytes_out = pipeline.save(_rows(connection, job, counter),
+                                                        os.path.join(stage_dir, job.file + extension),
+                                                        codec, database.encryption_passphrase, throttle=throttle)
+                    with lock:
+                        data.append({"file": job.file + extension, "database": job.schema, "table": job.table,
+                                     "where": job.where.strip(), "rows": counter[0],
+                                     "size": bytes_out, "uncompressed_size": bytes_in})
+                except BaseException as e:
+                    failed.append(e)
+
+        workers = [threading.Thread(target=work, args=(connection,)) for connection in connections]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if failed:
+            raise failed[0]
+
+        data.sort(key=lambda entry: entry["file"])
+        manifest = {
+            "engine": "parallel",
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "binlog_position": position,
+            "compression": codec.name,
+            "encrypted": database.encryption_passphrase != "",
+            "databases": schemas,
+            "schema_files": files,
+            "data_files": data,
+        }
+        with open(os.path.join(stage_dir, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        os.rename(stage_dir, target)
+    except BaseException:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        raise
+    finally:
+        for connection in connections:
+            connection.close()
+
+    entries = files + data
+    return sum(entry["uncompressed_size"] for entry in entries), sum(entry["size"] for entry in entries)
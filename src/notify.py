@@ -0,0 +1,151 @@
+import time
+import logging
+import threading
+import itertools
+import collections
+import requests
+import requests.adapters
+
+TIMEOUT = 10
+# Seconds before the first retry, doubled for every further one
+BACKOFF_SECONDS = 2
+# Seconds the queue is given to empty on shutdown
+FLUSH_SECONDS = 30
+
+_sequence = itertools.count()
+
+class Notification:
+    def __init__(self, method, url, data, description, check):
+        self.method = method
+        self.url = url
+        self.data = data
+        self.description = description
+        self.check = check
+        # Order of arrival, kept through retries
+        self.sequence = next(_sequence)
+        self.attempts = 0
+        self.due = time.monotonic()
+
+    def key(self):
+        return (self.method, self.url, self.data)
+
+class Notifier:
+    # Sends the pings to Healthchecks.io and SUCCESS_URL from a thread of
+    # its own, so a slow or unreachable endpoint never holds up a backup.
+    # Connections are kept open between notifications. The notifications
+    # of one check are sent in the order they arrived, a later one waits
+    # behind the retries of an earlier one; otherwise Healthchecks.io could
+    # see a start after the end of a run. A notification that equals the
+    # last one still waiting for its check is dropped, and when more than
+    # queue_size wait, the oldest one is.
+
+    def __init__(self, retries=3, queue_size=100):
+        self.retries = retries
+        self.queue_size = queue_size
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._queue = collections.deque()
+        self._sending = None
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="notify", daemon=True)
+        self._thread.start()
+
+    def send(self, method, url, data=None, description="notification", check=None):
+        # description names the notification in the log, check the url of
+        # the check it belongs to (the url itself by default)
+        notification = Notification(method, url, data, description, check or url)
+        with self._condition:
+            last = max((queued for queued in self._queue if queued.check == notification.check),
+                       key=lambda queued: queued.sequence, default=None)
+            if last is not None and last.key() == notification.key():
+                logging.debug(f"Skip {description}, the same one is still waiting")
+                return
+            if len(self._queue) >= self.queue_size:
+                dropped = min(self._queue, key=lambda queued: queued.sequence)
+                self._queue.remove(dropped)
+                logging.warning(f"Too many notifications waiting, dropped {dropped.description}")
+            self._queue.append(notification)
+            self._condition.notify_all()
+
+    def _heads(self):
+        # The oldest notification of every check, only those may be sent
+        heads = {}
+        for notification in sorted(self._queue, key=lambda notification: notification.sequence):
+            heads.setdefault(notification.check, notification)
+        return heads.values()
+
+    def _next(self):
+        # The notification that is due first, waits until it is
+        with self._condition:
+            while True:
+                if self._stopped and not self._queue:
+                    return None
+                now = time.monotonic()
+                due = min(self._heads(), key=lambda notification: (notification.due, notification.sequence), default=None)
+                if due is not None and (due.due <= now or self._stopped):
+                    self._queue.remove(due)
+                    self._sending = due
+                    return due
+                self._condition.wait(due.due - now if due is not None else None)
+
+    def _run(self):
+        while True:
+            notification = self._next()
+            if notification is None:
+                return
+            try:
+                self._deliver(notification)
+            finally:
+                with self._condition:
+                    self._sending = None
+                    self._condition.notify_all()
+
+    def _deliver(self, notification):
+        notification.attempts += 1
+        logging.debug(f"Send {notification.description} ({notification.url})...")
+        try:
+            response = self.session.request(notification.method, notification.url, data=notification.data, timeout=TIMEOUT)
+            # Client errors won't go away by trying again
+            if response.status_code < 500 and response.status_code != 429:
+                if not response.ok:
+                    logging.error(f"Sending {notification.description} failed. Error Output: HTTP {response.status_code}")
+                return
+            error = f"HTTP {response.status_code}"
+        except requests.RequestException as e:
+            error = e
+
+        with self._condition:
+            if notification.attempts < self.retries and not self._stopped:
+                notification.due = time.monotonic() + BACKOFF_SECONDS * 2 ** (notification.attempts - 1)
+                logging.debug(f"Sending {notification.description} failed, retrying. Error Output: {error}")
+                self._queue.appendleft(notification)
+                return
+        logging.error(f"Sending {notification.description} failed. Error Output: {error}")
+
+    def stop(self, timeout=FLUSH_SECONDS):
+        # Sends what is waiting right away, without further retries
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        with self._condition:
+            if self._queue or self._sending is not None:
+                logging.warning(f"{len(self._queue) + (self._sending is not None)} notification(s) could not be sent before the shutdown")
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+def configure(config):
+    global _notifier
+    with _notifier_lock:
+        _notifier = Notifier(config.notify_retries, config.notify_queue_size)
+
+def get():
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            _notifier = Notifier()
+        return _notifier
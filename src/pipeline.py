@@ -0,0 +1,397 @@
+import os
+import time
+import hashlib
+import queue
+import threading
+import subprocess
+import tempfile
+import urllib.parse
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import pyAesCrypt
+
+from . import encryption
+
+BUFFER_SIZE = 1024 * 1024
+TEMP_SUFFIX = ".part"
+# Every file written by the pipeline gets a sidecar in the format of
+# sha256sum, so it can also be checked with "sha256sum -c"
+CHECKSUM_EXTENSION = ".sha256"
+
+def file_name(*parts):
+    # Dots separate the parts, so they must not appear in database or table names
+    return ".".join(urllib.parse.quote(part, safe="").replace(".", "%2E") for part in parts)
+
+def parse_file_name(name):
+    # The parts of a name built by file_name(), without extensions
+    return [urllib.parse.unquote(part) for part in name.split(".")]
+
+def disk_usage(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+class Reader:
+    # Base class of all pipeline stages. A stage pulls data from its source
+    # and transforms it on the fly. Like a regular file, read(size) only
+    # returns less than size bytes at the end of the stream. seconds is the
+    # time spent in read(), including the time the sources before it took.
+
+    def __init__(self, source):
+        self.source = source
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        self._buffer = bytearray()
+        self._eof = False
+
+    def read(self, size=-1):
+        started = time.monotonic()
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            self._fill()
+
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.bytes_out += len(data)
+        self.seconds += time.monotonic() - started
+        return data
+
+    def peek(self, size):
+        # Returns the next size bytes without consuming them
+        while not self._eof and len(self._buffer) < size:
+            self._fill()
+        return bytes(self._buffer[:size])
+
+    def _fill(self):
+        data = self.source.read(BUFFER_SIZE)
+        if data:
+            self.bytes_in += len(data)
+            self._buffer += self._process(data)
+        else:
+            self._buffer += self._finish()
+            self._eof = True
+
+    def _process(self, data):
+        return data
+
+    def _finish(self):
+        return b""
+
+def _completed(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+class HashReader(Reader):
+    # Passes the stream through and computes its SHA-256 on the way
+    def __init__(self, source):
+        super().__init__(source)
+        self.digest = hashlib.sha256()
+
+    def _process(self, data):
+        self.digest.update(data)
+        return data
+
+class EncryptReader(Reader):
+    # Seals the stream chunk by chunk (see encryption). With several threads
+    # the chunks are encrypted on a pool, in order of their position.
+
+    def __init__(self, source, passphrase, threads=1):
+        super().__init__(source)
+        self._cipher = encryption.new_cipher(passphrase)
+        self._threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self._pending = deque()
+        self._next = None
+        self._index = 0
+        self._source_eof = False
+        self._buffer += self._cipher.header
+
+    def _read_chunk(self):
+        data = self.source.read(self._cipher.chunk_size)
+        self.bytes_in += len(data)
+        return data
+
+    def _fill(self):
+        if self._next is None:
+            self._next = self._read_chunk()
+
+        while not self._source_eof and len(self._pending) < self._threads * 2:
+            data = self._next
+            # Only a full chunk can be followed by another one
+            self._next = self._read_chunk() if len(data) == self._cipher.chunk_size else b""
+            self._source_eof = not self._next
+            if self._executor:
+                self._pending.append(self._executor.submit(self._cipher.encrypt, self._index, data, self._source_eof))
+            else:
+                self._pending.append(_completed(self._cipher.encrypt(self._index, data, self._source_eof)))
+            self._index += 1
+
+        if self._pending:
+            self._buffer += self._pending.popleft().result()
+        else:
+            if self._executor:
+                self._executor.shutdown()
+            self._eof = True
+
+class DecryptReader(Reader):
+    # Opens files written by EncryptReader. Every chunk is verified before
+    # it is handed out, so nothing unauthenticated reaches the caller.
+
+    def __init__(self, source, passphrase, threads=1):
+        super().__init__(source)
+        self._cipher = encryption.read_cipher(self._read(encryption.HEADER_SIZE), passphrase)
+        self._chunk_size = self._cipher.chunk_size + encryption.TAG_SIZE
+        self._threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self._pending = deque()
+        self._next = None
+        self._index = 0
+        self._source_eof = False
+
+    def _read(self, size):
+        data = b""
+        while len(data) < size:
+            # Plain files may return less than requested
+            block = self.source.read(size - len(data))
+            if not block:
+                break
+            data += block
+        self.bytes_in += len(data)
+        return data
+
+    def _fill(self):
+        if self._next is None:
+            self._next = self._read(self._chunk_size)
+
+        while not self._source_eof and len(self._pending) < self._threads * 2:
+            data = self._next
+            self._next = self._read(self._chunk_size) if len(data) == self._chunk_size else b""
+            self._source_eof = not self._next
+            if self._executor:
+                self._pending.append(self._executor.submit(self._cipher.decrypt, self._index, data, self._source_eof))
+            else:
+                self._pending.append(_completed(self._cipher.decrypt(self._index, data, self._source_eof)))
+            self._index += 1
+
+        if self._pending:
+            self._buffer += self._pending.popleft().result()
+        else:
+            if self._executor:
+                self._executor.shutdown()
+            self._eof = True
+
+class _QueueWriter:
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, data):
+        self.queue.put(bytes(data))
+        return len(data)
+
+class LegacyDecryptReader(Reader):
+    # Opens .aes files written by pyAesCrypt. pyAesCrypt can only write to a
+    # file, so it runs on a thread that hands the plain text over.
+
+    def __init__(self, source, passphrase):
+        super().__init__(source)
+        self._queue = queue.Queue(maxsize=16)
+        self._error = None
+        self._thread = threading.Thread(target=self._decrypt, args=(passphrase,), daemon=True)
+        self._thread.start()
+
+    def _decrypt(self, passphrase):
+        try:
+            pyAesCrypt.decryptStream(self.source, _QueueWriter(self._queue), passphrase, BUFFER_SIZE)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._queue.put(None)
+
+    def _fill(self):
+        data = self._queue.get()
+        if data is None:
+            self._thread.join()
+            # pyAesCrypt reports wrong passphrases and corrupted files as
+            # ValueError, errors of the source are passed on unchanged
+            if isinstance(self._error, ValueError):
+                raise encryption.DecryptionError(str(self._error))
+            if self._error is not None:
+                raise self._error
+            self._eof = True
+        else:
+            self.bytes_in += len(data)
+            self._buffer += data
+
+def decrypt(source, passphrase, threads=1):
+    # Returns a reader with the plain text of an encrypted backup in either
+    # format. source is a file object opened in binary mode.
+    source = Reader(source)
+    if source.peek(len(encryption.MAGIC)).startswith(encryption.LEGACY_MAGIC):
+        return LegacyDecryptReader(source, passphrase)
+    return DecryptReader(source, passphrase, threads)
+
+def write(reader, target, passphrase="", source=None, timings=None, throttle=None):
+    # Writes the stream to a temporary file next to the target. The caller
+    # decides whether it is moved in place with commit() or thrown away.
+    # timings receives the time spent in the source (the dump), in the
+    # compression between source and reader and in encrypting and writing.
+    # throttle (see throttle.Throttle) limits the write rate. The checksum
+    # of the file is computed while it is written.
+    started = time.monotonic()
+    output = EncryptReader(reader, passphrase) if passphrase != "" else reader
+    temp_file = target + TEMP_SUFFIX
+    digest = hashlib.sha256()
+    with open(temp_file, "wb") as f:
+        while True:
+            data = output.read(BUFFER_SIZE)
+            if not data:
+                break
+            digest.update(data)
+            f.write(data)
+            if throttle is not None:
+                throttle.wrote(len(data))
+        f.flush()
+        os.fsync(f.fileno())
+    with open(target + CHECKSUM_EXTENSION + TEMP_SUFFIX, "w") as f:
+        f.write("{}  {}\n".format(digest.hexdigest(), os.path.basename(target)))
+
+    if timings is not None:
+        source = source or reader
+        timings["dump"] = timings.get("dump", 0.0) + source.seconds
+        if reader is not source:
+            timings["compress"] = timings.get("compress", 0.0) + reader.seconds - source.seconds
+        if output is not reader:
+            timings["encrypt"] = timings.get("encrypt", 0.0) + output.seconds - reader.seconds
+        timings["write"] = timings.get("write", 0.0) + time.monotonic() - started - output.seconds
+    return temp_file
+
+def commit(target):
+    os.replace(target + TEMP_SUFFIX, target)
+    if os.path.exists(target + CHECKSUM_EXTENSION + TEMP_SUFFIX):
+        os.replace(target + CHECKSUM_EXTENSION + TEMP_SUFFIX, target + CHECKSUM_EXTENSION)
+    return os.path.getsize(target)
+
+def discard(target):
+    for path in (target + TEMP_SUFFIX, target + CHECKSUM_EXTENSION + TEMP_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+def write_checksum(target, checksum):
+    with open(target + CHECKSUM_EXTENSION, "w") as f:
+        f.write("{}  {}\n".format(checksum, os.path.basename(target)))
+
+def read_checksum(target):
+    # The SHA-256 of the file target from its sidecar, None if it has none
+    try:
+        with open(target + CHECKSUM_EXTENSION) as f:
+            return f.read().split(maxsplit=1)[0]
+    except (OSError, IndexError):
+        return None
+
+class IterSource:
+    # Adapts an iterable of byte strings to the read() interface of a source
+
+    def __init__(self, chunks):
+        self._chunks = (chunk for chunk in chunks if chunk)
+
+    def read(self, size=-1):
+        return next(self._chunks, b"")
+
+def save(chunks, target, codec, passphrase="", timings=None, throttle=None):
+    # Same as run(), but the data is produced in-process
+    source = Reader(IterSource(chunks))
+    if throttle is not None:
+        source = throttle.reader(source)
+    try:
+        write(codec.reader(source), target, passphrase, source, timings, throttle)
+    except BaseException:
+        discard(target)
+        raise
+    return source.bytes_in, commit(target)
+
+def stream(command, consume, env=None, throttle=None):
+    # Runs the dump command and hands its stdout to consume(source). Raises
+    # CalledProcessError if the command fails. Returns the result of consume.
+    # throttle lowers the priority of the command and limits the read rate.
+    # A function in place of the command produces the source by itself and
+    # is called with consume.
+    if callable(command):
+        return command(consume)
+    if throttle is not None:
+        command = throttle.command(command)
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=stderr, env=env)
+        try:
+            source = Reader(process.stdout)
+            result = consume(throttle.reader(source) if throttle is not None else source)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            process.stdout.close()
+
+        returncode = process.wait()
+        if returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(returncode, command, output="",
+                                                stderr=stderr.read().decode(errors="replace"))
+    return result
+
+def run(command, target, codec, passphrase="", env=None, timings=None, throttle=None):
+    # Streams the stdout of the dump command through compression and
+    # encryption into the target file. Nothing but the target is written to
+    # disk. Returns the number of bytes read from the command and written to
+    # the target.
+    def consume(source):
+        write(codec.reader(source), target, passphrase, source, timings, throttle)
+        return source.bytes_in
+
+    try:
+        bytes_in = stream(command, consume, env, throttle)
+    except BaseException:
+        discard(target)
+        raise
+    return bytes_in, commit(target)
+
+def feed(command, reader, env=None):
+    # Counterpart of stream(): writes the reader to the stdin of command.
+    # Raises CalledProcessError if the command fails or stops reading early.
+    # Returns the number of bytes written.
+    size = 0
+    broken = False
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr, env=env)
+        try:
+            while True:
+                data = reader.read(BUFFER_SIZE)
+                if not data:
+                    break
+                process.stdin.write(data)
+                size += len(data)
+            process.stdin.close()
+        except BrokenPipeError:
+            # The command quit, its return code and output tell why
+            broken = True
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+
+        returncode = process.wait()
+        if returncode != 0 or broken:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(returncode or 1, command, output="",
+                                                stderr=stderr.read().decode(errors="replace"))
+    return size
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import shlex
+import shutil
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from . import pipeline
+from . import encryption
+from . import compression
+
+MANIFEST_FILE = "manifest.json"
+
+def _connection_args(host, database):
+    return "--host={} --port={} --username={}".format(host, database.port, database.username)
+
+def _compress_option(codec):
+    # pg_dump compresses every table file of the directory format itself
+    if codec.name == "zstd":
+        return "--compress=zstd:{}".format(codec.level)
+    elif codec.name == "gzip":
+        return "--compress={}".format(codec.level)
+    return "--compress=0"
+
+def list_databases(host, database, env):
+    # Largest first, so a big database doesn't end up alone at the end
+    output = subprocess.run(
+        ("psql {} --dbname=template1 --no-align --tuples-only --command="
+         "\"SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate ORDER BY pg_database_size(datname) DESC\"").format(
+            _connection_args(host, database)),
+        shell=True,
+        text=True,
+        capture_output=True,
+        env=env,
+    )
+    output.check_returncode()
+    return [line for line in output.stdout.splitlines() if line]
+
+def _dump_database(host, database, env, stage_dir, name, log_prefix, throttle=None):
+    directory = pipeline.file_name(name)
+    path = os.path.join(stage_dir, directory)
+    logging.debug(f"{log_prefix} Dumping database {name} with {database.jobs} job(s)...")
+    # pg_dump writes the files itself, so only its priority can be lowered
+    command = "pg_dump {} --format=directory --jobs={} {} --file={} --dbname={}".format(
+        _connection_args(host, database),
+        database.jobs,
+        _compress_option(database.codec),
+        shlex.quote(path),
+        shlex.quote(name))
+    subprocess.run(
+        throttle.command(command) if throttle is not None else command,
+        shell=True,
+        text=True,
+        capture_output=True,
+        env=env,
+    ).check_returncode()
+
+    size = pipeline.disk_usage(path)
+    entry = {"database": name, "format": "directory", "file": directory, "uncompressed_size": size, "size": size}
+
+    if database.encryption_passphrase != "":
+        # The table files are already compressed, so they are only packed
+        # and encrypted
+        entry["file"] = directory + ".tar" + encryption.EXTENSION
+        entry["uncompressed_size"], entry["size"] = pipeline.run(
+            "tar -cf - -C {} {}".format(shlex.quote(stage_dir), shlex.quote(directory)),
+            os.path.join(stage_dir, entry["file"]),
+            compression.get("none"),
+            database.encryption_passphrase,
+            env,
+            throttle=throttle)
+        shutil.rmtree(path)
+
+    return entry
+
+def dump(host, database, target, env, log_prefix="", throttle=None):
+    # Dumps the globals (roles, tablespaces) and every database of the
+    # cluster in the directory format of pg_dump into the directory target.
+    # Up to parallel_databases databases are dumped at once, each of them
+    # with jobs connections.
+    stage_dir = target + pipeline.TEMP_SUFFIX
+    os.makedirs(stage_dir)
+
+    started = time.time()
+    try:
+        databases = list_databases(host, database, env)
+        logging.debug(f"{log_prefix} Found {len(databases)} database(s)")
+
+        globals_file = "globals.sql" + database.codec.extension + (encryption.EXTENSION if database.encryption_passphrase != "" else "")
+        uncompressed_size, size = pipeline.run(
+            "pg_dumpall {} --globals-only".format(_connection_args(host, database)),
+            os.path.join(stage_dir, globals_file),
+            database.codec,
+            database.encryption_passphrase,
+            env,
+            throttle=throttle)
+        globals_entry = {"file": globals_file, "uncompressed_size": uncompressed_size, "size": size}
+
+        with ThreadPoolExecutor(max_workers=database.parallel_databases) as executor:
+            futures = [executor.submit(_dump_database, host, database, env, stage_dir, name, log_prefix, throttle) for name in databases]
+            entries = [future.result() for future in futures]
+
+        manifest = {
+            "engine": "parallel",
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "compression": database.codec.name,
+            "encrypted": database.encryption_passphrase != "",
+            "globals": globals_entry,
+            "databases": entries,
+        }
+        with open(os.path.join(stage_dir, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        os.rename(stage_dir, target)
+    except BaseException:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        raise
+
+    entries = [globals_entry] + entries
+    return sum(entry["uncompressed_size"] for entry in entries), sum(entry["size"] for entry in entries)
@@ -0,0 +1,168 @@
+import os
+import logging
+import datetime
+import threading
+import humanize
+
+from . import pipeline
+from . import compression
+from . import encryption
+from . import catalog
+from . import store
+from . import throttle
+from . import changes
+
+class Interrupted(Exception):
+    pass
+
+class _Stoppable(pipeline.Reader):
+    # Ends the stream as soon as the next backup cycle starts
+    def __init__(self, source, stopped):
+        super().__init__(source)
+        self._stopped = stopped
+
+    def _process(self, data):
+        if self._stopped.is_set():
+            raise Interrupted()
+        return data
+
+def _plain_name(name):
+    # The name without the extensions of compression and encryption
+    match = catalog.BACKUP_NAME_REGEX.match(name)
+    return name[:match.start(3)] if match.group(3) else name[:match.start(4)] if match.group(4) else name
+
+class Recompactor:
+    # Re-encodes backups older than recompact_after hours with a denser
+    # codec. It only runs between backup cycles, at idle CPU and I/O
+    # priority, and one file at a time: the new file is written next to the
+    # old one, read back and compared, and only then replaces it.
+    # passphrase(name) returns the passphrase of the backups of a container.
+
+    def __init__(self, config, passphrase=lambda name: ""):
+        self.config = config
+        self.codec = compression.get(config.recompact_codec, config.recompact_level, 1)
+        self.passphrase = passphrase
+        self._stopped = threading.Event()
+        self._thread = None
+        # Backups that failed are tried again after a restart
+        self._failed = set()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="recompact", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # The file in progress is thrown away
+        self._stopped.set()
+        self.join()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _candidates(self, backup_catalog):
+        # Hard links of one file (see change_detection) are recompacted
+        # together, so they still share it afterwards
+        deadline = datetime.datetime.now() - datetime.timedelta(hours=self.config.recompact_after)
+        groups = {}
+        for backup in backup_catalog.recompaction_candidates(deadline):
+            path = os.path.join(self.config.dump_dir, backup["name"])
+            if backup["name"] in self._failed or backup["name"].endswith(store.SNAPSHOT_EXTENSION) or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            groups.setdefault((stat.st_dev, stat.st_ino), []).append(backup)
+        return list(groups.values())
+
+    def _run(self):
+        throttle.idle_priority()
+        backup_catalog = catalog.get(self.config.dump_dir)
+        groups = self._candidates(backup_catalog)
+        if not groups:
+            return
+        logging.info(f"Recompact {len(groups)} backup(s) with {self.codec.name} level {self.codec.level}...")
+        count = 0
+        saved = 0
+        for backups in groups:
+            if self._stopped.is_set():
+                break
+            try:
+                saved += self.recompact(backup_catalog, backups)
+                count += 1
+            except Interrupted:
+                logging.info("Recompaction paused for the next backup cycle")
+                break
+            except Exception as e:
+                if self._stopped.is_set():
+                    # Cut off by the next cycle, the backup is fine
+                    logging.info("Recompaction paused for the next backup cycle")
+                    break
+                logging.error(f"Failed to recompact {backups[0]['name']}. Error Output: {e}")
+                self._failed.update(backup["name"] for backup in backups)
+        logging.info(f"Recompacted {count} backup(s), {humanize.naturalsize(saved)} saved")
+
+    def _decode(self, f, name, passphrase):
+        reader = _Stoppable(f, self._stopped)
+        if encryption.is_encrypted(name):
+            reader = pipeline.decrypt(reader, passphrase)
+            name = os.path.splitext(name)[0]
+        return compression.from_extension(os.path.splitext(name)[1]).decompressor(reader)
+
+    def recompact(self, backup_catalog, backups):
+        # Returns the bytes saved
+        name = backups[0]["name"]
+        path = os.path.join(self.config.dump_dir, name)
+        passphrase = ""
+        if encryption.is_encrypted(name):
+            passphrase = self.passphrase(backups[0]["container"])
+            if not passphrase:
+                raise ValueError("no passphrase for the container")
+        # Legacy .aes files are encrypted in the current format
+        new_name = _plain_name(name) + self.codec.extension + (encryption.EXTENSION if passphrase else "")
+        target = os.path.join(self.config.dump_dir, new_name)
+
+        try:
+            with open(path, "rb") as f:
+                plain = pipeline.HashReader(self._decode(f, name, passphrase))
+                pipeline.write(self.codec.reader(plain), target, passphrase)
+            with open(target + pipeline.TEMP_SUFFIX, "rb") as f:
+                check = pipeline.HashReader(self._decode(f, new_name, passphrase))
+                while check.read(pipeline.BUFFER_SIZE):
+                    pass
+            if check.digest.digest() != plain.digest.digest():
+                raise ValueError("the recompacted file doesn't match the backup")
+            old_size = os.path.getsize(path)
+            if os.path.getsize(target + pipeline.TEMP_SUFFIX) >= old_size and not name.endswith(encryption.LEGACY_EXTENSION):
+                # Already dense enough
+                pipeline.discard(target)
+                for backup in backups:
+                    backup_catalog.recompacted(backup["name"])
+                return 0
+        except BaseException:
+            pipeline.discard(target)
+            raise
+
+        size = pipeline.commit(target)
+        checksum = pipeline.read_checksum(target)
+        self._replace(backup_catalog, backups[0], target, size, checksum)
+        for backup in backups[1:]:
+            other = os.path.join(self.config.dump_dir, _plain_name(backup["name"]) + self.codec.extension + (encryption.EXTENSION if passphrase else ""))
+            if other != target:
+                changes._link_file(target, other + pipeline.TEMP_SUFFIX)
+                os.replace(other + pipeline.TEMP_SUFFIX, other)
+                pipeline.write_checksum(other, checksum)
+            self._replace(backup_catalog, backup, other, size, checksum)
+        logging.debug(f"Recompacted {name} from {humanize.naturalsize(old_size)} to {humanize.naturalsize(size)}")
+        return old_size - size
+
+    def _replace(self, backup_catalog, backup, target, size, checksum):
+        # The catalog points to the new file before the old one is removed
+        backup_catalog.recompacted(backup["name"], os.path.basename(target), size, self.codec.name, checksum)
+        old = os.path.join(self.config.dump_dir, backup["name"])
+        if old != target:
+            for path in (old, old + pipeline.CHECKSUM_EXTENSION):
+                if os.path.exists(path):
+                    os.remove(path)
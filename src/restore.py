@@ -0,0 +1,262 @@
+import os
+import re
+import json
+import shlex
+import shutil
+import logging
+import tempfile
+import itertools
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import DatabaseType
+from . import pipeline
+from . import compression
+from . import encryption
+from . import store
+
+MANIFEST_FILE = "manifest.json"
+
+# Where the dumps of mysqldump --all-databases and pg_dumpall switch to the
+# next database
+MYSQL_SECTION_REGEX = re.compile(rb"^-- Current Database: `((?:[^`]|``)+)`$", re.MULTILINE)
+POSTGRES_SECTION_REGEX = re.compile(rb'^-- Database "(.+)" dump$', re.MULTILINE)
+
+class RestoreError(Exception):
+    pass
+
+def _plain_name(name):
+    # The name without the extensions of encryption, store and compression
+    for extension in (encryption.EXTENSION, encryption.LEGACY_EXTENSION, store.SNAPSHOT_EXTENSION):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    root, extension = os.path.splitext(name)
+    return root if extension in compression.EXTENSIONS else name
+
+class SectionFilter(pipeline.Reader):
+    # Passes the part of a dump before the first database on, and the parts
+    # of the selected databases
+
+    def __init__(self, source, regex, databases, unquote=lambda name: name):
+        super().__init__(source)
+        self._regex = regex
+        self._databases = set(databases)
+        self._unquote = unquote
+        self._keep = True
+        self._partial = b""
+
+    def _select(self, data):
+        output = []
+        position = 0
+        for match in self._regex.finditer(data):
+            if self._keep:
+                output.append(data[position:match.start()])
+            self._keep = self._unquote(match.group(1).decode()) in self._databases
+            position = match.start()
+        if self._keep:
+            output.append(data[position:])
+        return b"".join(output)
+
+    def _process(self, data):
+        # Only whole lines, so a marker is never split
+        data = self._partial + data
+        end = data.rfind(b"\n") + 1
+        self._partial = data[end:]
+        return self._select(data[:end])
+
+    def _finish(self):
+        return self._select(self._partial)
+
+class Restore:
+    # Restores one backup into the database of a container. host is the alias
+    # of the container on the helper network.
+
+    def __init__(self, host, database, passphrase="", jobs=None, databases=(), log_prefix=""):
+        self.host = host
+        self.database = database
+        self.passphrase = passphrase
+        self.jobs = jobs or database.jobs
+        self.databases = list(databases)
+        self.log_prefix = log_prefix
+        self.env = os.environ.copy()
+        if database.type == DatabaseType.postgres:
+            self.env["PGPASSWORD"] = database.password
+
+    @contextlib.contextmanager
+    def _open(self, path):
+        # The plain content of a backup file: decrypted and decompressed on
+        # the fly, or put together from the chunks of the store
+        name = os.path.basename(path)
+        if name.endswith(store.SNAPSHOT_EXTENSION):
+            with open(path) as f:
+                encrypted = json.load(f).get("encrypted")
+            chunks = store.get(os.path.dirname(path)).read(path, self.passphrase if encrypted else "")
+            yield pipeline.Reader(pipeline.IterSource(chunks))
+            return
+
+        with open(path, "rb") as f:
+            reader = pipeline.Reader(f)
+            if encryption.is_encrypted(name):
+                if self.passphrase == "":
+                    raise RestoreError(f"{name} is encrypted, but no passphrase was given")
+                reader = pipeline.decrypt(f, self.passphrase, os.cpu_count() or 1)
+                name = os.path.splitext(name)[0]
+            yield compression.from_extension(os.path.splitext(name)[1]).decompressor(reader)
+
+    def _feed(self, command, path, prefix=b""):
+        with self._open(path) as content:
+            reader = content
+            if prefix:
+                reader = pipeline.Reader(pipeline.IterSource(itertools.chain([prefix], iter(lambda: content.read(pipeline.BUFFER_SIZE), b""))))
+            return pipeline.feed(command, reader, self.env)
+
+    def _mysql(self, schema=None):
+        return "mysql --host={} --port={} --user={} --password='{}'{}".format(
+            self.host, self.database.port, self.database.username, self.database.password,
+            " --database={}".format(shlex.quote(schema)) if schema else "")
+
+    def _psql(self, dbname="postgres"):
+        return "psql --host={} --port={} --username={} --quiet --dbname={}".format(
+            self.host, self.database.port, self.database.username, shlex.quote(dbname))
+
+    def _influx(self, path, bucket=None):
+        return "influx restore --host http://{}:{} --token {}{} {}".format(
+            self.host, self.database.port, self.database.token,
+            " --bucket {}".format(shlex.quote(bucket)) if bucket else "", path)
+
+    def run(self, path):
+        # Returns the number of bytes handed to the database clients
+        name = os.path.basename(path)
+        if os.path.isdir(path):
+            with open(os.path.join(path, MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+            if "binlog_position" in manifest:
+                return self._mysql_directory(path, manifest)
+            return self._postgres_directory(path, manifest)
+        if _plain_name(name).endswith(".tar") and self.database.type == DatabaseType.postgres:
+            raise RestoreError(f"{name} is a base backup of the data directory, it is restored into a stopped database (see Continuous Backups)")
+        if _plain_name(name).endswith(".tar"):
+            return self._influx_archive(path)
+        if self.database.type in (DatabaseType.mysql, DatabaseType.mariadb):
+            return self._sql(path, self._mysql(), MYSQL_SECTION_REGEX, lambda name: name.replace("``", "`"))
+        if self.database.type == DatabaseType.postgres:
+            return self._sql(path, self._psql(), POSTGRES_SECTION_REGEX)
+        raise RestoreError(f"Cannot restore {name} into a {self.database.type.name} database")
+
+    def replay(self, files, position, until=None):
+        # Applies the plain binary log files, in order, from position on to a
+        # restored dump. until is a datetime, the events after it are left out.
+        if self.database.type not in (DatabaseType.mysql, DatabaseType.mariadb):
+            raise RestoreError(f"Cannot replay a binary log into a {self.database.type.name} database")
+        command = "mysqlbinlog --start-position={}{} {}".format(
+            position.rpartition(":")[2],
+            " --stop-datetime='{}'".format(until.strftime("%Y-%m-%d %H:%M:%S")) if until is not None else "",
+            " ".join(shlex.quote(file) for file in files))
+        logging.debug(f"{self.log_prefix} Replay {len(files)} binary log file(s)...")
+        return pipeline.stream(command, lambda source: pipeline.feed(self._mysql(), source, self.env), self.env)
+
+    def _sql(self, path, command, regex, unquote=lambda name: name):
+        # A dump of all databases is fed to the client in one stream
+        with self._open(path) as reader:
+            if self.databases:
+                reader = SectionFilter(reader, regex, self.databases, unquote)
+            return pipeline.feed(command, reader, self.env)
+
+    def _parallel(self, function, items, workers):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return sum(executor.map(function, items))
+
+    def _mysql_directory(self, path, manifest):
+        # Databases and tables first, then the data files on jobs
+        # connections at once, then the views, which may use the tables
+        if self.database.type not in (DatabaseType.mysql, DatabaseType.mariadb):
+            raise RestoreError(f"Cannot restore a MySQL backup into a {self.database.type.name} database")
+        extension = ".sql" + compression.get(manifest["compression"]).extension + (encryption.EXTENSION if manifest["encrypted"] else "")
+        selected = lambda schema: not self.databases or schema in self.databases
+        schemas, tables, views = [], [], []
+        for entry in manifest["schema_files"]:
+            base = entry["file"][:-len(extension)]
+            for suffix, target in (("-schema-create", schemas), ("-schema-view", views), ("-schema", tables)):
+                if base.endswith(suffix):
+                    parts = pipeline.parse_file_name(base[:-len(suffix)])
+                    if selected(parts[0]):
+                        target.append((parts, entry["file"]))
+                    break
+
+        size = 0
+        for (schema,), file in schemas:
+            logging.debug(f"{self.log_prefix} Create database {schema}...")
+            with self._open(os.path.join(path, file)) as reader:
+                statement = reader.read().replace(b"CREATE DATABASE ", b"CREATE DATABASE IF NOT EXISTS ", 1)
+            size += pipeline.feed(self._mysql(), pipeline.Reader(pipeline.IterSource([statement])), self.env)
+
+        def create(item, kind="TABLE"):
+            (schema, table), file = item
+            prefix = "SET FOREIGN_KEY_CHECKS=0;\nDROP {} IF EXISTS `{}`;\n".format(kind, table.replace("`", "``")).encode()
+            return self._feed(self._mysql(schema), os.path.join(path, file), prefix)
+
+        size += self._parallel(create, tables, self.jobs)
+        data = [entry for entry in manifest["data_files"] if selected(entry["database"])]
+        logging.debug(f"{self.log_prefix} Load {len(data)} data file(s) on {self.jobs} connection(s)...")
+        size += self._parallel(lambda entry: self._feed(self._mysql(entry["database"]), os.path.join(path, entry["file"])), data, self.jobs)
+        size += sum(create(item, "VIEW") for item in views)
+        return size
+
+    def _postgres_directory(self, path, manifest):
+        # The globals first, then up to parallel_databases databases at once,
+        # each with jobs connections
+        if self.database.type != DatabaseType.postgres:
+            raise RestoreError(f"Cannot restore a PostgreSQL backup into a {self.database.type.name} database")
+        size = 0
+        if not self.databases:
+            size += self._feed(self._psql(), os.path.join(path, manifest["globals"]["file"]))
+        entries = [entry for entry in manifest["databases"] if not self.databases or entry["database"] in self.databases]
+        return size + self._parallel(lambda entry: self._pg_restore(path, entry), entries, self.database.parallel_databases)
+
+    def _pg_restore(self, path, entry):
+        logging.debug(f"{self.log_prefix} Restore database {entry['database']} with {self.jobs} job(s)...")
+        command = "pg_restore --host={} --port={} --username={} --jobs={} --clean --if-exists --create --dbname=postgres {{}}".format(
+            self.host, self.database.port, self.database.username, self.jobs)
+        source = os.path.join(path, entry["file"])
+        if os.path.isdir(source):
+            self._run(command.format(shlex.quote(source)))
+            return pipeline.disk_usage(source)
+
+        # pg_restore reads the directory format only from disk, so an
+        # encrypted database is unpacked next to the backup first
+        stage_dir = tempfile.mkdtemp(prefix=".restore-", dir=path)
+        try:
+            size = self._feed("tar -xf - -C {}".format(shlex.quote(stage_dir)), source)
+            directory = os.path.join(stage_dir, pipeline.file_name(entry["database"]))
+            self._run(command.format(shlex.quote(directory)))
+        finally:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+        return size
+
+    def _influx_archive(self, path):
+        # influx restore only reads a directory, so the archive is unpacked
+        # next to the backup first. Buckets are restored at the same time.
+        if self.database.type != DatabaseType.influxdb:
+            raise RestoreError(f"Cannot restore an InfluxDB backup into a {self.database.type.name} database")
+        stage_dir = tempfile.mkdtemp(prefix=".restore-", dir=os.path.dirname(path))
+        try:
+            size = self._feed("tar -xf - -C {}".format(shlex.quote(stage_dir)), path)
+            entries = sorted(os.scandir(stage_dir), key=lambda entry: entry.name)
+            if entries and all(entry.is_dir() for entry in entries):
+                # A directory per bucket, up to parallel_databases at once
+                buckets = [(pipeline.parse_file_name(entry.name)[0], entry.path) for entry in entries]
+                buckets = [bucket for bucket in buckets if not self.databases or bucket[0] in self.databases]
+                logging.debug(f"{self.log_prefix} Restore {len(buckets)} bucket(s)...")
+                self._parallel(lambda bucket: self._run(self._influx(shlex.quote(bucket[1]))), buckets, self.database.parallel_databases)
+            elif self.databases:
+                self._parallel(lambda bucket: self._run(self._influx(stage_dir, bucket)), self.databases, self.jobs)
+            else:
+                self._run(self._influx(stage_dir))
+        finally:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+        return size
+
+    def _run(self, command):
+        subprocess.run(command, shell=True, text=True, capture_output=True, env=self.env).check_returncode()
+        return 0
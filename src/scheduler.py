@@ -0,0 +1,103 @@
+import hashlib
+import datetime
+import logging
+import threading
+from croniter import croniter
+
+class Job:
+    def __init__(self, key, name, schedule, offset):
+        self.key = key
+        self.name = name
+        self.schedule = schedule
+        self.offset = offset
+        self.tick = None
+        self.next_run = None
+
+class Scheduler:
+    # Keeps the next run of every container. A run belongs to a tick of its
+    # cron schedule, but starts a fixed, per container offset of up to jitter
+    # seconds later. The offset is derived from the container name, so it
+    # stays the same across restarts and spreads the load over the window.
+
+    def __init__(self, jitter=0, startup=False):
+        self.jitter = jitter
+        self.startup = startup
+        self.jobs = {}
+        self.wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def offset(self, name):
+        if self.jitter <= 0:
+            return datetime.timedelta()
+        digest = hashlib.sha256(name.encode()).digest()
+        return datetime.timedelta(seconds=int.from_bytes(digest[:8], "big") % (self.jitter + 1))
+
+    def _schedule(self, job, base, now):
+        job.tick = croniter(job.schedule, base).get_next(datetime.datetime)
+        job.next_run = job.tick + job.offset
+        skipped = 0
+        while job.next_run <= now - datetime.timedelta(minutes=1):
+            # The process was busy or asleep for a long time. Don't catch up
+            # with every missed run, only with the latest one.
+            job.tick = croniter(job.schedule, job.tick).get_next(datetime.datetime)
+            job.next_run = job.tick + job.offset
+            skipped += 1
+        if skipped:
+            logging.warning(f"[{job.name}] Skipped {skipped} missed run(s)")
+
+    def update(self, entries, now=None):
+        # entries maps a key to (name, schedule). New jobs are added, gone
+        # ones removed and changed schedules recalculated. Returns the
+        # removed jobs.
+        now = now or datetime.datetime.now()
+        removed = []
+        with self._lock:
+            for key in list(self.jobs):
+                if key not in entries or entries[key] != (self.jobs[key].name, self.jobs[key].schedule):
+                    removed.append(self.jobs.pop(key))
+
+            for key, (name, schedule) in entries.items():
+                if key in self.jobs:
+                    continue
+
+                job = Job(key, name, schedule, self.offset(name))
+                if self.startup:
+                    job.tick = now
+                    job.next_run = now + job.offset
+                else:
+                    self._schedule(job, now - job.offset, now)
+                self.jobs[key] = job
+                logging.debug(f"[{name}] Next backup will be at {job.next_run} (schedule '{schedule}')")
+            self.startup = False
+        return removed
+
+    def next_run(self):
+        with self._lock:
+            if not self.jobs:
+                return None
+            return min(job.next_run for job in self.jobs.values())
+
+    def pop_due(self, now=None):
+        # Returns the due jobs as (job, tick, members) and moves them to their
+        # next run. members are the keys of all jobs that share the schedule
+        # and tick, including the ones whose offset isn't reached yet.
+        now = now or datetime.datetime.now()
+        due = []
+        with self._lock:
+            members = {}
+            for job in self.jobs.values():
+                members.setdefault((job.schedule, job.tick), set()).add(job.key)
+            for job in self.jobs.values():
+                if job.next_run <= now:
+                    due.append((job, job.tick, members[(job.schedule, job.tick)]))
+                    self._schedule(job, job.tick, now)
+        return due
+
+    def wait(self, timeout):
+        # Sleeps until the timeout or until someone calls notify(). Without
+        # a timeout it only wakes up on notify().
+        self.wakeup.wait(None if timeout is None else max(0, timeout))
+        self.wakeup.clear()
+
+    def notify(self):
+        self.wakeup.set()
@@ -1,9 +1,17 @@
 import os
+import re
+import urllib.parse
 import distutils.util
 from croniter import croniter
 import logging
 
+from . import compression
+
 LABEL_PREFIX = "foorschtbar.pyd2b2."
+RATE_REGEX = re.compile(r"^(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?$", re.IGNORECASE)
+RATE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+# Level of the recompaction if RECOMPACT_LEVEL is auto, slow but dense
+RECOMPACT_LEVELS = {"gzip": 9, "zstd": 19}
 
 CONFIG_DEFAULTS = {
     "debug": "false",
@@ -19,6 +27,24 @@ CONFIG_DEFAULTS = {
     "keep_min": "20",
     "delete_days": "14",
     "container_filter":"",
+    "max_parallel": "1",
+    "max_parallel_per_host": "0",
+    "schedule_jitter": "0",
+    "metrics_port": "0",
+    "metrics_file": ".metrics.jsonl",
+    "upload_targets": "",
+    "upload_parallel": "2",
+    "upload_retries": "3",
+    "max_read_rate": "0",
+    "max_write_rate": "0",
+    "max_compress_threads": "0",
+    "overrun": "warn",
+    "docker_hosts": "",
+    "recompact_after": "0",
+    "recompact_codec": "zstd",
+    "recompact_level": "auto",
+    "notify_retries": "3",
+    "notify_queue_size": "100",
 }
 
 LABEL_DEFAULTS = {
@@ -29,7 +55,25 @@ LABEL_DEFAULTS = {
     "type": "auto",
     "port": "auto",
     "compress": "true",
+    "compress_level": "auto",
+    "compress_threads": "auto",
     "encryption_passphrase": "",
+    "engine": "default",
+    "jobs": "4",
+    "chunk_rows": "1000000",
+    "parallel_databases": "2",
+    "storage": "files",
+    "schedule": "",
+    "read_limit": "0",
+    "write_limit": "0",
+    "nice": "0",
+    "ionice": "none",
+    "adaptive_throttle": "false",
+    "change_detection": "off",
+    "max_skip_age": "24",
+    "continuous": "false",
+    "continuous_interval": "300",
+    "hc_uuid": "",
 }
 
 class Config:
@@ -64,6 +108,10 @@ class Config:
 
         self.startup = distutils.util.strtobool(values["startup"])
 
+        self.schedule_jitter = int(values["schedule_jitter"])
+        if self.schedule_jitter < 0:
+            raise AttributeError("Invalid schedule_jitter value")
+
         if self.schedule:
             self.singlerun = False
         else: 
@@ -71,6 +119,98 @@ class Config:
 
         self.helper_network_name = str(values["helper_network_name"])
 
+        self.max_parallel = int(values["max_parallel"])
+        if self.max_parallel < 1:
+            raise AttributeError("Invalid max_parallel value")
+
+        self.max_parallel_per_host = int(values["max_parallel_per_host"])
+        if self.max_parallel_per_host < 0:
+            raise AttributeError("Invalid max_parallel_per_host value")
+
+        self.metrics_port = int(values["metrics_port"])
+        if self.metrics_port < 0 or self.metrics_port > 65535:
+            raise AttributeError("Invalid metrics_port value")
+
+        # Relative to the dump directory, empty disables the cycle records
+        self.metrics_file = str(values["metrics_file"]).strip()
+        if self.metrics_file:
+            self.metrics_file = os.path.join(self.dump_dir, self.metrics_file)
+
+        self.upload_targets = [x.strip() for x in str(values["upload_targets"]).split(",") if x.strip()]
+
+        self.upload_parallel = int(values["upload_parallel"])
+        if self.upload_parallel < 1:
+            raise AttributeError("Invalid upload_parallel value")
+
+        self.upload_retries = int(values["upload_retries"])
+        if self.upload_retries < 1:
+            raise AttributeError("Invalid upload_retries value")
+
+        # Shared by all backups, per container limits come from labels
+        self.max_read_rate = parse_rate(values["max_read_rate"], "max_read_rate")
+        self.max_write_rate = parse_rate(values["max_write_rate"], "max_write_rate")
+
+        self.max_compress_threads = int(values["max_compress_threads"])
+        if self.max_compress_threads < 0:
+            raise AttributeError("Invalid max_compress_threads value")
+
+        # What happens when a cycle is due while the previous one of the
+        # same schedule still runs
+        self.overrun = str(values["overrun"]).strip().lower()
+        if self.overrun not in ("warn", "skip"):
+            raise AttributeError("Invalid overrun value")
+
+        # Empty means the local Docker socket only
+        self.docker_hosts = parse_hosts(values["docker_hosts"])
+
+        # Hours after which backups are re-encoded with the denser codec, 0
+        # turns the recompaction off
+        self.recompact_after = int(values["recompact_after"])
+        if self.recompact_after < 0:
+            raise AttributeError("Invalid recompact_after value")
+
+        self.recompact_codec = str(values["recompact_codec"]).strip().lower()
+        if self.recompact_codec not in RECOMPACT_LEVELS:
+            raise AttributeError("Invalid recompact_codec value")
+        if str(values["recompact_level"]).strip().lower() == "auto":
+            self.recompact_level = RECOMPACT_LEVELS[self.recompact_codec]
+        else:
+            self.recompact_level = int(values["recompact_level"])
+        codec = compression.CODECS[self.recompact_codec]
+        if not codec.min_level <= self.recompact_level <= codec.max_level:
+            raise AttributeError("Invalid recompact_level value {} for {} ({}-{})".format(
+                self.recompact_level, codec.name, codec.min_level, codec.max_level))
+
+        self.notify_retries = int(values["notify_retries"])
+        if self.notify_retries < 1:
+            raise AttributeError("Invalid notify_retries value")
+        self.notify_queue_size = int(values["notify_queue_size"])
+        if self.notify_queue_size < 1:
+            raise AttributeError("Invalid notify_queue_size value")
+
+def parse_hosts(value):
+    # Comma-separated [name=]url entries. Remote hosts are named after their
+    # address by default, the local socket has no name.
+    hosts = []
+    for entry in [x.strip() for x in str(value).split(",") if x.strip()]:
+        name, url = entry.split("=", 1) if "=" in entry else ("", entry)
+        if not url.startswith(("unix://", "tcp://", "ssh://")):
+            raise AttributeError("Invalid docker_hosts value")
+        if not name and not url.startswith("unix://"):
+            name = urllib.parse.urlparse(url).hostname
+        hosts.append((name.strip(), url))
+    if len({name for name, _ in hosts}) != len(hosts):
+        raise AttributeError("Invalid docker_hosts value, host names must be unique")
+    return hosts
+
+def parse_rate(value, name):
+    # Bytes per second like 512K, 20M or 1.5G. 0 means no limit.
+    matches = RATE_REGEX.match(str(value).strip())
+    if not matches:
+        raise AttributeError("Invalid {} value".format(name))
+    rate = int(float(matches.group(1)) * RATE_UNITS[matches.group(2).lower()])
+    return rate if rate > 0 else None
+
 def read():
     config_values = {}
     label_values = {}
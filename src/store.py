@@ -0,0 +1,256 @@
+import os
+import hmac
+import json
+import time
+import zlib
+import random
+import hashlib
+import logging
+import threading
+import zstandard
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from . import pipeline
+
+STORE_DIR = ".store"
+SNAPSHOT_EXTENSION = ".snap"
+CONFIG_FILE = "config.json"
+VERSION = 1
+
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+SEARCH_WINDOW = 1024 * 1024
+# Chunks nobody references are only deleted after this time, so chunks of a
+# backup that is still running are not collected
+GC_GRACE_SECONDS = 24 * 60 * 60
+
+# Content-defined chunking: every byte is mapped to the parity of its bits
+# and a chunk ends behind the first occurrence of a fixed 18 bit pattern. The
+# boundaries only depend on the surrounding bytes, so an insertion only
+# changes the chunks around it. translate() and find() run at C speed.
+_PARITY = bytes(ord("a") + (bin(b).count("1") & 1) for b in range(256))
+_PATTERN = bytes(ord("a") + random.Random(0x9d2b2).randrange(2) for _ in range(18))
+
+_CODECS = {"none": 0, "gzip": 1, "zstd": 2}
+_HEADER_SIZE = 3
+_NONCE_SIZE = 12
+
+def _cut(buffer, eof):
+    if len(buffer) <= MIN_CHUNK_SIZE:
+        return len(buffer) if eof else None
+
+    end = min(len(buffer), MAX_CHUNK_SIZE)
+    start = MIN_CHUNK_SIZE - len(_PATTERN)
+    while start <= end - len(_PATTERN):
+        stop = min(end, start + SEARCH_WINDOW + len(_PATTERN))
+        found = buffer[start:stop].translate(_PARITY).find(_PATTERN)
+        if found >= 0:
+            return start + found + len(_PATTERN)
+        start = stop - len(_PATTERN) + 1
+
+    if len(buffer) >= MAX_CHUNK_SIZE:
+        return MAX_CHUNK_SIZE
+    return len(buffer) if eof else None
+
+def chunks(source):
+    buffer = bytearray()
+    eof = False
+    while buffer or not eof:
+        while not eof and len(buffer) < MAX_CHUNK_SIZE:
+            data = source.read(pipeline.BUFFER_SIZE)
+            if data:
+                buffer += data
+            else:
+                eof = True
+
+        if not buffer:
+            break
+        cut = _cut(buffer, eof)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+class Keys:
+    def __init__(self, id_key, encryption_key):
+        self.id_key = id_key
+        self.aead = AESGCM(encryption_key) if encryption_key else None
+
+class Store:
+    def __init__(self, dump_dir):
+        self.root = os.path.join(dump_dir, STORE_DIR)
+        self.chunk_dir = os.path.join(self.root, "chunks")
+        self._keys = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.chunk_dir, exist_ok=True)
+
+        config_file = os.path.join(self.root, CONFIG_FILE)
+        try:
+            with open(config_file, "x") as f:
+                json.dump({"version": VERSION, "salt": os.urandom(16).hex()}, f)
+        except FileExistsError:
+            pass
+        with open(config_file) as f:
+            self.salt = bytes.fromhex(json.load(f)["salt"])
+
+    def keys(self, passphrase):
+        # Key derivation is expensive on purpose, so it only runs once per
+        # passphrase. Chunks of encrypted backups are named by a keyed hash,
+        # so the names don't reveal anything about their content.
+        with self._lock:
+            if passphrase not in self._keys:
+                if passphrase == "":
+                    self._keys[passphrase] = Keys(None, None)
+                else:
+                    key = hashlib.scrypt(passphrase.encode(), salt=self.salt, n=2**15, r=8, p=1, maxmem=64 * 1024 * 1024, dklen=64)
+                    self._keys[passphrase] = Keys(key[:32], key[32:])
+            return self._keys[passphrase]
+
+    def _path(self, chunk_id):
+        return os.path.join(self.chunk_dir, chunk_id[:2], chunk_id)
+
+    def _chunk_id(self, data, keys):
+        if keys.id_key:
+            return hmac.new(keys.id_key, data, hashlib.sha256).hexdigest()
+        return hashlib.sha256(data).hexdigest()
+
+    def _encode(self, chunk_id, data, codec, keys):
+        if codec.name == "gzip":
+            payload = zlib.compress(data, codec.level)
+        elif codec.name == "zstd":
+            payload = zstandard.ZstdCompressor(level=codec.level).compress(data)
+        else:
+            payload = data
+        header = bytes([VERSION, _CODECS[codec.name], 1 if keys.aead else 0])
+        if keys.aead:
+            nonce = os.urandom(_NONCE_SIZE)
+            payload = nonce + keys.aead.encrypt(nonce, payload, header + chunk_id.encode())
+        return header + payload
+
+    def _decode(self, chunk_id, blob, keys):
+        header, payload = blob[:_HEADER_SIZE], blob[_HEADER_SIZE:]
+        if header[2]:
+            if not keys.aead:
+                raise ValueError("Chunk {} is encrypted, but no passphrase was given".format(chunk_id))
+            payload = keys.aead.decrypt(payload[:_NONCE_SIZE], payload[_NONCE_SIZE:], header + chunk_id.encode())
+        if header[1] == _CODECS["gzip"]:
+            data = zlib.decompress(payload)
+        elif header[1] == _CODECS["zstd"]:
+            data = zstandard.ZstdDecompressor().decompress(payload)
+        else:
+            data = payload
+        if self._chunk_id(data, keys) != chunk_id:
+            raise ValueError("Chunk {} is corrupted".format(chunk_id))
+        return data
+
+    def _put(self, data, codec, keys, throttle=None):
+        chunk_id = self._chunk_id(data, keys)
+        path = self._path(chunk_id)
+        if os.path.exists(path):
+            return chunk_id, len(data), 0
+
+        blob = self._encode(chunk_id, data, codec, keys)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = "{}.{}{}".format(path, threading.get_ident(), pipeline.TEMP_SUFFIX)
+        with open(temp_file, "wb") as f:
+            f.write(blob)
+        if throttle is not None:
+            throttle.wrote(len(blob))
+        os.replace(temp_file, path)
+        return chunk_id, len(data), len(blob)
+
+    def save(self, source, snapshot, codec, passphrase="", throttle=None):
+        # Splits the stream into chunks and stores the ones that are not in
+        # the store yet. The snapshot file lists the chunks of the stream.
+        # Returns the size of the stream and the number of bytes newly
+        # written to the store.
+        keys = self.keys(passphrase)
+        entries = []
+        size = 0
+        written = 0
+
+        with ThreadPoolExecutor(max_workers=codec.threads) as executor:
+            pending = deque()
+            for chunk in chunks(source):
+                pending.append(executor.submit(self._put, chunk, codec, keys, throttle))
+                while len(pending) > codec.threads * 2:
+                    entries.append(pending.popleft().result())
+            while pending:
+                entries.append(pending.popleft().result())
+
+        for _, chunk_size, chunk_written in entries:
+            size += chunk_size
+            written += chunk_written
+
+        manifest = {
+            "version": VERSION,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "size": size,
+            "compression": codec.name,
+            "encrypted": keys.aead is not None,
+            "chunks": [[chunk_id, chunk_size] for chunk_id, chunk_size, _ in entries],
+        }
+        temp_file = snapshot + pipeline.TEMP_SUFFIX
+        with open(temp_file, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_file, snapshot)
+
+        new_chunks = sum(1 for entry in entries if entry[2] > 0)
+        logging.debug("Stored {} of {} chunk(s) ({} bytes of {})".format(new_chunks, len(entries), written, size))
+        return size, written
+
+    def read(self, snapshot, passphrase=""):
+        # Yields the content of a snapshot chunk by chunk
+        keys = self.keys(passphrase)
+        with open(snapshot) as f:
+            manifest = json.load(f)
+        for chunk_id, _ in manifest["chunks"]:
+            with open(self._path(chunk_id), "rb") as f:
+                yield self._decode(chunk_id, f.read(), keys)
+
+    def missing(self, snapshot):
+        # Chunks of a snapshot that are not in the store
+        with open(snapshot) as f:
+            manifest = json.load(f)
+        return [chunk_id for chunk_id, _ in manifest["chunks"] if not os.path.isfile(self._path(chunk_id))]
+
+    def collect_garbage(self, dump_dir):
+        # Counts the references of all snapshots and deletes the chunks
+        # nobody references anymore
+        references = Counter()
+        for root, dirs, files in os.walk(dump_dir):
+            if root == dump_dir and STORE_DIR in dirs:
+                dirs.remove(STORE_DIR)
+            for f in files:
+                if f.endswith(SNAPSHOT_EXTENSION):
+                    with open(os.path.join(root, f)) as snapshot:
+                        references.update(chunk_id for chunk_id, _ in json.load(snapshot)["chunks"])
+
+        deadline = time.time() - GC_GRACE_SECONDS
+        deleted = 0
+        freed = 0
+        for root, _, files in os.walk(self.chunk_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                if references[f] > 0:
+                    continue
+                stat = os.stat(path)
+                if stat.st_mtime > deadline:
+                    continue
+                try:
+                    os.remove(path)
+                    deleted += 1
+                    freed += stat.st_size
+                except OSError:
+                    logging.exception(f"Failed to delete chunk {path}")
+
+        return len(references), deleted, freed
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get(dump_dir):
+    with _stores_lock:
+        if dump_dir not in _stores:
+            _stores[dump_dir] = Store(dump_dir)
+        return _stores[dump_dir]
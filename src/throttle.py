@@ -0,0 +1,209 @@
+import os
+import time
+import shutil
+import subprocess
+import socket
+import logging
+import threading
+
+from .pipeline import Reader
+
+IONICE_CLASSES = {"none": None, "idle": "3", "best-effort": "2"}
+
+# Adaptive mode: the container is probed every PROBE_SECONDS. The read rate
+# is halved when the latency is above BACKOFF_FACTOR times the latency
+# before the backup and raised again by RECOVER_FACTOR once it is back to
+# normal.
+PROBE_SECONDS = 2
+PROBE_TIMEOUT = 5
+BASELINE_PROBES = 3
+BACKOFF_FACTOR = 2.0
+RECOVER_FACTOR = 1.25
+MIN_RATE = 1024 * 1024
+
+class RateLimiter:
+    # Token bucket that allows bursts of up to one second. Several streams
+    # can share one limiter.
+
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._tokens = rate or 0
+        self._updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        with self._lock:
+            self._rate = rate
+            if rate is not None:
+                self._tokens = min(self._tokens, rate)
+
+    def consume(self, size):
+        with self._lock:
+            if self._rate is None:
+                return
+            now = time.monotonic()
+            self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= size
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class ThrottledReader(Reader):
+    def __init__(self, source, limiters):
+        super().__init__(source)
+        self._limiters = limiters
+
+    def _process(self, data):
+        for limiter in self._limiters:
+            limiter.consume(len(data))
+        return data
+
+def _probe(host, port, type):
+    # Time until the database answers, without logging in. MySQL sends its
+    # greeting right away, PostgreSQL answers an SSL request and InfluxDB a
+    # ping.
+    started = time.monotonic()
+    with socket.create_connection((host, port), timeout=PROBE_TIMEOUT) as connection:
+        if type == "postgres":
+            connection.sendall(b"\x00\x00\x00\x08\x04\xd2\x16\x2f")
+        elif type == "influxdb":
+            connection.sendall(b"GET /ping HTTP/1.0\r\n\r\n")
+        connection.recv(1)
+    return time.monotonic() - started
+
+class Throttle:
+    # Limits of one backup: the read and write rates (the own ones of the
+    # container and the global ones shared by all backups), the priority of
+    # the spawned tools and the adaptive back off.
+
+    _nice = shutil.which("nice")
+    _ionice = shutil.which("ionice")
+
+    def __init__(self, read_limiters=(), write_limiters=(), nice=0, ionice="none", adaptive=False, log_prefix=""):
+        self.read_limiters = [limiter for limiter in read_limiters if limiter.rate is not None]
+        self.write_limiters = [limiter for limiter in write_limiters if limiter.rate is not None]
+        self.nice = nice
+        self.ionice = ionice
+        self.log_prefix = log_prefix
+        self._adaptive = None
+        self._readers = []
+        self._stopped = threading.Event()
+        self._thread = None
+        if adaptive:
+            # Starts without a limit of its own and never goes above the
+            # limit of the container
+            self._ceiling = min((limiter.rate for limiter in self.read_limiters), default=None)
+            self._adaptive = RateLimiter()
+            self.read_limiters.append(self._adaptive)
+
+    def command(self, command):
+        # Prefixes a shell command with nice and ionice, if they are installed
+        prefix = ""
+        if self.nice and self._nice:
+            prefix += "nice -n {} ".format(self.nice)
+        name, _, level = self.ionice.partition(":")
+        if IONICE_CLASSES[name] and self._ionice:
+            prefix += "ionice -c {} ".format(IONICE_CLASSES[name]) + ("-n {} ".format(level) if level else "")
+        return prefix + command
+
+    def reader(self, source):
+        if not self.read_limiters:
+            return source
+        reader = ThrottledReader(source, self.read_limiters)
+        self._readers.append(reader)
+        return reader
+
+    def wrote(self, size):
+        for limiter in self.write_limiters:
+            limiter.consume(size)
+
+    def start(self, host, port, type):
+        # Measures the latency of the idle database, then keeps measuring it
+        # while the backup runs
+        if self._adaptive is None:
+            return
+        try:
+            baseline = sorted(_probe(host, port, type) for _ in range(BASELINE_PROBES))[BASELINE_PROBES // 2]
+        except OSError as e:
+            logging.warning(f"{self.log_prefix} Cannot measure the database latency, adaptive throttling is off. Error Output: {e}")
+            return
+        logging.debug(f"{self.log_prefix} Database latency before the backup: {baseline * 1000:.1f}ms")
+        self._thread = threading.Thread(target=self._watch, args=(host, port, type, baseline), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _bytes_read(self):
+        return sum(reader.bytes_in for reader in self._readers)
+
+    def _watch(self, host, port, type, baseline):
+        # A few milliseconds of headroom, so jitter on fast local connections
+        # doesn't count as slow down
+        threshold = baseline * BACKOFF_FACTOR + 0.005
+        last_read = self._bytes_read()
+        # Throughput without the adaptive limit, once the limit is raised
+        # above it, it is lifted again
+        peak = 0
+        while not self._stopped.wait(PROBE_SECONDS):
+            try:
+                latency = _probe(host, port, type)
+            except OSError:
+                latency = PROBE_TIMEOUT
+            bytes_read = self._bytes_read()
+            rate = self._adaptive.rate
+            if rate is None:
+                peak = max(peak, (bytes_read - last_read) / PROBE_SECONDS)
+            last_read = bytes_read
+
+            if latency > threshold:
+                new_rate = max(MIN_RATE, (rate or peak) / 2)
+                if new_rate != rate:
+                    logging.info(f"{self.log_prefix} Database latency is up to {latency * 1000:.1f}ms, slowing down to {new_rate / 1024 / 1024:.1f} MiB/s")
+                    self._adaptive.rate = new_rate
+            elif rate is not None and latency < (baseline + threshold) / 2:
+                new_rate = rate * RECOVER_FACTOR
+                if new_rate >= (self._ceiling or peak):
+                    new_rate = None
+                    logging.info(f"{self.log_prefix} Database latency is back to {latency * 1000:.1f}ms, no longer slowing down")
+                else:
+                    logging.debug(f"{self.log_prefix} Database latency is back to {latency * 1000:.1f}ms, raising the limit to {new_rate / 1024 / 1024:.1f} MiB/s")
+                self._adaptive.rate = new_rate
+
+def idle_priority():
+    # Lowers the CPU and I/O priority of the calling thread and of the
+    # threads it starts. Linux keeps both per thread.
+    thread_id = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, thread_id, 19)
+    except (AttributeError, OSError) as e:
+        logging.debug(f"Cannot lower the CPU priority. Error Output: {e}")
+    if Throttle._ionice:
+        subprocess.run([Throttle._ionice, "-c", "3", "-p", str(thread_id)], capture_output=True)
+
+# Shared by all backups that run at the same time
+_global_read = RateLimiter()
+_global_write = RateLimiter()
+
+def configure(config):
+    _global_read.rate = config.max_read_rate
+    _global_write.rate = config.max_write_rate
+
+def get(database, log_prefix=""):
+    return Throttle([RateLimiter(database.read_limit), _global_read],
+                    [RateLimiter(database.write_limit), _global_write],
+                    database.nice, database.ionice, database.adaptive_throttle, log_prefix)
+
+def limit_threads(codec, max_threads):
+    if max_threads and codec.threads > max_threads:
+        return codec.configure(codec.level, max_threads)
+    return codec
@@ -0,0 +1,142 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import pipeline
+from . import compression
+from . import encryption
+from . import store
+
+MANIFEST_FILE = "manifest.json"
+
+class Result:
+    # Outcome of the verification of one backup. Files without a checksum
+    # (written by older versions or by pg_dump itself) are only counted.
+
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.unchecked = 0
+        self.notes = []
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+def _drain(reader):
+    while reader.read(pipeline.BUFFER_SIZE):
+        pass
+
+def _manifest_files(value):
+    # All files a manifest of the parallel engines lists
+    if isinstance(value, dict):
+        if isinstance(value.get("file"), str):
+            yield value["file"]
+        for entry in value.values():
+            yield from _manifest_files(entry)
+    elif isinstance(value, list):
+        for entry in value:
+            yield from _manifest_files(entry)
+
+def _check_file(path, deep, passphrase, result, expected=None, name=None):
+    # Reads the file once: the checksum is computed on the way to the
+    # decryption and decompression of a deep check. name is the path of
+    # files inside a directory backup.
+    prefix = f"{name}: " if name else ""
+    result.files += 1
+    expected = expected or pipeline.read_checksum(path)
+    with open(path, "rb") as f:
+        source = pipeline.HashReader(f)
+        reader = source
+        if deep:
+            inner = os.path.basename(path)
+            if encryption.is_encrypted(inner):
+                inner = os.path.splitext(inner)[0]
+                reader = pipeline.decrypt(reader, passphrase) if passphrase else None
+            if reader is None:
+                result.notes.append(f"{prefix}not decrypted, no passphrase")
+                reader = source
+            else:
+                reader = compression.from_extension(os.path.splitext(inner)[1]).decompressor(reader)
+        _drain(reader)
+
+    if expected is None:
+        result.unchecked += 1
+    elif source.digest.hexdigest() != expected:
+        result.errors.append(f"{prefix}checksum mismatch")
+
+def _check_directory(path, deep, passphrase, result):
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        result.errors.append(f"{MANIFEST_FILE} is missing, the backup is incomplete")
+        return
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    for name in _manifest_files(manifest):
+        if not os.path.exists(os.path.join(path, name)):
+            result.errors.append(f"{name}: missing")
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(pipeline.CHECKSUM_EXTENSION) or (file == MANIFEST_FILE and root == path):
+                continue
+            file_path = os.path.join(root, file)
+            try:
+                _check_file(file_path, deep, passphrase, result, name=os.path.relpath(file_path, path))
+            except Exception as e:
+                result.errors.append(f"{os.path.relpath(file_path, path)}: {e}")
+
+def _check_snapshot(path, dump_dir, deep, passphrase, result):
+    # Chunks are addressed by their content, decoding them verifies them
+    dedup_store = store.get(dump_dir)
+    with open(path) as f:
+        manifest = json.load(f)
+    result.files += 1
+    if not manifest.get("encrypted"):
+        passphrase = ""
+    elif deep and not passphrase:
+        result.notes.append("not decrypted, no passphrase")
+        deep = False
+    if deep:
+        for _ in dedup_store.read(path, passphrase):
+            pass
+        return
+    for chunk_id in dedup_store.missing(path):
+        result.errors.append(f"chunk {chunk_id} is missing")
+
+def check(dump_dir, name, deep=False, passphrase="", checksum=None):
+    # Quick: compares the checksums of the files. Deep: also decrypts and
+    # decompresses them, without writing anything.
+    result = Result(name)
+    path = os.path.join(dump_dir, name)
+    try:
+        if not os.path.exists(path):
+            result.errors.append("missing")
+        elif os.path.isdir(path):
+            _check_directory(path, deep, passphrase, result)
+        elif name.endswith(store.SNAPSHOT_EXTENSION):
+            _check_snapshot(path, dump_dir, deep, passphrase, result)
+        else:
+            _check_file(path, deep, passphrase, result, checksum)
+    except Exception as e:
+        result.errors.append(str(e))
+    return result
+
+def verify(dump_dir, backups, deep=False, passphrase="", parallel=1):
+    # backups are catalog entries. Returns one Result per backup, in order.
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [executor.submit(check, dump_dir, backup["name"], deep, passphrase, backup.get("checksum")) for backup in backups]
+        results = []
+        for future in futures:
+            result = future.result()
+            if result.ok:
+                logging.debug(f"Verified {result.name} ({result.files} file(s), {result.unchecked} without checksum)")
+            else:
+                logging.error("Verification of {} failed: {}".format(result.name, "; ".join(result.errors)))
+            for note in result.notes:
+                logging.warning(f"{result.name}: {note}")
+            results.append(result)
+    return results
@@ -0,0 +1,66 @@
+# Stand-ins for the parts of the docker SDK the inventory uses. Events are
+# put into a queue by the test, None ends the stream like a lost connection.
+import queue
+
+import docker
+
+from src import settings
+
+class Image:
+    def __init__(self, tag):
+        self.tags = [tag]
+
+class Container:
+    def __init__(self, container_id, name, image="mysql:8", labels=None, status="running", ports=None):
+        self.id = container_id
+        self.short_id = container_id[:12]
+        self.name = name
+        self.image = Image(image)
+        self.labels = {settings.LABEL_PREFIX + "enable": "true"} if labels is None else labels
+        self.status = status
+        self.attrs = {"NetworkSettings": {"Ports": ports or {}}}
+
+class Containers:
+    def __init__(self, client, containers):
+        self.client = client
+        self.items = {container.id: container for container in containers}
+
+    def list(self, filters=None, all=False):
+        if self.client.error is not None:
+            raise self.client.error
+        return [container for container in self.items.values() if container.status == "running"]
+
+    def get(self, container_id):
+        if container_id not in self.items:
+            raise docker.errors.NotFound("No such container: " + container_id)
+        return self.items[container_id]
+
+class Client:
+    def __init__(self, containers=(), error=None):
+        self.containers = Containers(self, containers)
+        # Raised by containers.list(), a host that can't be reached
+        self.error = error
+        self.events_queue = queue.Queue()
+        self.streams = 0
+
+    def add(self, container):
+        self.containers.items[container.id] = container
+
+    def event(self, container_id, action):
+        self.events_queue.put({"Type": "container", "Action": action, "id": container_id, "time": 0})
+
+    def events(self, decode=False, since=None, filters=None):
+        self.streams += 1
+        while True:
+            event = self.events_queue.get()
+            if event is None:
+                return
+            yield event
+
+class Host:
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+
+    def __str__(self):
+        return self.name or "local"
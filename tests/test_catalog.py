@@ -0,0 +1,46 @@
+import shutil
+import datetime
+import tempfile
+import unittest
+
+from src import catalog
+
+class ExpiredTest(unittest.TestCase):
+    def setUp(self):
+        self.dump_dir = tempfile.mkdtemp()
+        self.catalog = catalog.Catalog(self.dump_dir)
+        self.now = datetime.datetime.now().replace(microsecond=0)
+
+    def tearDown(self):
+        self.catalog._connection.close()
+        shutil.rmtree(self.dump_dir)
+
+    def add(self, container, days):
+        created = self.now - datetime.timedelta(days=days)
+        name = "{}_{}.sql.gz".format(container, created.strftime("%Y%m%dT%H%M%S"))
+        self.catalog.add(name, container, "mysql", created, 1)
+        return name
+
+    def test_older_than_delete_days(self):
+        old = [self.add("db", days) for days in (10, 9, 8)]
+        self.add("db", 1)
+        self.add("db", 0)
+        self.assertEqual(self.catalog.expired(7, 0), sorted(old))
+
+    def test_keeps_the_newest_keep_min(self):
+        names = [self.add("db", days) for days in (10, 9, 8, 7)]
+        # All are expired, but the two newest are kept
+        self.assertEqual(self.catalog.expired(1, 2), sorted(names[:2]))
+
+    def test_keep_min_per_container(self):
+        first = [self.add("first", days) for days in (10, 9, 8)]
+        self.add("second", 10)
+        self.assertEqual(self.catalog.expired(1, 1), sorted(first[:2]))
+
+    def test_nothing_expired(self):
+        self.add("db", 10)
+        self.assertEqual(self.catalog.expired(1, 5), [])
+        self.assertEqual(self.catalog.expired(30, 0), [])
+
+if __name__ == "__main__":
+    unittest.main()
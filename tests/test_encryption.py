@@ -0,0 +1,118 @@
+import io
+import os
+import unittest
+
+import pyAesCrypt
+
+from src import pipeline
+from src import encryption
+
+CHUNK = encryption.CHUNK_SIZE
+SEALED_CHUNK = CHUNK + encryption.TAG_SIZE
+
+def encrypt(data, passphrase="secret", threads=1):
+    return pipeline.EncryptReader(pipeline.Reader(io.BytesIO(data)), passphrase, threads).read()
+
+def decrypt(data, passphrase="secret", threads=1):
+    return pipeline.decrypt(io.BytesIO(data), passphrase, threads).read()
+
+class EncryptionTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = os.urandom(CHUNK * 2 + 1234)
+        for threads in (1, 4):
+            with self.subTest(threads=threads):
+                encrypted = encrypt(data, threads=threads)
+                self.assertTrue(encrypted.startswith(encryption.MAGIC + bytes([encryption.VERSION])))
+                self.assertEqual(len(encrypted), encryption.HEADER_SIZE + len(data) + 3 * encryption.TAG_SIZE)
+                self.assertEqual(decrypt(encrypted, threads=threads), data)
+
+    def test_files_differ_with_the_same_passphrase(self):
+        data = b"same content"
+        self.assertNotEqual(encrypt(data), encrypt(data))
+
+    def test_empty_input(self):
+        encrypted = encrypt(b"")
+        # A single empty chunk, which still carries the last flag
+        self.assertEqual(len(encrypted), encryption.HEADER_SIZE + encryption.TAG_SIZE)
+        self.assertEqual(decrypt(encrypted), b"")
+
+    def test_exact_multiple_of_the_chunk_size(self):
+        data = os.urandom(CHUNK * 2)
+        encrypted = encrypt(data)
+        # No empty chunk follows, the second one is the last
+        self.assertEqual(len(encrypted), encryption.HEADER_SIZE + 2 * SEALED_CHUNK)
+        self.assertEqual(decrypt(encrypted), data)
+
+    def test_truncation_at_a_chunk_boundary(self):
+        encrypted = encrypt(os.urandom(CHUNK * 2 + 10))
+        for size in (encryption.HEADER_SIZE, encryption.HEADER_SIZE + SEALED_CHUNK, encryption.HEADER_SIZE + 2 * SEALED_CHUNK):
+            with self.subTest(size=size), self.assertRaises(encryption.DecryptionError):
+                decrypt(encrypted[:size])
+
+    def test_truncation_within_a_chunk(self):
+        encrypted = encrypt(os.urandom(1000))
+        with self.assertRaises(encryption.DecryptionError):
+            decrypt(encrypted[:-1])
+
+    def test_tampered_chunk(self):
+        encrypted = bytearray(encrypt(os.urandom(CHUNK + 10)))
+        encrypted[encryption.HEADER_SIZE + 100] ^= 1
+        with self.assertRaises(encryption.DecryptionError):
+            decrypt(bytes(encrypted))
+
+    def test_tampered_header(self):
+        # The header is authenticated with every chunk
+        encrypted = bytearray(encrypt(b"content"))
+        encrypted[encryption.HEADER_SIZE - 10] ^= 1
+        with self.assertRaises(encryption.DecryptionError):
+            decrypt(bytes(encrypted))
+
+    def test_reordered_chunks(self):
+        encrypted = encrypt(os.urandom(CHUNK * 3))
+        header = encrypted[:encryption.HEADER_SIZE]
+        chunks = [encrypted[offset:offset + SEALED_CHUNK] for offset in range(encryption.HEADER_SIZE, len(encrypted), SEALED_CHUNK)]
+        with self.assertRaises(encryption.DecryptionError):
+            decrypt(header + chunks[1] + chunks[0] + chunks[2])
+
+    def test_wrong_passphrase(self):
+        with self.assertRaises(encryption.DecryptionError):
+            decrypt(encrypt(b"content"), "wrong")
+
+    def test_unsupported_version(self):
+        encrypted = bytearray(encrypt(b"content"))
+        encrypted[len(encryption.MAGIC)] = encryption.VERSION + 1
+        with self.assertRaisesRegex(encryption.DecryptionError, "Unsupported encryption version"):
+            decrypt(bytes(encrypted))
+
+    def test_not_encrypted(self):
+        with self.assertRaisesRegex(encryption.DecryptionError, "Not an encrypted backup"):
+            decrypt(b"plain text that is long enough for a header............")
+
+class LegacyTest(unittest.TestCase):
+    def legacy(self, data, passphrase="secret"):
+        encrypted = io.BytesIO()
+        pyAesCrypt.encryptStream(io.BytesIO(data), encrypted, passphrase, 64 * 1024)
+        return encrypted.getvalue()
+
+    def test_round_trip(self):
+        data = os.urandom(200 * 1024 + 7)
+        self.assertEqual(decrypt(self.legacy(data)), data)
+
+    def test_wrong_passphrase(self):
+        with self.assertRaises(encryption.DecryptionError):
+            decrypt(self.legacy(b"content"), "wrong")
+
+    def test_source_errors_are_passed_on(self):
+        class Stopped(Exception):
+            pass
+
+        class Failing(pipeline.Reader):
+            def _process(self, data):
+                raise Stopped()
+
+        source = Failing(io.BytesIO(self.legacy(os.urandom(1024 * 1024))))
+        with self.assertRaises(Stopped):
+            pipeline.LegacyDecryptReader(source, "secret").read()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import time
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+
+from src import settings
+from src import inventory
+from src import dispatcher
+from src.docker import PublishedPorts, UnreachableError
+
+from . import fakes
+
+class InventoriesTest(unittest.TestCase):
+    def setUp(self):
+        self.first = fakes.Host("", fakes.Client([fakes.Container("a" * 64, "db")]))
+        self.second = fakes.Host("remote", fakes.Client([fakes.Container("b" * 64, "db")]))
+
+    def inventories(self, *hosts):
+        return inventory.Inventories(hosts, dict(settings.LABEL_DEFAULTS))
+
+    def test_merges_the_containers_of_all_hosts(self):
+        inventories = self.inventories(self.first, self.second)
+        inventories.seed()
+        containers = inventories.containers()
+        self.assertEqual(set(containers), {"a" * 64, "b" * 64})
+        self.assertIs(inventories.host("a" * 64), self.first)
+        self.assertIs(inventories.host("b" * 64), self.second)
+
+    def test_unreachable_host_is_left_out(self):
+        self.second.client.error = docker.errors.APIError("connection refused")
+        inventories = self.inventories(self.first, self.second)
+        with self.assertLogs(level="ERROR"):
+            inventories.seed()
+        self.assertEqual(list(inventories.containers()), ["a" * 64])
+
+    def test_fails_if_no_host_can_be_reached(self):
+        self.first.client.error = docker.errors.APIError("connection refused")
+        self.second.client.error = docker.errors.APIError("connection refused")
+        inventories = self.inventories(self.first, self.second)
+        with self.assertLogs(level="ERROR"), self.assertRaises(docker.errors.APIError):
+            inventories.seed()
+
+class DispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peak = {}
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+
+    def work(self, host):
+        with self.lock:
+            self.running[host] = self.running.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0), self.running[host])
+        self.release.wait(5)
+        with self.lock:
+            self.running[host] -= 1
+        return host
+
+    def test_limits_the_work_per_host(self):
+        slots = dispatcher.Dispatcher(self.executor, 1)
+        futures = [slots.submit(host, self.work, host) for host in ("a", "a", "a", "b")]
+        # The backup of b doesn't wait behind the ones of a
+        for _ in range(100):
+            with self.lock:
+                if self.running.get("b"):
+                    break
+            time.sleep(0.01)
+        with self.lock:
+            self.assertEqual(self.running, {"a": 1, "b": 1})
+        self.release.set()
+        self.assertEqual([future.result(5) for future in futures], ["a", "a", "a", "b"])
+        self.assertEqual(self.peak, {"a": 1, "b": 1})
+
+    def test_passes_exceptions_on(self):
+        slots = dispatcher.Dispatcher(self.executor, 1)
+        failed = slots.submit("a", lambda: 1 / 0)
+        after = slots.submit("a", lambda: "next")
+        self.assertIsInstance(failed.exception(5), ZeroDivisionError)
+        self.assertEqual(after.result(5), "next")
+
+class PublishedPortsTest(unittest.TestCase):
+    def target(self, bindings):
+        container = fakes.Container("a" * 64, "db", ports={"3306/tcp": bindings})
+        return PublishedPorts("docker.example.com").target(container, 3306)
+
+    def test_all_interfaces_use_the_host_address(self):
+        for ip in ("", "0.0.0.0", "::"):
+            with self.subTest(ip=ip):
+                self.assertEqual(self.target([{"HostIp": ip, "HostPort": "13306"}]), ("docker.example.com", 13306))
+
+    def test_bound_address_is_used(self):
+        self.assertEqual(self.target([{"HostIp": "10.0.0.5", "HostPort": "13306"}]), ("10.0.0.5", 13306))
+
+    def test_loopback_binding_is_skipped(self):
+        bindings = [{"HostIp": "127.0.0.1", "HostPort": "13306"}, {"HostIp": "0.0.0.0", "HostPort": "23306"}]
+        self.assertEqual(self.target(bindings), ("docker.example.com", 23306))
+
+    def test_unreachable(self):
+        for bindings in (None, [], [{"HostIp": "127.0.0.1", "HostPort": "13306"}], [{"HostIp": "::1", "HostPort": "13306"}]):
+            with self.subTest(bindings=bindings), self.assertRaises(UnreachableError):
+                self.target(bindings)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import time
+import threading
+import unittest
+
+from src import settings
+from src import inventory
+
+from . import fakes
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met within {} seconds".format(timeout))
+        time.sleep(0.01)
+
+class InventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.changes = 0
+        self.db = fakes.Container("a" * 64, "db")
+        self.client = fakes.Client([self.db])
+        self.inventory = inventory.Inventory(self.client, dict(settings.LABEL_DEFAULTS), on_change=self.changed)
+
+    def changed(self):
+        self.changes += 1
+
+    def test_seed_lists_running_containers(self):
+        self.client.add(fakes.Container("b" * 64, "stopped", status="exited"))
+        self.inventory.seed()
+        self.assertEqual(list(self.inventory.containers()), [self.db.id])
+        self.assertEqual(self.changes, 1)
+
+    def test_seed_applies_the_container_filter(self):
+        self.client.add(fakes.Container("b" * 64, "other"))
+        filtered = inventory.Inventory(self.client, dict(settings.LABEL_DEFAULTS), ["other"])
+        filtered.seed()
+        self.assertEqual(list(filtered.containers()), ["b" * 64])
+
+    def test_start_adds_the_container(self):
+        self.inventory.seed()
+        other = fakes.Container("b" * 64, "other")
+        self.client.add(other)
+        self.inventory.handle({"Action": "start", "id": other.id})
+        self.assertEqual(set(self.inventory.containers()), {self.db.id, other.id})
+        self.assertEqual(self.changes, 2)
+
+    def test_stop_and_destroy_remove_the_container(self):
+        for action in inventory.REMOVE_ACTIONS:
+            with self.subTest(action=action):
+                self.inventory.seed()
+                self.inventory.handle({"Action": action, "id": self.db.id})
+                self.assertEqual(self.inventory.containers(), {})
+
+    def test_update_of_a_removed_container(self):
+        self.inventory.seed()
+        del self.client.containers.items[self.db.id]
+        self.inventory.handle({"Action": "update", "id": self.db.id})
+        self.assertEqual(self.inventory.containers(), {})
+
+    def test_update_reads_the_labels_again(self):
+        self.inventory.seed()
+        self.db.labels[settings.LABEL_PREFIX + "compress"] = "zstd"
+        self.inventory.handle({"status": "rename", "Actor": {"ID": self.db.id}})
+        self.assertEqual(self.inventory.containers()[self.db.id][1].compress, "zstd")
+
+    def test_unknown_events_are_ignored(self):
+        self.inventory.seed()
+        self.inventory.handle({"Action": "exec_start", "id": self.db.id})
+        self.inventory.handle({"Action": "stop"})
+        self.assertEqual(list(self.inventory.containers()), [self.db.id])
+        self.assertEqual(self.changes, 1)
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.reconnect_seconds = inventory.RECONNECT_SECONDS
+        inventory.RECONNECT_SECONDS = 0.05
+        self.db = fakes.Container("a" * 64, "db")
+        self.client = fakes.Client([self.db])
+        self.changed = threading.Event()
+        self.inventory = inventory.Inventory(self.client, dict(settings.LABEL_DEFAULTS), on_change=self.changed.set)
+        self.inventory.seed()
+
+    def tearDown(self):
+        self.inventory.stop()
+        self.client.events_queue.put(None)
+        inventory.RECONNECT_SECONDS = self.reconnect_seconds
+
+    def test_follows_the_events_stream(self):
+        self.inventory.start()
+        other = fakes.Container("b" * 64, "other")
+        self.client.add(other)
+        self.client.event(other.id, "start")
+        wait_for(lambda: other.id in self.inventory.containers())
+        self.client.event(self.db.id, "die")
+        wait_for(lambda: self.db.id not in self.inventory.containers())
+
+    def test_seeds_again_after_the_stream_ended(self):
+        self.inventory.start()
+        # Started while the stream was down, so there is no event for it
+        other = fakes.Container("b" * 64, "other")
+        self.client.add(other)
+        self.client.events_queue.put(None)
+        wait_for(lambda: other.id in self.inventory.containers())
+        wait_for(lambda: self.client.streams >= 2)
+
+if __name__ == "__main__":
+    unittest.main()
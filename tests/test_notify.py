@@ -0,0 +1,178 @@
+import time
+import threading
+import unittest
+import http.server
+
+from src import notify
+
+class Server(http.server.ThreadingHTTPServer):
+    # Records the requests. /fail/<n> answers 500 to the first n requests,
+    # so do the paths in failures, /missing answers 404 and /block waits
+    # until unblock is set.
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.requests = []
+        self.failures = {}
+        self.unblock = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return "http://127.0.0.1:{}{}".format(self.server_port, path)
+
+    def paths(self):
+        with self.lock:
+            return [path for _, path, _ in self.requests]
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def handle_request(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path, body))
+            count = sum(1 for _, path, _ in self.server.requests if path == self.path)
+        status = 200
+        if self.path == "/block":
+            self.server.unblock.wait(5)
+        elif self.path == "/missing":
+            status = 404
+        elif self.path.startswith("/fail/") and count <= int(self.path.split("/")[2]):
+            status = 500
+        elif count <= self.server.failures.get(self.path, 0):
+            status = 500
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = do_PUT = handle_request
+
+    def log_message(self, *args):
+        pass
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met within {} seconds".format(timeout))
+        time.sleep(0.01)
+
+class NotifierTest(unittest.TestCase):
+    def setUp(self):
+        self.backoff_seconds = notify.BACKOFF_SECONDS
+        notify.BACKOFF_SECONDS = 0.05
+        self.server = Server()
+        self.notifiers = []
+
+    def tearDown(self):
+        self.server.unblock.set()
+        for notifier in self.notifiers:
+            notifier.stop(5)
+        self.server.shutdown()
+        self.server.server_close()
+        notify.BACKOFF_SECONDS = self.backoff_seconds
+
+    def notifier(self, retries=3, queue_size=100):
+        notifier = notify.Notifier(retries, queue_size)
+        self.notifiers.append(notifier)
+        return notifier
+
+    def block(self, notifier):
+        # Keeps the thread of the notifier busy until unblock is set
+        notifier.send("GET", self.server.url("/block"))
+        wait_for(lambda: "/block" in self.server.paths())
+
+    def test_send_does_not_wait_for_the_server(self):
+        notifier = self.notifier()
+        self.block(notifier)
+        started = time.monotonic()
+        notifier.send("PUT", self.server.url("/ping"), "message")
+        self.assertLess(time.monotonic() - started, 1)
+        self.server.unblock.set()
+        wait_for(lambda: "/ping" in self.server.paths())
+        self.assertIn(("PUT", "/ping", b"message"), self.server.requests)
+
+    def test_server_errors_are_retried(self):
+        notifier = self.notifier(retries=3)
+        notifier.send("GET", self.server.url("/fail/2"))
+        wait_for(lambda: self.server.paths().count("/fail/2") == 3)
+
+    def test_retries_are_limited(self):
+        notifier = self.notifier(retries=2)
+        with self.assertLogs(level="ERROR"):
+            notifier.send("GET", self.server.url("/fail/9"))
+            wait_for(lambda: self.server.paths().count("/fail/9") == 2)
+            time.sleep(0.3)
+        self.assertEqual(self.server.paths().count("/fail/9"), 2)
+
+    def test_client_errors_are_not_retried(self):
+        notifier = self.notifier(retries=3)
+        with self.assertLogs(level="ERROR"):
+            notifier.send("GET", self.server.url("/missing"))
+            wait_for(lambda: "/missing" in self.server.paths())
+            time.sleep(0.3)
+        self.assertEqual(self.server.paths().count("/missing"), 1)
+
+    def test_duplicates_are_sent_once(self):
+        notifier = self.notifier()
+        self.block(notifier)
+        notifier.send("PUT", self.server.url("/ping"), "same")
+        notifier.send("PUT", self.server.url("/ping"), "same")
+        notifier.send("PUT", self.server.url("/ping"), "other")
+        self.server.unblock.set()
+        notifier.stop(5)
+        self.assertEqual([body for _, path, body in self.server.requests if path == "/ping"], [b"same", b"other"])
+
+    def test_check_keeps_its_order_through_retries(self):
+        self.server.failures["/check/start"] = 1
+        notifier = self.notifier()
+        check = self.server.url("/check")
+        notifier.send("GET", check + "/start", check=check)
+        notifier.send("PUT", check, "finished", check=check)
+        notifier.send("GET", self.server.url("/other"))
+        wait_for(lambda: "/check" in self.server.paths())
+        # The end of the run waits for its start, other checks go ahead
+        self.assertEqual(self.server.paths(), ["/check/start", "/other", "/check/start", "/check"])
+
+    def test_duplicates_only_of_the_last_notification_of_a_check(self):
+        notifier = self.notifier()
+        self.block(notifier)
+        check = self.server.url("/check")
+        for path in ("/check/start", "/check", "/check/start"):
+            notifier.send("GET", self.server.url(path), check=check)
+        self.server.unblock.set()
+        notifier.stop(5)
+        self.assertEqual(self.server.paths(), ["/block", "/check/start", "/check", "/check/start"])
+
+    def test_oldest_is_dropped_when_the_queue_is_full(self):
+        notifier = self.notifier(queue_size=2)
+        self.block(notifier)
+        with self.assertLogs(level="WARNING"):
+            for path in ("/first", "/second", "/third"):
+                notifier.send("GET", self.server.url(path))
+        self.server.unblock.set()
+        notifier.stop(5)
+        self.assertEqual(self.server.paths(), ["/block", "/second", "/third"])
+
+    def test_stop_flushes_the_queue(self):
+        notifier = self.notifier(retries=5)
+        self.block(notifier)
+        notifier.send("GET", self.server.url("/ping"))
+        notifier.send("GET", self.server.url("/fail/9"))
+        self.server.unblock.set()
+        with self.assertLogs(level="ERROR"):
+            notifier.stop(5)
+        self.assertFalse(notifier._thread.is_alive())
+        # Waiting notifications go out at once, without further retries
+        self.assertEqual(self.server.paths(), ["/block", "/ping", "/fail/9"])
+
+    def test_stop_warns_about_unsent_notifications(self):
+        notifier = self.notifier()
+        self.block(notifier)
+        notifier.send("GET", self.server.url("/ping"))
+        with self.assertLogs(level="WARNING") as logs:
+            notifier.stop(0.1)
+        self.assertIn("2 notification(s) could not be sent", "\n".join(logs.output))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import io
+import time
+import shutil
+import tempfile
+import unittest
+
+from src import store
+from src import pipeline
+from src import compression
+
+class GarbageCollectionTest(unittest.TestCase):
+    def setUp(self):
+        self.dump_dir = tempfile.mkdtemp()
+        self.store = store.Store(self.dump_dir)
+        self.codec = compression.get("zstd", threads=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.dump_dir)
+
+    def save(self, name, data, passphrase=""):
+        snapshot = os.path.join(self.dump_dir, name + store.SNAPSHOT_EXTENSION)
+        self.store.save(pipeline.Reader(io.BytesIO(data)), snapshot, self.codec, passphrase)
+        return snapshot
+
+    def chunks(self):
+        return {f for _, _, files in os.walk(self.store.chunk_dir) for f in files}
+
+    def age(self):
+        # Chunks younger than the grace period are never deleted
+        past = time.time() - store.GC_GRACE_SECONDS - 60
+        for root, _, files in os.walk(self.store.chunk_dir):
+            for f in files:
+                os.utime(os.path.join(root, f), (past, past))
+
+    def test_deletes_unreferenced_chunks(self):
+        shared = os.urandom(2 * 1024 * 1024)
+        kept = self.save("kept_20240101T000000.sql", shared + os.urandom(1024 * 1024))
+        removed = self.save("removed_20240101T000000.sql", shared + os.urandom(1024 * 1024))
+        before = self.chunks()
+        os.remove(removed)
+        self.age()
+
+        referenced, deleted, freed = self.store.collect_garbage(self.dump_dir)
+        self.assertGreater(deleted, 0)
+        self.assertGreater(freed, 0)
+        self.assertEqual(len(self.chunks()), len(before) - deleted)
+        self.assertEqual(referenced, len(self.chunks()))
+        self.assertEqual(self.store.missing(kept), [])
+
+    def test_keeps_young_chunks(self):
+        removed = self.save("removed_20240101T000000.sql", os.urandom(1024 * 1024))
+        before = self.chunks()
+        os.remove(removed)
+        # A backup in progress has chunks, but no snapshot yet
+        self.assertEqual(self.store.collect_garbage(self.dump_dir)[1], 0)
+        self.assertEqual(self.chunks(), before)
+
+    def test_content_survives(self):
+        data = os.urandom(3 * 1024 * 1024)
+        snapshot = self.save("db_20240101T000000.sql", data, "secret")
+        self.save("other_20240101T000000.sql", os.urandom(1024 * 1024))
+        os.remove(os.path.join(self.dump_dir, "other_20240101T000000.sql" + store.SNAPSHOT_EXTENSION))
+        self.age()
+        self.store.collect_garbage(self.dump_dir)
+        self.assertEqual(b"".join(self.store.read(snapshot, "secret")), data)
+
+if __name__ == "__main__":
+    unittest.main()